@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the write, query and cohort hot paths of bitmapist against
+a Redis server.
+
+For every data size (the number of distinct user ids), the benchmark
+loads 30 days of "active" and "purchase" events and times each operation,
+reporting ops/sec, p50/p99 latency and the number of Redis commands per
+operation, taken from INFO commandstats. Each size runs with the same
+random seed, so runs are comparable.
+
+Only keys under `--prefix` are written and deleted, but the command
+statistics of the server are reset, so prefer a dedicated instance::
+
+    $ redis-server --port 6399 --save ''
+    $ python benchmarks/bench_bitmapist.py --port 6399 --sizes 10000,1000000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+import redis
+
+from bitmapist import Bitmapist, BufferedBitmapist
+from bitmapist.cohort import Cohort
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--prefix', default='bench', help='Key prefix of the benchmark data')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='Comma separated numbers of distinct user ids')
+    parser.add_argument('--repeat', type=int, default=200, help='Timed calls per operation')
+    parser.add_argument('--names', type=int, default=2000,
+                        help='Event names created for the name listing benchmarks')
+    parser.add_argument('--only', help='Comma separated names of the benchmarks to run')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+    args = parser.parse_args(argv)
+
+    client = redis.Redis(host=args.host, port=args.port, db=args.db)
+    bm = Bitmapist(client, prefix=args.prefix)
+    only = set(args.only.split(',')) if args.only else None
+
+    results = []
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            bm.delete_all()
+            random.seed(size)
+            now = datetime.utcnow()
+            _load_events(bm, size, now)
+
+            for name, setup, operation in _get_benchmarks(bm, size, now, args):
+                if only and name not in only:
+                    continue
+                if setup is not None:
+                    setup()
+                result = _run(client, operation, args.repeat)
+                result.update(benchmark=name, size=size)
+                results.append(result)
+                _report(result, args.json)
+    finally:
+        bm.delete_all()
+    return results
+
+
+def _get_benchmarks(bm, size, now, args):
+    """
+    Returns `(name, setup, operation)` triples. `setup` runs once, untimed.
+    """
+    yesterday = now - timedelta(days=1)
+    random_id = lambda: random.randint(0, size - 1)
+
+    def nested_bit_op():
+        return bm.bit_op_and(
+            bm.bit_op_or(bm.get_day_event('active', now), bm.get_day_event('active', yesterday)),
+            bm.bit_op_xor(bm.get_month_event('active', now), bm.get_month_event('purchase', now)),
+        ).get_count()
+
+    scanning = Bitmapist(bm.redis_client, prefix=bm.prefix, name_registry=False)
+
+    def create_names():
+        with BufferedBitmapist(bm.redis_client, prefix=bm.prefix, max_marks=10000) as buffered:
+            for index in range(args.names):
+                buffered.mark_event('name:%d' % index, random_id(), now=now, hour=False)
+        bm.rebuild_name_registry()
+        # Both listings must find the same names, or they are not timing the same work
+        assert bm.get_all_event_names() == scanning.get_all_event_names()
+    uuids = [random_id() for _ in range(1000)]
+
+    return [
+        ('mark_event', None,
+         lambda: bm.mark_event('active', random_id(), now=now)),
+        ('mark_attribute_multi', None,
+         lambda: bm.mark_attribute_multi('paid_user', uuids)),
+        ('get_count', None,
+         lambda: bm.get_month_event('active', now).get_count()),
+        ('get_count_range', None,
+         lambda: bm.get_month_event('active', now).get_count(size // 4, size // 2 + 3)),
+        ('nested_bit_op', None, nested_bit_op),
+        ('get_all_event_names', create_names, bm.get_all_event_names),
+        ('get_all_event_names_scan', None, scanning.get_all_event_names),
+        ('cohort_days', None,
+         lambda: Cohort(bm).get_dates_data('active', 'purchase', time_group='days')),
+        ('cohort_months', None,
+         lambda: Cohort(bm).get_dates_data('active', 'purchase', time_group='months')),
+    ]
+
+
+def _load_events(bm, size, now):
+    """
+    Marks a tenth of the ids active, and a third of those purchasing,
+    on each of the last 30 days.
+    """
+    with BufferedBitmapist(bm.redis_client, prefix=bm.prefix, max_marks=100000) as buffered:
+        for days_ago in range(30):
+            day = now - timedelta(days=days_ago)
+            for uuid in random.sample(range(size), max(size // 10, 1)):
+                buffered.mark_event('active', uuid, now=day)
+                if uuid % 3 == 0:
+                    buffered.mark_event('purchase', uuid, now=day)
+
+
+def _run(client, operation, repeat):
+    operation()  # Warm up caches and connections
+
+    client.config_resetstat()
+    latencies = []
+    started = time.time()
+    for _ in range(repeat):
+        start = time.time()
+        operation()
+        latencies.append(time.time() - start)
+    elapsed = time.time() - started
+
+    commands = _count_commands(client)
+    latencies.sort()
+    return {
+        'ops_per_sec': repeat / elapsed if elapsed else float('inf'),
+        'p50_ms': _percentile(latencies, 0.5) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'commands_per_op': commands / float(repeat),
+    }
+
+
+def _count_commands(client):
+    stats = client.info('commandstats')
+    return sum(stat['calls'] for name, stat in stats.items()
+               if name != 'cmdstat_config')
+
+
+def _percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def _report(result, as_json):
+    if as_json:
+        print(json.dumps(result, sort_keys=True))
+    else:
+        print('%-26s %9d ids %12.1f ops/s   p50 %8.3f ms   p99 %8.3f ms   %8.1f cmds/op' % (
+            result['benchmark'], result['size'], result['ops_per_sec'],
+            result['p50_ms'], result['p99_ms'], result['commands_per_op']))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
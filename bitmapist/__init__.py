@@ -24,7 +24,8 @@ If you want to read more about bitmaps please read following:
 * http://en.wikipedia.org/wiki/Bit_array
 * http://www.slideshare.net/crashlytics/crashlytics-on-redis-analytics
 
-Requires Redis 2.6+ and newest version of redis-py.
+Requires Redis 2.8+ and redis-py 2.10+. Keys are deleted with UNLINK on Redis 4.0+
+and bits are written and read in bulk with BITFIELD on Redis 3.2+.
 
 Examples
 ========
@@ -80,51 +81,211 @@ Nest bit operations!::
 :license: BSD
 """
 
+import operator
 import re
+import threading
+import time
 
-from datetime import datetime
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from functools import reduce
+from hashlib import sha1
+from uuid import uuid4
+
+from redis.exceptions import NoScriptError, ResponseError
+
+from bitmapist.instrumentation import Instrumentation, _instrumented, _InstrumentedClient  # noqa: F401
 
 
 class Bitmapist(object):
 
-    def __init__(self, redis_client, prefix='trackist', divider=':', temp_ttl=None):
+    def __init__(self, redis_client, prefix='trackist', divider=':', temp_ttl=None,
+                 use_script=False, plan_bit_ops=False, cache_bit_ops=False, scan_count=1000,
+                 name_registry=True, registry_refresh=3600, id_mapper=None,
+                 rollup=False, cluster=False, hash_tag=None, segment_size=None,
+                 temp_memory_budget=None, instrumentation=None):
         """
         :param :temp_ttl Time to live for temporary bit op keys. Defaults to 60 seconds
+        :param :use_script If `True`, `mark_event` runs as a single server-side Lua script
+                           instead of a MULTI block. TTLs are then only applied to new keys.
+                           Requires Redis 2.6+ with scripting enabled
+        :param :plan_bit_ops If `True`, bit operations fetch the size of their operands
+                             first and skip work that cannot change the result,
+                             e.g. an AND with a missing bitmap. Costs one extra round trip
+        :param :cache_bit_ops If `True`, bit operation results are stored under content addressed
+                              keys and reused until one of their operands is written to.
+                              Every mark then also writes a version token next to each key
+                              it marks, which expires with it
+        :param :scan_count The COUNT hint used when scanning for keys, and the default
+                           batch size when deleting them
+        :param :name_registry If `True`, event and attribute names are recorded in sorted sets
+                              scored by when they were last seen. Once `rebuild_name_registry`
+                              has recorded the names marked before, they are listed from
+                              the registry instead of by scanning the keyspace
+        :param :registry_refresh How many seconds a process waits before recording a name
+                                 it has already recorded again. Defaults to an hour
+        :param :id_mapper An `IdMapper` translating the uuids passed to the mark methods
+                          and membership checks into dense bitmap offsets
+        :param :rollup If `True`, marks in the current week and month only write
+                       their day and hour bits. Week and month bitmaps are derived
+                       by OR-ing their days on read, until `compact_rollups` has
+                       materialized them. Scans for event names then match day
+                       keys too, since open weeks have no week keys
+        :param :cluster If `True`, `redis_client` is a Redis Cluster client. Writes are sent in
+                        non-transactional pipelines, temporary keys share the hash slot of
+                        their operands and bit operations over keys in different slots
+                        are computed client-side. Not compatible with `use_script`, `cache_bit_ops`
+                        and `id_mapper`, whose scripts touch keys in several slots
+        :param :hash_tag Groups keys into hash slots: "event" puts all the bitmaps
+                         of an event in one slot, "month" all the bitmaps of a month.
+                         Operations within a group then run on a single node
+        :param :segment_size If set, every bitmap is split into segments of `segment_size` ids
+                             (a multiple of 8, e.g. 2 ** 20). Segment N is stored under
+                             `{key}{divider}s{divider}N` and the set of existing segments
+                             under the bitmap's own key. Counts and bit operations then run
+                             one bounded command per segment and skip absent segments.
+                             Not compatible with `use_script`, `cache_bit_ops` and `rollup`
+        :param :temp_memory_budget How many bytes the results of bit operations may use.
+                                   Results are tracked in a registry by last use and the least
+                                   recently used ones are deleted early when the budget is
+                                   exceeded. Not compatible with `cluster` and `segment_size`
+        :param :instrumentation An `Instrumentation` recording the wall time, round trips,
+                                commands and bytes of every public call, see
+                                `bitmapist.instrumentation`
 
         """
+        if hash_tag not in (None, 'event', 'month'):
+            raise ValueError('hash_tag must be "event" or "month"')
+        if cluster and cache_bit_ops:
+            raise ValueError('Cached bit operations are not supported in cluster mode')
+        if cluster and (use_script or id_mapper is not None):
+            raise ValueError('use_script and id_mapper are not supported in cluster mode')
+        if segment_size is not None:
+            if segment_size <= 0 or segment_size % 8:
+                raise ValueError('segment_size must be a positive multiple of 8')
+            if use_script or cache_bit_ops or rollup:
+                raise ValueError('Segmented bitmaps do not support use_script, cache_bit_ops or rollup')
+        if temp_memory_budget is not None and (cluster or segment_size):
+            raise ValueError('temp_memory_budget is not supported with cluster or segment_size')
+
+        if instrumentation is not None:
+            redis_client = _InstrumentedClient(redis_client, instrumentation)
+
         self.redis_client = redis_client
+        self.instrumentation = instrumentation
         self.prefix = prefix
         self.divider = divider
         self.temp_ttl = temp_ttl or 60
+        self.use_script = use_script
+        self.plan_bit_ops = plan_bit_ops
+        self.cache_bit_ops = cache_bit_ops
+        self.scan_count = scan_count
+        self._supports_unlink = True
+        self._supports_bitfield = None
+        self.name_registry = name_registry
+        self.registry_refresh = registry_refresh
+        self._registered_names = {'ev': {}, 'at': {}}
+        self.id_mapper = id_mapper
+        self.rollup = rollup
+        self._sealed_key = divider.join([prefix, 'rollup', 'sealed'])
+        self._sealed_keys = set()
+        self._range_covers = _LRUCache(1000)
+        self.cluster = cluster
+        self.hash_tag = hash_tag
+        self.segment_size = segment_size
+        self.temp_memory_budget = temp_memory_budget
+
+        self._mark_event_script = None
+        if use_script:
+            self._mark_event_script = redis_client.register_script(_MARK_EVENT_SCRIPT)
 
     def get_month_event(self, event_name, now):
-        return MonthEvents(event_name, now.year, now.month, self.prefix, self.divider, self.redis_client)
+        month_events = self._get_stored_month_event(event_name, now)
+        if not self.rollup:
+            return month_events
+        return self._get_rollup(event_name, month_events, _month_days(now))
 
     def get_week_event(self, event_name, now):
-        return WeekEvents(event_name, now.isocalendar()[0], now.isocalendar()[1], self.prefix, self.divider, self.redis_client)
+        week_events = self._get_stored_week_event(event_name, now)
+        if not self.rollup:
+            return week_events
+        return self._get_rollup(event_name, week_events, _week_days(now))
+
+    def _get_stored_month_event(self, event_name, now):
+        return MonthEvents(event_name, now.year, now.month, self.prefix, self.divider, self.redis_client,
+                           id_mapper=self.id_mapper, hash_tag=self.hash_tag, segment_size=self.segment_size)
+
+    def _get_stored_week_event(self, event_name, now):
+        return WeekEvents(event_name, now.isocalendar()[0], now.isocalendar()[1], self.prefix, self.divider, self.redis_client,
+                          id_mapper=self.id_mapper, hash_tag=self.hash_tag, segment_size=self.segment_size)
 
     def get_day_event(self, event_name, now):
-        return DayEvents(event_name, now.year, now.month, now.day, self.prefix, self.divider, self.redis_client)
+        return DayEvents(event_name, now.year, now.month, now.day, self.prefix, self.divider, self.redis_client,
+                         id_mapper=self.id_mapper, hash_tag=self.hash_tag, segment_size=self.segment_size)
 
     def get_hour_event(self, event_name, now):
-        return HourEvents(event_name, now.year, now.month, now.day, now.hour, self.prefix, self.divider, self.redis_client)
+        return HourEvents(event_name, now.year, now.month, now.day, now.hour, self.prefix, self.divider, self.redis_client,
+                          id_mapper=self.id_mapper, hash_tag=self.hash_tag, segment_size=self.segment_size)
+
+    def get_range_event(self, event_name, start, end):
+        """
+        Returns a bit operation with the users that had `event_name` between
+        the hours of `start` and `end`, both inclusive.
+
+        The interval is covered with as few bitmaps as possible: whole months,
+        then whole ISO weeks, days and finally hours at the edges. All of them
+        are OR-ed by a single lazy bit operation. Covers are cached per interval.
+
+        Example::
+
+            # Unique active users over the last 30 days
+            active = bm.get_range_event('active', now - timedelta(days=30), now)
+            print len(active)
+        """
+        start = start.replace(minute=0, second=0, microsecond=0)
+        end = end.replace(minute=0, second=0, microsecond=0)
+        if end < start:
+            raise ValueError('The end of the range is before its start')
+
+        cover = self._range_covers.get((start, end))
+        if cover is None:
+            cover = _get_range_cover(start, end)
+            self._range_covers.set((start, end), cover)
+
+        get_events = {
+            'month': self.get_month_event,
+            'week': self.get_week_event,
+            'day': self.get_day_event,
+            'hour': self.get_hour_event,
+        }
+        return self.bit_op_or(*[get_events[granularity](event_name, now)
+                                for granularity, now in cover])
 
     def get_attribute(self, attribute_name):
-        return Attributes(attribute_name, self.prefix, self.divider, self.redis_client)
+        return Attributes(attribute_name, self.prefix, self.divider, self.redis_client,
+                          id_mapper=self.id_mapper, hash_tag=self.hash_tag, segment_size=self.segment_size)
 
     def bit_op_and(self, *bitmaps):
-        return BitOpAnd(self.prefix, self.divider, self.redis_client, self.temp_ttl, *bitmaps)
+        return self._bit_op(BitOpAnd, *bitmaps)
 
     def bit_op_or(self, *bitmaps):
-        return BitOpOr(self.prefix, self.divider, self.redis_client, self.temp_ttl, *bitmaps)
+        return self._bit_op(BitOpOr, *bitmaps)
 
     def bit_op_xor(self, *bitmaps):
-        return BitOpXor(self.prefix, self.divider, self.redis_client, self.temp_ttl, *bitmaps)
+        return self._bit_op(BitOpXor, *bitmaps)
 
     def bit_op_not(self, bitmap):
-        return BitOpNot(self.prefix, self.divider, self.redis_client, self.temp_ttl, bitmap)
+        return self._bit_op(BitOpNot, bitmap)
+
+    def _bit_op(self, op_class, *bitmaps):
+        return op_class(self.prefix, self.divider, self.redis_client, self.temp_ttl, *bitmaps,
+                        plan=self.plan_bit_ops, cache=self.cache_bit_ops, id_mapper=self.id_mapper,
+                        cluster=self.cluster, segment_size=self.segment_size,
+                        memory_budget=self.temp_memory_budget)
 
     #--- Events marking and deleting ----------------------------------------------
+    @_instrumented
     def mark_event(self, event_name, uuid, now=None, month=True, week=True, day=True, hour=True,
             month_ttl=None, week_ttl=None, day_ttl=None, hour_ttl=None):
         """
@@ -142,6 +303,10 @@ class Bitmapist(object):
         :param :day_ttl Time to live for the day key, in seconds or timedelta
         :param :hour_ttl Time to live for the hour key, in seconds or timedelta
 
+        When the instance was created with `use_script=True` all keys, and the
+        event name in the name registry, are written by one EVALSHA and the TTLs
+        are only set on keys that did not exist yet.
+
         Examples::
 
             # Mark id 1 as active
@@ -156,35 +321,295 @@ class Bitmapist(object):
         if not now:
             now = datetime.utcnow()
 
-        stat_objs = []
+        if self.id_mapper is not None:
+            uuid = self.id_mapper.get_offset(uuid)
+
+        stat_objs = self._get_event_targets(event_name, now, month, week, day, hour,
+                                            month_ttl, week_ttl, day_ttl, hour_ttl)
+
+        if self._mark_event_script is not None:
+            keys = [obj.redis_key for obj, _ in stat_objs]
+            if self.cache_bit_ops:
+                keys += [_version_key(self.prefix, self.divider, key) for key in keys]
+            registered_at = None
+            if self._needs_registering('ev', event_name):
+                registered_at = time.time()
+                keys.append(self._registry_key('ev'))
+            if keys:
+                self._mark_event_script(
+                    keys=keys,
+                    args=[uuid, _version_token(), '' if registered_at is None else int(registered_at),
+                          event_name] + [_ttl_seconds(ttl) for _, ttl in stat_objs])
+            if registered_at is not None:
+                self._registered_names['ev'][event_name] = registered_at
+            return
+
+        with self.redis_client.pipeline(transaction=not self.cluster) as p:
+            for obj, ttl in stat_objs:
+                self._queue_setbits(p, obj.redis_key, [uuid], 1, ttl)
+                self._queue_version_bump(p, obj.redis_key, ttl)
+            self._register_name(p, 'ev', event_name)
+            p.execute()
+
+    @_instrumented
+    def mark_events_bulk(self, events, batch_size=10000, month=True, week=True, day=True, hour=True,
+            month_ttl=None, week_ttl=None, day_ttl=None, hour_ttl=None):
+        """
+        Marks many events at once. Marks are grouped by their target keys
+        and flushed in non-transactional pipelines of at most `batch_size` SETBITs,
+        so replaying a large event stream costs one round trip per batch instead of one per event.
+
+        :param :events An iterable of `(event_name, uuid)` or `(event_name, uuid, now)` tuples.
+                       Events without a `now` are marked at the time they are read
+        :param :batch_size How many marks to buffer before flushing them to Redis
+        :param :month, week, day, hour, month_ttl, week_ttl, day_ttl, hour_ttl See `mark_event`
+        :return The number of events that were marked
+
+        Examples::
+
+            bm.mark_events_bulk([
+                ('active', 1, datetime(2012, 10, 23)),
+                ('active', 2, datetime(2012, 10, 23)),
+                ('song:played', 1),
+            ])
+        """
+        if self.id_mapper is not None:
+            events = self._map_event_ids(events, batch_size)
+
+        targets_cache = {}
+        event_names = set()
+        pending = {}
+        pending_count = 0
+        marked = 0
+
+        for event in events:
+            if len(event) == 3:
+                event_name, uuid, now = event
+            else:
+                event_name, uuid = event
+                now = None
+            now = now or datetime.utcnow()
+
+            cache_key = (event_name, now.year, now.month, now.day, now.hour)
+            targets = targets_cache.get(cache_key)
+            if targets is None:
+                targets = self._get_event_targets(event_name, now, month, week, day, hour,
+                                                  month_ttl, week_ttl, day_ttl, hour_ttl)
+                targets_cache[cache_key] = targets
+
+            for obj, ttl in targets:
+                key = (obj.redis_key, ttl)
+                uuids = pending.get(key)
+                if uuids is None:
+                    uuids = pending[key] = set()
+                if uuid not in uuids:
+                    uuids.add(uuid)
+                    pending_count += 1
+            event_names.add(event_name)
+            marked += 1
+
+            if pending_count >= batch_size:
+                self._flush_marks(pending, event_names)
+                pending = {}
+                pending_count = 0
+                targets_cache.clear()
+                event_names.clear()
+
+        if pending:
+            self._flush_marks(pending, event_names)
+
+        return marked
+
+    def _map_event_ids(self, events, batch_size):
+        """
+        Yields `events` with their uuids translated by the id mapper,
+        allocating offsets for `batch_size` events at a time.
+        """
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                for mapped in self._map_event_batch(batch):
+                    yield mapped
+                batch = []
+        for mapped in self._map_event_batch(batch):
+            yield mapped
+
+    def _map_event_batch(self, batch):
+        offsets = self.id_mapper.get_offsets([event[1] for event in batch])
+        for event, offset in zip(batch, offsets):
+            yield (event[0], offset) + tuple(event[2:])
+
+    def _flush_marks(self, pending, event_names=(), attribute_names=()):
+        """
+        Writes a `{(redis_key, ttl): uuids}` mapping in a single non-transactional pipeline.
+        """
+        with self.redis_client.pipeline(transaction=False) as p:
+            for event_name in event_names:
+                self._register_name(p, 'ev', event_name)
+            for attribute_name in attribute_names:
+                self._register_name(p, 'at', attribute_name)
+            for (redis_key, ttl), uuids in pending.items():
+                self._queue_setbits(p, redis_key, uuids, 1, ttl)
+                self._queue_version_bump(p, redis_key, ttl)
+            p.execute()
+
+    def _get_event_targets(self, event_name, now, month=True, week=True, day=True, hour=True,
+            month_ttl=None, week_ttl=None, day_ttl=None, hour_ttl=None):
+        """
+        Returns the `(bitmap, ttl)` pairs an event marked at `now` should be written to.
+        """
+        if self.rollup and day:
+            # Weeks and months that are still open are derived from their days
+            utcnow = datetime.utcnow()
+            month = month and (now.year, now.month) != (utcnow.year, utcnow.month)
+            week = week and now.isocalendar()[:2] != utcnow.isocalendar()[:2]
+
+        targets = []
         if month:
-            stat_objs.append((self.get_month_event(event_name, now), month_ttl))
+            targets.append((self._get_stored_month_event(event_name, now), month_ttl))
         if week:
-            stat_objs.append((self.get_week_event(event_name, now), week_ttl))
+            targets.append((self._get_stored_week_event(event_name, now), week_ttl))
         if day:
-            stat_objs.append((self.get_day_event(event_name, now), day_ttl))
+            targets.append((self.get_day_event(event_name, now), day_ttl))
         if hour:
-            stat_objs.append((self.get_hour_event(event_name, now), hour_ttl))
+            targets.append((self.get_hour_event(event_name, now), hour_ttl))
+        return targets
 
-        with self.redis_client.pipeline() as p:
-            p.multi()
-            for obj, ttl in stat_objs:
-                p.setbit(obj.redis_key, uuid, 1)
-                if ttl is not None:
-                    p.expire(obj.redis_key, ttl)
+    def _queue_setbits(self, pipe, redis_key, uuids, value=1, ttl=None):
+        """
+        Queues setting the bits of `uuids` in the bitmap stored under `redis_key`
+        to `value`, expiring it after `ttl` if given.
+        """
+        if not self.segment_size:
+            self._merge_bits(pipe, redis_key, uuids, value)
+            if ttl is not None:
+                pipe.expire(redis_key, ttl)
+            return
+
+        segments = {}
+        for uuid in uuids:
+            segment, offset = divmod(uuid, self.segment_size)
+            segments.setdefault(segment, []).append(offset)
+        if not segments:
+            return
+        for segment, offsets in segments.items():
+            self._merge_bits(pipe, _segment_key(redis_key, self.divider, segment), offsets, value)
+        pipe.sadd(redis_key, *segments)
+        if ttl is not None:
+            for segment in segments:
+                pipe.expire(_segment_key(redis_key, self.divider, segment), ttl)
+            pipe.expire(redis_key, ttl)
+
+    def _merge_bits(self, pipe, redis_key, offsets, value=1):
+        """
+        Queues setting the bits at `offsets` of `redis_key` to `value`, with BITFIELD SET
+        in chunks, or a SETBIT per offset on servers without BITFIELD. Either costs
+        time in the number of offsets, not in the size of the bitmap, and keeps its TTL.
+        """
+        offsets = list(offsets)
+        if len(offsets) > 1 and self._has_bitfield():
+            for chunk in _chunks(offsets, _BITFIELD_CHUNK_SIZE):
+                pipe.execute_command('BITFIELD', redis_key,
+                                     *_bitfield_args('SET', chunk, value))
+            return
+
+        for offset in offsets:
+            pipe.setbit(redis_key, offset, value)
+
+    def _write_bitsets(self, bitsets):
+        """
+        OR-s bitsets built client-side, given as `{redis_key: [(first_byte, data), ...]}`,
+        into the bitmaps stored under their keys, split per segment for segmented
+        bitmaps. The pieces of a bitmap are written with SETRANGE into a scratch key,
+        which one BITOP OR merges into the bitmap, so each bitmap costs a few commands
+        however many bits are set. BITOP drops the TTL of its destination,
+        so TTLs are read first and restored, like in `compact_rollups`.
+        """
+        writes = OrderedDict()
+        for redis_key, pieces in bitsets.items():
+            for first_byte, data in pieces:
+                if not self.segment_size:
+                    writes.setdefault(redis_key, (None, []))[1].append((first_byte, data))
+                    continue
+                segment_bytes = self.segment_size // 8
+                for segment in range(first_byte // segment_bytes,
+                                     (first_byte + len(data) - 1) // segment_bytes + 1):
+                    start = max(segment * segment_bytes - first_byte, 0)
+                    chunk = data[start:(segment + 1) * segment_bytes - first_byte]
+                    if chunk.strip(b'\x00'):
+                        key = _segment_key(redis_key, self.divider, segment)
+                        writes.setdefault(key, ((redis_key, segment), []))[1].append(
+                            (first_byte + start - segment * segment_bytes, chunk))
+
+        with self.redis_client.pipeline(transaction=False) as p:
+            for key in writes:
+                p.pttl(key)
+            ttls = p.execute()
+
+        with self.redis_client.pipeline(transaction=False) as p:
+            for (key, (segment, pieces)), ttl in zip(writes.items(), ttls):
+                self._merge_bitset(p, key, pieces)
+                if ttl is not None and ttl > 0:
+                    p.pexpire(key, ttl)
+                if segment is not None:
+                    p.sadd(*segment)
+            for redis_key in bitsets:
+                self._queue_version_bump(p, redis_key)
             p.execute()
 
+    def _merge_bitset(self, pipe, redis_key, pieces):
+        """
+        Queues OR-ing `pieces`, given as `(first_byte, data)` pairs, into `redis_key`:
+        a SETRANGE per piece into a scratch key, BITOP OR and DEL. BITOP takes time
+        in the length of `redis_key` and drops its TTL.
+        """
+        key_parts = [self.prefix, 'bitop', 'tmp', uuid4().hex]
+        if self.cluster:
+            key_parts.insert(2, '{%s}' % _hash_slot_key(redis_key))
+        scratch_key = self.divider.join(key_parts)
+
+        for first_byte, data in pieces:
+            pipe.setrange(scratch_key, first_byte, data)
+        pipe.bitop('OR', redis_key, redis_key, scratch_key)
+        pipe.delete(scratch_key)
+
+    def _has_bitfield(self):
+        """
+        Returns whether the server supports BITFIELD (Redis 3.2+), asking it once.
+        """
+        if self._supports_bitfield is None:
+            self._supports_bitfield = _server_has_bitfield(
+                self.redis_client, self.divider.join([self.prefix, 'bitfield']))
+        return self._supports_bitfield
+
+    def _queue_version_bump(self, pipe, redis_key, ttl=None):
+        """
+        Records a write to `redis_key` so cached bit operations over it get recomputed,
+        by giving it a new version token that expires after `ttl` if given.
+        """
+        if self.cache_bit_ops:
+            version_key = _version_key(self.prefix, self.divider, redis_key)
+            pipe.set(version_key, _version_token())
+            if ttl is not None:
+                pipe.expire(version_key, ttl)
+
+    @_instrumented
     def mark_attribute_multi(self, attribute_name, uuids, mark_as=1):
         if mark_as not in (0, 1):
             raise ValueError('Can only mark bitmaps with 0 or 1')
 
+        if self.id_mapper is not None:
+            uuids = self.id_mapper.get_offsets(uuids)
+
         obj = self.get_attribute(attribute_name)
-        with self.redis_client.pipeline(transaction=False) as p:
-            p.multi()
-            for _id in uuids:
-                p.setbit(obj.redis_key, _id, mark_as)
+        with self.redis_client.pipeline(transaction=not self.cluster) as p:
+            self._queue_setbits(p, obj.redis_key, uuids, mark_as)
+            self._queue_version_bump(p, obj.redis_key)
+            self._register_name(p, 'at', attribute_name)
             p.execute()
 
+    @_instrumented
     def mark_attribute(self, attribute_name, uuid, mark_as=1):
         """
         Marks an attribute that is not time specific.
@@ -205,159 +630,558 @@ class Bitmapist(object):
         if type(uuid) is list:
             return self.mark_attribute_multi(attribute_name, uuid, mark_as)
 
+        if self.id_mapper is not None:
+            uuid = self.id_mapper.get_offset(uuid)
+
         obj = self.get_attribute(attribute_name)
-        self.redis_client.setbit(obj.redis_key, uuid, mark_as)
+        if (not self.cache_bit_ops and not self.segment_size
+                and not self._needs_registering('at', attribute_name)):
+            self.redis_client.setbit(obj.redis_key, uuid, mark_as)
+            return
+
+        with self.redis_client.pipeline(transaction=not self.cluster) as p:
+            self._queue_setbits(p, obj.redis_key, [uuid], mark_as)
+            self._queue_version_bump(p, obj.redis_key)
+            self._register_name(p, 'at', attribute_name)
+            p.execute()
+
+    #--- Rollups ----------------------------------------------
+    @_instrumented
+    def compact_rollups(self, now, event_names=None):
+        """
+        Materializes the week and month containing `now` by OR-ing their day
+        bitmaps into the stored week and month bitmaps. Periods that have ended are
+        sealed, after which reads use the stored bitmap directly and the day
+        bitmaps may expire. Meant to run periodically, e.g. hourly for
+        the current day and once for yesterday after midnight.
+        Stored bitmaps keep the TTL they had.
+
+        :param :now A moment in the week and month to compact
+        :param :event_names The events to compact, defaults to every event name listed
+                            by `get_all_event_names`
 
+        Example::
+
+            bm.compact_rollups(datetime.utcnow() - timedelta(days=1))
+        """
+        if event_names is None:
+            event_names = self.get_all_event_names()
+
+        today = datetime.utcnow().date()
+        periods = [(self._get_stored_month_event, _month_days(now)),
+                   (self._get_stored_week_event, _week_days(now))]
+        targets = [(get_stored(event_name, now), event_name, days)
+                   for event_name in event_names for get_stored, days in periods]
+
+        # BITOP and SET drop the TTL of their destination, read it to restore it
+        with self.redis_client.pipeline(transaction=False) as p:
+            for stored, _, _ in targets:
+                p.pttl(stored.redis_key)
+            ttls = p.execute()
+
+        sealed = []
+        with self.redis_client.pipeline(transaction=False) as p:
+            for (stored, event_name, days), ttl in zip(targets, ttls):
+                day_keys = [self.get_day_event(event_name, d).redis_key for d in days]
+                if self.cluster and not _same_slot([stored.redis_key] + day_keys):
+                    rolled_up = reduce(operator.or_, _fetch_all(self.redis_client,
+                                                                [stored.redis_key] + day_keys))
+                    if rolled_up.data:
+                        p.set(stored.redis_key, bytes(rolled_up.data))
+                else:
+                    p.bitop('OR', stored.redis_key, stored.redis_key, *day_keys)
+                if ttl is not None and ttl > 0:
+                    p.pexpire(stored.redis_key, ttl)
+                self._queue_version_bump(p, stored.redis_key)
+                if days[-1] < today:
+                    p.sadd(self._sealed_key, stored.redis_key)
+                    sealed.append(stored.redis_key)
+            p.execute()
+
+        self._sealed_keys.update(sealed)
+
+    def _get_rollup(self, event_name, stored, days):
+        """
+        Returns the stored bitmap of a sealed period, otherwise
+        a lazy OR of the stored bitmap and the bitmaps of its days.
+        """
+        if self._is_sealed(stored.redis_key, days[-1]):
+            return stored
+        return self.bit_op_or(stored, *[self.get_day_event(event_name, d) for d in days])
+
+    def _is_sealed(self, redis_key, last_day):
+        if redis_key in self._sealed_keys:
+            return True
+        if last_day >= datetime.utcnow().date():
+            return False
+        if self.redis_client.sismember(self._sealed_key, redis_key):
+            self._sealed_keys.add(redis_key)
+            return True
+        return False
+
+    #--- Name registry ----------------------------------------------
+    @_instrumented
+    def rebuild_name_registry(self):
+        """
+        Records every event and attribute name found by scanning the keyspace
+        in the name registry, e.g. for data marked before it was enabled,
+        then marks the registry complete so names are listed from it.
+        Every process marking events should have the registry enabled by then.
+        """
+        for kind, names in (('ev', self._scan_event_names()),
+                            ('at', self._scan_attribute_names())):
+            with self.redis_client.pipeline(transaction=False) as p:
+                for name in names:
+                    p.execute_command('ZADD', self._registry_key(kind), int(time.time()), name)
+                p.set(self._registry_complete_key(kind), 1)
+                p.execute()
+
+    @_instrumented
+    def prune_name_registry(self, max_age):
+        """
+        Removes the names that have not been marked in the last `max_age` seconds
+        from the name registry and returns how many were removed. Names are
+        recorded again when they are marked. `max_age` should exceed
+        `registry_refresh` and how long bitmaps are kept, or names that still
+        have bitmaps are no longer listed.
+        """
+        cutoff = int(time.time() - max_age)
+        with self.redis_client.pipeline(transaction=False) as p:
+            for kind in ('ev', 'at'):
+                p.zremrangebyscore(self._registry_key(kind), '-inf', '(%d' % cutoff)
+            return sum(p.execute())
+
+    def _registry_key(self, kind):
+        return self.divider.join([self.prefix, 'names', kind])
+
+    def _registry_complete_key(self, kind):
+        return self.divider.join([self.prefix, 'names', kind, 'complete'])
+
+    def _needs_registering(self, kind, name):
+        if not self.name_registry:
+            return False
+        last_seen = self._registered_names[kind].get(name)
+        return last_seen is None or time.time() - last_seen >= self.registry_refresh
+
+    def _register_name(self, client, kind, name):
+        """
+        Records `name` as an event (`kind` is "ev") or attribute ("at") name seen now,
+        unless this process did so within the last `registry_refresh` seconds.
+        `client` can be a pipeline, in which case the write is only queued.
+        """
+        if self._needs_registering(kind, name):
+            now = time.time()
+            client.execute_command('ZADD', self._registry_key(kind), int(now), name)
+            self._registered_names[kind][name] = now
+
+    def _forget_names(self, *kinds):
+        """
+        Deletes the registries of the given kinds and returns how many existed.
+        Only this process forgets which names it has recorded, others
+        record their names again after `registry_refresh` seconds, so names
+        are scanned for again until the registries are rebuilt.
+        """
+        for kind in kinds:
+            self._registered_names[kind].clear()
+        self.redis_client.delete(*[self._registry_complete_key(kind) for kind in kinds])
+        return self.redis_client.delete(*[self._registry_key(kind) for kind in kinds])
+
+    def _get_registered_names(self, kind):
+        """
+        Returns the names in the registry of `kind`, or `None` if it
+        is not complete and names have to be scanned for.
+        """
+        with self.redis_client.pipeline(transaction=False) as p:
+            p.exists(self._registry_complete_key(kind))
+            p.zrange(self._registry_key(kind), 0, -1)
+            complete, names = p.execute()
+        return [_to_str(name) for name in names] if complete else None
+
+    @_instrumented
     def get_all_event_names(self):
         """
         Returns all event names based on keys in the system,
         assuming they were generated by this bitmapist configuration
         """
-        client = self.redis_client
-        keys = client.keys('{0}{1}ev{1}*'.format(self.prefix, self.divider))
-        event_names = set([])
-        # Assumes all events create a WeekEvent
-        event_re = re.compile(
-            r'{0}ev{0}(.*){0}W\d+-\d+'.format(self.divider))
-        for key in keys:
-            match = event_re.search(key)
-            if match:
-                event_names.add(match.groups()[0])
-        return event_names
+        return set(self.iter_event_names())
+
+    def iter_event_names(self):
+        """
+        Yields every event name once. Names are read from the name registry
+        once `rebuild_name_registry` has completed it, or discovered with
+        an incremental SCAN, so Redis is never blocked walking the whole keyspace.
+        """
+        if self.name_registry:
+            names = self._get_registered_names('ev')
+            if names is not None:
+                return iter(names)
+        return self._scan_event_names()
+
+    def _scan_event_names(self):
+        # Assumes all events create a WeekEvent, or a DayEvent in rollup mode
+        if self.rollup:
+            event_re = re.compile(
+                r'{0}ev{0}(.*){0}(?:W\d+-\d+|\d+-\d+-\d+)(?:{0}|$)'.format(self.divider))
+        else:
+            event_re = re.compile(
+                r'{0}ev{0}(.*){0}W\d+-\d+'.format(self.divider))
+        return self._iter_names('{0}{1}ev{1}*'.format(self.prefix, self.divider), event_re)
 
+    @_instrumented
     def get_all_attribute_names(self):
         """
         Returns all attribute names assuming based on keys in the system,
         assuming they were generated by bitmapist
         """
-        client = self.redis_client
-        keys = client.keys('{0}{1}at{1}*'.format(self.prefix, self.divider))
-        attr_names = set([])
-        thing = re.compile(r'{0}at{0}(.*)'.format(self.divider))
-        for key in keys:
-            match = thing.search(key)
-            if match:
-                attr_names.add(match.groups()[0])
-        return attr_names
+        return set(self.iter_attribute_names())
 
-    def delete_all(self):
+    def iter_attribute_names(self):
         """
-        Delete all bitmap keys from the database.
+        Yields every attribute name once, read from the complete name registry
+        or discovered with an incremental SCAN.
         """
-        cli = self.redis_client
-        keys = cli.keys('%s%s*' % (self.prefix, self.divider))
-        if len(keys) > 0:
-            cli.delete(*keys)
+        if self.name_registry:
+            names = self._get_registered_names('at')
+            if names is not None:
+                return iter(names)
+        return self._scan_attribute_names()
+
+    def _scan_attribute_names(self):
+        thing = re.compile(r'{0}at{0}(.*)'.format(self.divider))
+        return self._iter_names('{0}{1}at{1}*'.format(self.prefix, self.divider), thing)
+
+    def _iter_names(self, pattern, name_re):
+        segment_re = None
+        if self.segment_size:
+            segment_re = re.compile(r'{0}s{0}\d+$'.format(re.escape(self.divider)))
+
+        seen = set()
+        for key in self._scan_keys(pattern):
+            key = _to_str(key)
+            match = name_re.search(key)
+            if not match or (segment_re and segment_re.search(key)):
+                continue
+            name = match.groups()[0]
+            if self.hash_tag == 'event':
+                name = name[1:-1]
+            if name not in seen:
+                seen.add(name)
+                yield name
+
+    @_instrumented
+    def delete_all(self, batch_size=None, max_keys_per_second=None):
+        """
+        Delete all bitmap keys from the database.
 
-    def delete_all_events(self):
+        Like the other delete methods, keys are found with an incremental SCAN
+        and removed with UNLINK in batches of `batch_size` keys, at most
+        `max_keys_per_second` a second if given. Returns the number of deleted keys.
+        """
+        deleted = self._forget_names('ev', 'at')
+        self._sealed_keys.clear()
+        if self.id_mapper is not None:
+            self.id_mapper.clear_cache()
+        return deleted + self._delete_keys('%s%s*' % (self.prefix, self.divider),
+                                           batch_size, max_keys_per_second)
+
+    @_instrumented
+    def delete_all_events(self, batch_size=None, max_keys_per_second=None):
         """
         Delete all events from the database.
         """
-        cli = self.redis_client
-        keys = cli.keys('%s%sev%s*' % (self.prefix, self.divider, self.divider))
-        if len(keys) > 0:
-            cli.delete(*keys)
-
-    def delete_all_attributes(self):
+        deleted = self._forget_names('ev')
+        self._sealed_keys.clear()
+        deleted += self.redis_client.delete(self._sealed_key)
+        return deleted + self._delete_keys('%s%sev%s*' % (self.prefix, self.divider, self.divider),
+                                           batch_size, max_keys_per_second)
+
+    @_instrumented
+    def delete_all_attributes(self, batch_size=None, max_keys_per_second=None):
         """
         Delete all attributes from the database.
         """
-        cli = self.redis_client
-        keys = cli.keys('%s%sat%s*' % (self.prefix, self.divider, self.divider))
-        if len(keys) > 0:
-            cli.delete(*keys)
+        deleted = self._forget_names('at')
+        return deleted + self._delete_keys('%s%sat%s*' % (self.prefix, self.divider, self.divider),
+                                           batch_size, max_keys_per_second)
 
-    def delete_temporary_bitop_keys(self):
+    @_instrumented
+    def delete_temporary_bitop_keys(self, batch_size=None, max_keys_per_second=None):
         """
         Delete all temporary keys that are used when using bit operations.
         """
-        cli = self.redis_client
-        keys = cli.keys('%s%sbitop%s*' % (self.prefix, self.divider, self.divider))
-        if len(keys) > 0:
-            cli.delete(*keys)
+        return self._delete_keys('%s%sbitop%s*' % (self.prefix, self.divider, self.divider),
+                                 batch_size, max_keys_per_second)
+
+    def _scan_keys(self, pattern):
+        return self.redis_client.scan_iter(match=pattern, count=self.scan_count)
+
+    def _delete_keys(self, pattern, batch_size=None, max_keys_per_second=None):
+        """
+        Unlinks every key matching `pattern` in batches, sleeping between
+        batches as needed to stay under `max_keys_per_second`.
+        """
+        batch_size = batch_size or self.scan_count
+        started = time.time()
+        deleted = 0
+
+        batch = []
+        for key in self._scan_keys(pattern):
+            batch.append(key)
+            if len(batch) < batch_size:
+                continue
+
+            deleted += self._unlink(batch)
+            batch = []
+
+            if max_keys_per_second:
+                ahead = float(deleted) / max_keys_per_second - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        if batch:
+            deleted += self._unlink(batch)
+        return deleted
+
+    def _unlink(self, keys):
+        """
+        Deletes `keys` with UNLINK, so their memory is reclaimed in the background,
+        falling back to DEL on Redis versions older than 4.0. Returns how many
+        keys the server deleted.
+        """
+        # SCAN may return a key more than once
+        keys = list(set(keys))
+        if self._supports_unlink:
+            try:
+                if self.cluster:
+                    # The cluster client splits the keys by slot
+                    return self.redis_client.unlink(*keys)
+                return self.redis_client.execute_command('UNLINK', *keys)
+            except ResponseError as e:
+                if 'unknown command' not in str(e).lower():
+                    raise
+                self._supports_unlink = False
+        return self.redis_client.delete(*keys)
+
+
+class BufferedBitmapist(Bitmapist):
+    """
+    A `Bitmapist` that buffers marks in memory instead of writing them right away.
+    Marks are deduplicated per target key and flushed together, dense ones
+    merged as bitsets, once `max_marks` distinct bits are buffered or the oldest
+    buffered mark is `max_delay` seconds old. Both are checked as marks come in,
+    so producers that go idle should call `flush` periodically.
+
+    Buffered marks are not visible to queries until they are flushed.
+    Unmarking an attribute flushes the buffer and is written right away.
+    Call `close`, or use the instance as a context manager, to flush on shutdown.
+
+    Example::
+
+        with BufferedBitmapist(redis.Redis('localhost', 6379), max_marks=50000) as bm:
+            for user_id in stream:
+                bm.mark_event('active', user_id)
+    """
+
+    def __init__(self, redis_client, max_marks=10000, max_delay=5.0, **options):
+        """
+        :param :max_marks How many distinct bits to buffer before flushing
+        :param :max_delay How many seconds a mark may stay buffered, `None` for no limit
+        :param :options Passed on to `Bitmapist`
+        """
+        Bitmapist.__init__(self, redis_client, **options)
+        self.max_marks = max_marks
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._reset_buffer()
+
+    @_instrumented
+    def mark_event(self, event_name, uuid, now=None, month=True, week=True, day=True, hour=True,
+            month_ttl=None, week_ttl=None, day_ttl=None, hour_ttl=None):
+        """
+        Buffers an event mark. Takes the same arguments as `Bitmapist.mark_event`.
+        """
+        if not now:
+            now = datetime.utcnow()
+
+        if self.id_mapper is not None:
+            uuid = self.id_mapper.get_offset(uuid)
+
+        targets = self._get_event_targets(event_name, now, month, week, day, hour,
+                                          month_ttl, week_ttl, day_ttl, hour_ttl)
+        with self._lock:
+            for obj, ttl in targets:
+                self._buffer(obj.redis_key, ttl, [uuid])
+            self._buffered_names['ev'].add(event_name)
+            due = self._is_due()
+        if due:
+            self.flush()
+
+    @_instrumented
+    def mark_attribute_multi(self, attribute_name, uuids, mark_as=1):
+        if mark_as != 1:
+            self.flush()
+            return Bitmapist.mark_attribute_multi(self, attribute_name, uuids, mark_as)
+
+        if self.id_mapper is not None:
+            uuids = self.id_mapper.get_offsets(uuids)
+
+        obj = self.get_attribute(attribute_name)
+        with self._lock:
+            self._buffer(obj.redis_key, None, uuids)
+            self._buffered_names['at'].add(attribute_name)
+            due = self._is_due()
+        if due:
+            self.flush()
+
+    @_instrumented
+    def mark_attribute(self, attribute_name, uuid, mark_as=1):
+        """
+        Buffers an attribute mark. Takes the same arguments as `Bitmapist.mark_attribute`.
+        """
+        if type(uuid) is not list:
+            uuid = [uuid]
+        return self.mark_attribute_multi(attribute_name, uuid, mark_as)
+
+    @_instrumented
+    def flush(self):
+        """
+        Writes every buffered mark in one pipeline and returns how many bits were written.
+        If the write fails, the marks are buffered again before the error is raised.
+        """
+        with self._lock:
+            pending, names, since = self._pending, self._buffered_names, self._buffered_since
+            count = self._pending_count
+            self._reset_buffer()
+
+        if pending:
+            try:
+                self._flush_marks(pending, names['ev'], names['at'])
+            except Exception:
+                with self._lock:
+                    self._rebuffer(pending, names, since)
+                raise
+        return count
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _buffer(self, redis_key, ttl, uuids):
+        buffered = self._pending.get((redis_key, ttl))
+        if buffered is None:
+            buffered = self._pending[(redis_key, ttl)] = set()
+        for uuid in uuids:
+            if uuid not in buffered:
+                buffered.add(uuid)
+                self._pending_count += 1
+        if self._buffered_since is None:
+            self._buffered_since = time.time()
+
+    def _rebuffer(self, pending, names, since):
+        """
+        Puts back marks taken out of the buffer by a flush that failed.
+        """
+        for (redis_key, ttl), uuids in pending.items():
+            self._buffer(redis_key, ttl, uuids)
+        for kind, kind_names in names.items():
+            self._buffered_names[kind].update(kind_names)
+        self._buffered_since = min(self._buffered_since, since)
+
+    def _is_due(self):
+        if self._pending_count >= self.max_marks:
+            return True
+        return (self.max_delay is not None and self._buffered_since is not None
+                and time.time() - self._buffered_since >= self.max_delay)
+
+    def _reset_buffer(self):
+        self._pending = {}
+        self._buffered_names = {'ev': set(), 'at': set()}
+        self._pending_count = 0
+        self._buffered_since = None
 
 
 #--- Events ----------------------------------------------
-class MixinMarked:
+class MixinMarked(object):
     """
     Extends with an obj.has_events_marked()
     that returns `True` if there are any events marked,
     otherwise `False` is returned.
     """
+    @_instrumented
     def has_events_marked(self):
-        cli = self.redis_client
-        return cli.get(self.redis_key) != None
+        exists, = self._execute(lambda p: p.exists(self.redis_key))
+        return bool(exists)
 
 
-class MixinCounts:
+class MixinCounts(object):
     """
     Extends with an obj.get_count() that uses BITCOUNT to
     count all the events. Supports also __len__
     """
 
-    ERROR = 'error'
-
+    @_instrumented
     def get_count(self, start_bit=None, end_bit=None):
         """
         Redis bitcount command start/end paramaters use Byte units
         whereas setbit operations are on a bit basis
         We can either approximate or use this hack to determine exact count
 
+        The partial bytes at the edges of the range are fetched with GETRANGE and
+        counted locally, in the same pipeline as the BITCOUNT of the bytes in between.
+        Negative bits count from the end of the bitmap and cost an extra STRLEN.
+
         :param :start_bit Starting bit, inclusive
         :param :end_bit Ending bit, inclusive
         """
-        # TODO: deal with errors in what is passed in
-
-        cli = self.redis_client
-        if not start_bit and not end_bit:
-            return cli.bitcount(self.redis_key)
-
-        start_byte = self._convert_to_start_byte(start_bit)   # First byte that is entirely
-                                                              # in the range of bits specified
-        end_byte = self._convert_to_end_byte(end_bit)         # Last byte that is entirely
-                                                              # in the range of bits specified
-        total_bits = 0
-
-        # TODO: pipeline this
-        if start_byte != self.ERROR and end_byte != self.ERROR:
-
-            # Bits before the start_byte
-            bit_floor = start_byte * 8
-            for offset in xrange(start_bit, bit_floor, (start_bit >= 0 and 1 or -1)):
-                total_bits += cli.getbit(self.redis_key, offset)
-
-            # Bits that fall inside the bytes
-            total_bits += cli.bitcount(self.redis_key, start=start_byte, end=end_byte)
-
-            # Bits after end_byte
-            bit_ceiling = (end_byte + 1) * 8
-            for offset in xrange(bit_ceiling, end_bit + 1, (bit_ceiling >= 0 and 1 or -1)):
-                total_bits += cli.getbit(self.redis_key, offset)
-        else:
-            for offset in xrange(start_bit, end_bit + 1):
-                total_bits += cli.getbit(self.redis_key, offset)
-
-        return total_bits
-
-    def _convert_to_start_byte(self, bit):
-        if -7 <= bit < 0:
-            return self.ERROR
-        else:
-            return (bit + 7) / 8
-
-    def _convert_to_end_byte(self, bit):
-        if bit < 0:
-            return (bit + 1) / 8 - 1
-        elif bit < 7:
-            return self.ERROR
-        else:
-            return (bit - 7) / 8
+        if self.segment_size:
+            return self._get_segmented_count(start_bit, end_bit)
+
+        steps = _count_bit_range(self.redis_key, start_bit, end_bit)
+        step = next(steps)
+        while callable(step):
+            step = steps.send(self._execute(step))
+        return step
+
+    def _get_segmented_count(self, start_bit, end_bit):
+        segments = self._get_segments()
+        if start_bit is None and end_bit is None:
+            counts = self._execute(
+                lambda p: [p.bitcount(self._segment_key(segment)) for segment in segments])
+            return sum(counts)
+
+        start_bit = start_bit or 0
+        end_bit = -1 if end_bit is None else end_bit
+
+        if start_bit < 0 or end_bit < 0:
+            length = 0
+            if segments:
+                last_length, = self._execute(lambda p: p.strlen(self._segment_key(segments[-1])))
+                length = segments[-1] * self.segment_size + last_length * 8
+            if start_bit < 0:
+                start_bit = max(start_bit + length, 0)
+            if end_bit < 0:
+                end_bit += length
+
+        count = 0
+        for segment in segments:
+            first_bit = segment * self.segment_size
+            last_bit = first_bit + self.segment_size - 1
+            if last_bit < start_bit or first_bit > end_bit:
+                continue
+            count += Bitmap(self._segment_key(segment), self.redis_client).get_count(
+                max(start_bit, first_bit) - first_bit, min(end_bit, last_bit) - first_bit)
+        return count
 
     def __len__(self):
         return self.get_count()
 
 
-class MixinContains:
+class MixinContains(object):
     """
     Makes it possible to see if an uuid has been marked.
 
@@ -365,18 +1189,231 @@ class MixinContains:
 
        user_active_today = 123 in DayEvents('active', 2012, 10, 23)
     """
+    @_instrumented
     def __contains__(self, uuid):
-        cli = self.redis_client
-        if cli.getbit(self.redis_key, uuid):
+        if self.id_mapper is not None:
+            uuid = self.id_mapper.lookup_offset(uuid)
+            if uuid is None:
+                return False
+
+        key = self.redis_key
+        if self.segment_size:
+            segment, uuid = divmod(uuid, self.segment_size)
+            key = self._segment_key(segment)
+
+        value, = self._execute(lambda p: p.getbit(key, uuid))
+        if value:
             return True
         else:
             return False
 
+    @_instrumented
+    def contains_many(self, uuids):
+        """
+        Returns whether each of `uuids` has been marked, as a list of booleans.
+        Offsets in the same key are read with BITFIELD GET, many per command,
+        falling back to a GETBIT each on Redis versions older than 3.2.
+
+        Example::
+
+            paid = bm.get_attribute('paid_user').contains_many(user_ids)
+        """
+        uuids = list(uuids)
+        if self.id_mapper is not None:
+            uuids = self.id_mapper.lookup_offsets(uuids)
+
+        by_key = {}
+        for i, uuid in enumerate(uuids):
+            if uuid is None or uuid < 0:
+                continue
+            key = self.redis_key
+            if self.segment_size:
+                segment, uuid = divmod(uuid, self.segment_size)
+                key = self._segment_key(segment)
+            by_key.setdefault(key, []).append((i, uuid))
+
+        requests = []
+        for key, positions in by_key.items():
+            requests.extend((key, chunk) for chunk in _chunks(positions, _BITFIELD_CHUNK_SIZE))
+
+        def queue_bitfields(p):
+            for key, chunk in requests:
+                p.execute_command('BITFIELD', key,
+                                  *_bitfield_args('GET', [uuid for _, uuid in chunk]))
+
+        def queue_getbits(p):
+            for key, chunk in requests:
+                for _, uuid in chunk:
+                    p.getbit(key, uuid)
+
+        found = [False] * len(uuids)
+        if not requests:
+            return found
+
+        if not _server_has_bitfield(self.redis_client, requests[0][0]):
+            replies = self._execute(queue_getbits)
+            positions = [i for _, chunk in requests for i, _ in chunk]
+            for i, value in zip(positions, replies):
+                found[i] = bool(value)
+            return found
+
+        replies = self._execute(queue_bitfields)
+        for (_, chunk), values in zip(requests, replies):
+            for (i, _), value in zip(chunk, values):
+                found[i] = bool(value)
+        return found
+
+
+class Bitmap(MixinCounts, MixinContains, MixinMarked):
+    """
+    A bitmap stored under `redis_key`.
 
-class Bitmap(object, MixinCounts, MixinContains, MixinMarked):
-    def __init__(self, redis_key, redis_client):
+    When an `id_mapper` is given, membership checks and `iter_ids` translate
+    between uuids and bitmap offsets. Counted ranges and fetched bitmaps
+    are in offset space.
+
+    When `segment_size` is given the bitmap is split into segments of that many
+    bits, see `Bitmapist`. `redis_key` then holds the set of segment numbers.
+    """
+
+    id_mapper = None
+    segment_size = None
+
+    def __init__(self, redis_key, redis_client, id_mapper=None, segment_size=None, divider=':'):
         self.redis_client = redis_client
         self.redis_key = redis_key
+        self.id_mapper = id_mapper
+        self.segment_size = segment_size
+        self.divider = divider
+
+    def _execute(self, queue_commands):
+        """
+        Runs the commands queued by `queue_commands(pipe)` in one round trip
+        and returns their replies.
+        """
+        with self.redis_client.pipeline(transaction=False) as p:
+            queue_commands(p)
+            return p.execute()
+
+    def _materialize(self):
+        """
+        Makes sure `redis_key` holds the bitmap. A no-op for stored bitmaps.
+        """
+
+    def _segment_key(self, segment):
+        return _segment_key(self.redis_key, self.divider, segment)
+
+    def _get_segments(self):
+        """
+        Returns the numbers of the segments that exist, in ascending order.
+        """
+        members, = self._execute(lambda p: p.smembers(self.redis_key))
+        return sorted(int(member) for member in members)
+
+    def _iter_segments(self, start, end):
+        """
+        Yields `(first_bit, bitmap)` for the existing segments that overlap
+        the bits from `start` to `end`, inclusive.
+        """
+        for segment in self._get_segments():
+            first_bit = segment * self.segment_size
+            if first_bit + self.segment_size <= start:
+                continue
+            if end is not None and first_bit > end:
+                return
+            yield first_bit, Bitmap(self._segment_key(segment), self.redis_client)
+
+    @_instrumented
+    def fetch(self, chunk_size=1024 * 1024):
+        """
+        Downloads the bitmap into a `LocalBitmap`, `chunk_size` bytes per GETRANGE,
+        so no single command has to return a huge string.
+
+        Example::
+
+            active = bm.get_month_event('active', now).fetch()
+            paid = bm.get_attribute('paid_user').fetch()
+            print len(active & paid)
+        """
+        if self.segment_size:
+            data = bytearray()
+            for first_bit, segment in self._iter_segments(0, None):
+                data.extend(bytearray(first_bit // 8 - len(data)))
+                data.extend(segment.fetch(chunk_size).data)
+            return LocalBitmap(data)
+
+        chunks = []
+        offset = 0
+        while True:
+            chunk, = self._execute(
+                lambda p: p.getrange(self.redis_key, offset, offset + chunk_size - 1))
+            chunks.append(chunk)
+            if len(chunk) < chunk_size:
+                break
+            offset += chunk_size
+        return LocalBitmap(b''.join(chunks))
+
+    def iter_ids(self, start=None, end=None, chunk_size=64 * 1024):
+        """
+        Yields the marked uuids in ascending order, downloading the bitmap
+        `chunk_size` bytes at a time, so memory use stays bounded.
+
+        :param :start First uuid to consider, inclusive. Defaults to 0
+        :param :end Last uuid to consider, inclusive. Defaults to the end of the bitmap
+
+        With an `id_mapper`, `start` and `end` are offsets and the offsets
+        found are translated back to uuids in batches.
+
+        Example::
+
+            for uuid in bm.get_month_event('active', now).iter_ids():
+                export(uuid)
+        """
+        offsets = self._iter_offsets(start, end, chunk_size)
+        if self.id_mapper is None:
+            return offsets
+        return self.id_mapper.iter_ids(offsets)
+
+    def _iter_offsets(self, start, end, chunk_size):
+        start = start or 0
+        if self.segment_size:
+            return self._iter_segmented_offsets(start, end, chunk_size)
+        return self._iter_stored_offsets(start, end, chunk_size)
+
+    def _iter_segmented_offsets(self, start, end, chunk_size):
+        for first_bit, segment in self._iter_segments(start, end):
+            segment_end = first_bit + self.segment_size - 1
+            if end is not None:
+                segment_end = min(segment_end, end)
+            for uuid in segment._iter_offsets(max(start - first_bit, 0), segment_end - first_bit,
+                                              chunk_size):
+                yield first_bit + uuid
+
+    def _iter_stored_offsets(self, start, end, chunk_size):
+        offset = start // 8
+        last_byte = None if end is None else end // 8
+
+        while last_byte is None or offset <= last_byte:
+            length = chunk_size
+            if last_byte is not None:
+                length = min(length, last_byte - offset + 1)
+
+            chunk, = self._execute(
+                lambda p: p.getrange(self.redis_key, offset, offset + length - 1))
+
+            for uuid in _iter_set_bits(chunk, offset * 8):
+                if uuid < start:
+                    continue
+                if end is not None and uuid > end:
+                    return
+                yield uuid
+
+            if len(chunk) < length:
+                return
+            offset += length
+
+    def __iter__(self):
+        return self.iter_ids()
 
 
 class MonthEvents(Bitmap):
@@ -387,10 +1424,11 @@ class MonthEvents(Bitmap):
 
         MonthEvents('active', 2012, 10)
     """
-    def __init__(self, event_name, year, month, prefix, divider, redis_client):
+    def __init__(self, event_name, year, month, prefix, divider, redis_client, **options):
+        hash_tag = options.pop('hash_tag', None)
         super(MonthEvents, self).__init__(
-            _prefix_key(event_name, prefix, divider, '%s-%s' % (year, month)),
-            redis_client)
+            _prefix_key(event_name, prefix, divider, '%s-%s' % (year, month), hash_tag, (year, month)),
+            redis_client, divider=divider, **options)
 
 
 class WeekEvents(Bitmap):
@@ -401,10 +1439,13 @@ class WeekEvents(Bitmap):
 
         WeekEvents('active', 2012, 48)
     """
-    def __init__(self, event_name, year, week, prefix, divider, redis_client):
+    def __init__(self, event_name, year, week, prefix, divider, redis_client, **options):
+        hash_tag = options.pop('hash_tag', None)
+        monday = _iso_week_start(year, week)
         super(WeekEvents, self).__init__(
-            _prefix_key(event_name, prefix, divider, 'W%s-%s' % (year, week)),
-            redis_client)
+            _prefix_key(event_name, prefix, divider, 'W%s-%s' % (year, week), hash_tag,
+                        (monday.year, monday.month)),
+            redis_client, divider=divider, **options)
 
 
 class DayEvents(Bitmap):
@@ -415,10 +1456,12 @@ class DayEvents(Bitmap):
 
         DayEvents('active', 2012, 10, 23)
     """
-    def __init__(self, event_name, year, month, day, prefix, divider, redis_client):
+    def __init__(self, event_name, year, month, day, prefix, divider, redis_client, **options):
+        hash_tag = options.pop('hash_tag', None)
         super(DayEvents, self).__init__(
-            _prefix_key(event_name, prefix, divider, '%s-%s-%s' % (year, month, day)),
-            redis_client)
+            _prefix_key(event_name, prefix, divider, '%s-%s-%s' % (year, month, day), hash_tag,
+                        (year, month)),
+            redis_client, divider=divider, **options)
 
 
 class HourEvents(Bitmap):
@@ -429,10 +1472,12 @@ class HourEvents(Bitmap):
 
         HourEvents('active', 2012, 10, 23, 13)
     """
-    def __init__(self, event_name, year, month, day, hour, prefix, divider, redis_client):
+    def __init__(self, event_name, year, month, day, hour, prefix, divider, redis_client, **options):
+        hash_tag = options.pop('hash_tag', None)
         super(HourEvents, self).__init__(
-            _prefix_key(event_name, prefix, divider, '%s-%s-%s-%s' % (year, month, day, hour)),
-            redis_client)
+            _prefix_key(event_name, prefix, divider, '%s-%s-%s-%s' % (year, month, day, hour),
+                        hash_tag, (year, month)),
+            redis_client, divider=divider, **options)
 
 
 class Attributes(Bitmap):
@@ -443,10 +1488,244 @@ class Attributes(Bitmap):
 
         Attributes('paid_user')
     """
-    def __init__(self, attribute_name, prefix, divider, redis_client):
+    def __init__(self, attribute_name, prefix, divider, redis_client, **options):
+        hash_tag = options.pop('hash_tag', None)
         super(Attributes, self).__init__(
-            _prefix_key(attribute_name, prefix, divider),
-            redis_client)
+            _prefix_key(attribute_name, prefix, divider, hash_tag=hash_tag),
+            redis_client, divider=divider, **options)
+
+
+#--- Id mapping ----------------------------------------------
+class IdMapper(object):
+    """
+    Translates arbitrary ids, e.g. 64-bit ints or UUID strings, into dense
+    sequential bitmap offsets, so sparse ids do not blow up bitmap memory.
+
+    Offsets are allocated atomically by a Lua script and stored in two hashes,
+    `{prefix}{divider}ids{divider}fwd` (id to offset) and `...{divider}rev`
+    (offset to id). Recently used translations are kept in a local LRU cache.
+
+    Example::
+
+        mapper = IdMapper(redis_client)
+        bm = Bitmapist(redis_client, id_mapper=mapper)
+
+        bm.mark_event('active', 7239810239812734)
+        assert 7239810239812734 in bm.get_day_event('active', now)
+    """
+
+    def __init__(self, redis_client, prefix='trackist', divider=':', cache_size=100000,
+                 batch_size=10000, id_type=None):
+        """
+        :param :cache_size How many translations to keep in memory
+        :param :batch_size How many ids to allocate per script call
+        :param :id_type A callable applied to ids read back from Redis, e.g. `int`
+        """
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+        self.id_type = id_type
+        self.forward_key = divider.join([prefix, 'ids', 'fwd'])
+        self.reverse_key = divider.join([prefix, 'ids', 'rev'])
+        self.counter_key = divider.join([prefix, 'ids', 'seq'])
+
+        self._offsets = _LRUCache(cache_size)
+        self._ids = _LRUCache(cache_size)
+        self._allocate_script = redis_client.register_script(_ALLOCATE_IDS_SCRIPT)
+
+    def get_offset(self, uuid):
+        """
+        Returns the offset of `uuid`, allocating one if it has none yet.
+        """
+        return self.get_offsets([uuid])[0]
+
+    def get_offsets(self, uuids):
+        """
+        Returns the offsets of `uuids`, allocating the missing ones in batches.
+        """
+        uuids = [str(uuid) for uuid in uuids]
+
+        found = {}
+        for uuid in set(uuids):
+            offset = self._offsets.get(uuid)
+            if offset is not None:
+                found[uuid] = offset
+        missing = [uuid for uuid in set(uuids) if uuid not in found]
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            offsets = self._allocate_script(
+                keys=[self.forward_key, self.reverse_key, self.counter_key], args=batch)
+            for uuid, offset in zip(batch, offsets):
+                found[uuid] = int(offset)
+                self._remember(uuid, found[uuid])
+
+        return [found[uuid] for uuid in uuids]
+
+    def lookup_offset(self, uuid):
+        """
+        Returns the offset of `uuid`, or `None` if it was never allocated.
+        """
+        return self.lookup_offsets([uuid])[0]
+
+    def lookup_offsets(self, uuids):
+        """
+        Returns the offsets of `uuids`, `None` for the ones never allocated,
+        reading the ones not cached with a single HMGET per `batch_size` ids.
+        """
+        uuids = [str(uuid) for uuid in uuids]
+
+        found = {}
+        for uuid in set(uuids):
+            offset = self._offsets.get(uuid)
+            if offset is not None:
+                found[uuid] = offset
+        missing = [uuid for uuid in set(uuids) if uuid not in found]
+
+        for batch in _chunks(missing, self.batch_size):
+            for uuid, offset in zip(batch, self.redis_client.hmget(self.forward_key, batch)):
+                if offset is not None:
+                    found[uuid] = int(offset)
+                    self._remember(uuid, found[uuid])
+
+        return [found.get(uuid) for uuid in uuids]
+
+    def get_ids(self, offsets):
+        """
+        Returns the ids allocated to `offsets`, `None` for unknown offsets.
+        """
+        found = {}
+        for offset in set(offsets):
+            uuid = self._ids.get(offset)
+            if uuid is not None:
+                found[offset] = uuid
+        missing = [offset for offset in set(offsets) if offset not in found]
+
+        if missing:
+            for offset, uuid in zip(missing, self.redis_client.hmget(self.reverse_key, missing)):
+                if uuid is not None:
+                    found[offset] = uuid = _to_str(uuid)
+                    self._remember(uuid, offset)
+
+        ids = [found.get(offset) for offset in offsets]
+        if self.id_type is None:
+            return ids
+        return [uuid if uuid is None else self.id_type(uuid) for uuid in ids]
+
+    def iter_ids(self, offsets):
+        """
+        Translates an iterable of offsets back to ids, `batch_size` offsets at a time.
+        """
+        batch = []
+        for offset in offsets:
+            batch.append(offset)
+            if len(batch) >= self.batch_size:
+                for uuid in self.get_ids(batch):
+                    yield uuid
+                batch = []
+        for uuid in self.get_ids(batch):
+            yield uuid
+
+    def clear_cache(self):
+        """
+        Forgets the locally cached translations, e.g. after the hashes were deleted.
+        """
+        self._offsets = _LRUCache(self._offsets.max_size)
+        self._ids = _LRUCache(self._ids.max_size)
+
+    def _remember(self, uuid, offset):
+        self._offsets.set(uuid, offset)
+        self._ids.set(offset, uuid)
+
+
+class _LRUCache(object):
+    """
+    A dictionary that forgets the least recently used keys beyond `max_size`.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+        return value
+
+    def set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+#--- Local bitmaps ----------------------------------------------
+class LocalBitmap(object):
+    """
+    A bitmap held in process memory, laid out like a Redis string
+    (bit 0 is the most significant bit of the first byte).
+
+    Supports the same set algebra as BITOP, with `&`, `|`, `^` and `~`,
+    plus counting and membership, without touching Redis. Shorter operands
+    are padded with zero bytes and `~` only inverts the bytes that exist,
+    just like BITOP does.
+
+    Example::
+
+        active = bm.get_month_event('active', now).fetch()
+        paid = bm.get_attribute('paid_user').fetch()
+
+        active_paid = active & paid
+        print len(active_paid)
+        assert 123 in active_paid
+    """
+
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+
+    def get_count(self):
+        count = 0
+        for offset in range(0, len(self.data), _LOCAL_CHUNK_SIZE):
+            chunk = self.data[offset:offset + _LOCAL_CHUNK_SIZE]
+            count += bin(_bytes_to_int(chunk)).count('1')
+        return count
+
+    def __len__(self):
+        return self.get_count()
+
+    def __contains__(self, uuid):
+        index = uuid // 8
+        if uuid < 0 or index >= len(self.data):
+            return False
+        return bool(self.data[index] & (0x80 >> (uuid % 8)))
+
+    def __and__(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def __xor__(self, other):
+        return self._combine(other, lambda a, b: a ^ b)
+
+    def __invert__(self):
+        mask = (1 << (len(self.data) * 8)) - 1
+        return LocalBitmap(_int_to_bytes(_bytes_to_int(self.data) ^ mask, len(self.data)))
+
+    def __iter__(self):
+        return _iter_set_bits(bytes(self.data))
+
+    def __eq__(self, other):
+        return isinstance(other, LocalBitmap) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _combine(self, other, op):
+        length = max(len(self.data), len(other.data))
+        left = _bytes_to_int(self.data + bytearray(length - len(self.data)))
+        right = _bytes_to_int(other.data + bytearray(length - len(other.data)))
+        return LocalBitmap(_int_to_bytes(op(left, right), length))
 
 
 #--- Bit operations ----------------------------------------------
@@ -454,8 +1733,15 @@ class BitOperation(Bitmap):
     """
     Base class for bit operations (AND, OR, XOR).
 
-    Please note that each bit operation creates a new key prefixed with `{KEY_PREFIX}{DIVIDER}bitop{DIVIDER}`.
-    These temporary keys can be deleted with `delete_temporary_bitop_keys`.
+    Please note that each bit operation creates a new key prefixed with `{KEY_PREFIX}{DIVIDER}bitop{DIVIDER}`
+    and named after a hash of its operator and operand keys, so names stay short however
+    deeply operations are nested. These temporary keys can be deleted with `delete_temporary_bitop_keys`.
+
+    Bit operations are lazy: nothing is sent to Redis until the result is
+    counted or queried. The whole expression tree, including nested operations
+    that have not been computed yet, then runs in one MULTI/EXEC round trip
+    together with the query. Intermediate results are written to scratch keys
+    that are deleted in the same transaction.
 
     You can even nest bit operations.
 
@@ -483,50 +1769,1005 @@ class BitOperation(Bitmap):
             MonthEvents('active', now.year, now.month)
         )
 
+    When `plan` is set the STRLEN of every stored operand is fetched in one
+    pipeline before the tree runs. Missing operands are dropped from OR and XOR,
+    an AND with a missing operand is skipped entirely, duplicate AND/OR operands
+    are removed and operands are ordered smallest first. Short-circuiting is not
+    applied below a NOT, whose result depends on the length of its operand.
+
+    When `cache` is set each operation in the tree is stored under its own
+    hashed key instead of a scratch key. A server-side script compares
+    the version tokens and lengths of the operands with the signature the stored
+    result was computed from and only runs BITOP again if they changed, so a
+    repeated query only pays for that check and its BITCOUNT. The signature is
+    stored next to the result and expires with it, and a reused result is
+    not expired any later than `ttl` after it was computed. Version tokens are
+    written by the `Bitmapist` mark methods when it was created with `cache_bit_ops=True`.
+    They take the TTL of their bitmap and are deleted once their bitmap is gone.
+
+    When `cluster` is set the result and scratch keys carry the hash tag of the
+    first operand, so they live in its slot. If the operands are spread over
+    several slots they are downloaded, combined client-side and the result is
+    written back with SET.
+
+    When `memory_budget` is set every result is recorded, with its size, in a
+    registry of live temporary keys: a sorted set by last use, a hash of sizes
+    and a counter of their total.
+    Whenever results are written and the registry exceeds the budget, the least
+    recently used results are deleted before their TTL, by a second script that is
+    passed the keys it deletes. A result that was evicted or expired is computed
+    again when it is next read.
     """
 
-    def __init__(self, op_name, prefix, divider, redis_client, ttl, *events):
+    def __init__(self, op_name, prefix, divider, redis_client, ttl, *events, **options):
         event_redis_keys = [ev.redis_key for ev in events]
 
-        self.redis_key = divider.join([
-            prefix,
-            'bitop',
-            op_name,
-            '-'.join(event_redis_keys),
-            ])
+        self.plan = options.get('plan', False)
+        self.cache = options.get('cache', False)
+        self.id_mapper = options.get('id_mapper')
+        self.cluster = options.get('cluster', False)
+        self.segment_size = options.get('segment_size')
+        self.memory_budget = options.get('memory_budget')
+
+        self._slot_tag = None
+        if self.cluster:
+            self._slot_tag = '{%s}' % _hash_slot_key(event_redis_keys[0])
+        self.redis_key = _content_key(prefix, divider, op_name, event_redis_keys, self._slot_tag)
 
         self.redis_client = redis_client
-        self.redis_client.bitop(op_name, self.redis_key, *event_redis_keys)
-        self.redis_client.expire(self.redis_key, ttl)
+        self.op_name = op_name
+        self.prefix = prefix
+        self.divider = divider
+        self.ttl = ttl
+        self.events = events
+        self._materialized = False
+        self._tracked_keys = []
+
+    def _execute(self, queue_commands):
+        if self._materialized and self.memory_budget is not None:
+            def touch():
+                with self.redis_client.pipeline() as p:
+                    _queue_script(p, self.redis_client, _TOUCH_TEMP_KEY_SCRIPT,
+                                  [self.redis_key] + self._registry_keys(), [time.time()])
+                    queue_commands(p)
+                    return p.execute()
+
+            results = _run_scripted(self.redis_client, touch)
+            if results[0]:
+                return results[1:]
+            # Evicted or expired since it was computed
+            self._materialized = False
+
+        if self._materialized:
+            return Bitmap._execute(self, queue_commands)
+
+        def materialize():
+            with self.redis_client.pipeline(transaction=not self.cluster) as p:
+                queued = self._queue_materialize(p)
+                queue_commands(p)
+                results = p.execute()
+            if self.memory_budget is not None:
+                # The registry script is the last command of the materialization
+                self._evict_over_budget(results[queued - 1], self._tracked_keys)
+            return results[queued:]
+
+        results = _run_scripted(self.redis_client, materialize)
+        self._materialized = True
+        return results
+
+    def _materialize(self):
+        if not self._materialized:
+            self._execute(lambda p: None)
+
+    def _queue_materialize(self, pipe):
+        """
+        Queues the commands that compute this operation on `pipe`
+        and returns how many commands were queued.
+        """
+        if self.segment_size:
+            return self._queue_segmented_materialize(pipe)
+
+        sizes = self._get_operand_sizes() if self.plan else None
+        plan = self._plan(sizes, False, {})
+        if plan is None:
+            pipe.delete(self.redis_key)
+            return 1 + self._queue_track(pipe, [])
+
+        if self.cluster and not _same_slot([self.redis_key] + list(_iter_plan_keys(plan))):
+            return self._queue_local_result(pipe, plan, self.redis_key)
+
+        scratch_keys = {}
+        queued = self._queue_plan(pipe, plan, self.redis_key, scratch_keys)
+        if self.cache:
+            result_keys = [self.redis_key] + list(_iter_nested_results(self._plan_key, plan))
+            return queued + self._queue_track(pipe, result_keys)
+
+        pipe.expire(self.redis_key, self.ttl)
+        queued += 1
+
+        if scratch_keys:
+            pipe.delete(*scratch_keys.values())
+            queued += 1
+
+        return queued + self._queue_track(pipe, [self.redis_key])
+
+    def _queue_track(self, pipe, result_keys):
+        """
+        Queues recording `result_keys` in the temporary key registry. The queued
+        script returns the bytes used by all results, see `_evict_over_budget`.
+        """
+        if self.memory_budget is None:
+            return 0
+        self._tracked_keys = result_keys
+        _queue_script(pipe, self.redis_client, _TRACK_TEMP_KEYS_SCRIPT,
+                      self._registry_keys() + result_keys, [time.time(), self.ttl])
+        return 1
+
+    def _evict_over_budget(self, used, written):
+        """
+        Deletes the least recently used results until the `used` bytes fit in
+        the memory budget, sparing the keys just `written`.
+        """
+        written = set(written)
+        while used > self.memory_budget:
+            candidates = [key for key in self.redis_client.zrange(
+                self._registry_keys()[0], 0, len(written) + _EVICTION_BATCH - 1)
+                if _to_str(key) not in written]
+            if not candidates:
+                return
+            used = _run_scripted(self.redis_client, lambda: _queue_script(
+                self.redis_client, self.redis_client, _EVICT_TEMP_KEYS_SCRIPT,
+                self._registry_keys() + candidates, [self.memory_budget]))
+
+    def _registry_keys(self):
+        return [self.divider.join([self.prefix, 'bitop', 'lru']),
+                self.divider.join([self.prefix, 'bitop', 'sizes']),
+                self.divider.join([self.prefix, 'bitop', 'used'])]
+
+    def _queue_segmented_materialize(self, pipe):
+        """
+        Like `_queue_materialize`, for segmented bitmaps. The segment sets of the
+        operands are read first, then the operation runs once per segment that
+        can be non-empty and the numbers of those segments are stored in `redis_key`.
+
+        NOT inverts every segment up to the last one of its operand, like it would
+        the unsegmented bitmap: segments below the last one are XOR-ed with a full
+        segment of ones, so missing and short ones come out full.
+        """
+        plan = self._plan(None, False, {})
+        operand_keys = list(set(_iter_plan_keys(plan)))
+        segment_sets = dict(zip(operand_keys, _get_segment_sets(self.redis_client, operand_keys)))
+        segments = sorted(_plan_segments(plan, segment_sets))
+
+        pipe.delete(self.redis_key)
+        queued = 1
+
+        scratch_keys = []
+        for segment in segments:
+            segment_plan = _segment_plan(plan, self.divider, segment, segment_sets,
+                                         ('ONES', [], self.segment_size // 8))
+            dest_key = self._segment_key(segment)
+            if self.cluster and not _same_slot([dest_key] + list(_iter_plan_keys(segment_plan))):
+                queued += self._queue_local_result(pipe, segment_plan, dest_key)
+                continue
+
+            segment_scratch_keys = {}
+            queued += self._queue_plan(pipe, segment_plan, dest_key, segment_scratch_keys)
+            scratch_keys.extend(segment_scratch_keys.values())
+            pipe.expire(dest_key, self.ttl)
+            queued += 1
+
+        if segments:
+            pipe.sadd(self.redis_key, *segments)
+            pipe.expire(self.redis_key, self.ttl)
+            queued += 2
+
+        if scratch_keys:
+            pipe.delete(*scratch_keys)
+            queued += 1
+
+        return queued
+
+    def _queue_local_result(self, pipe, plan, dest_key):
+        """
+        Computes `plan` client-side and queues writing the result to `dest_key`.
+        """
+        result = self._compute_locally(plan, {})
+        if not result.data:
+            pipe.delete(dest_key)
+            return 1
+
+        pipe.set(dest_key, bytes(result.data))
+        pipe.expire(dest_key, self.ttl)
+        return 2
+
+    def _compute_locally(self, plan, fetched):
+        op_name, operands, size = plan
+        if op_name == 'ONES':
+            return LocalBitmap(b'\xff' * size)
+        if op_name == 'EMPTY':
+            return LocalBitmap(b'')
+
+        values = []
+        for operand in operands:
+            if isinstance(operand, tuple):
+                values.append(self._compute_locally(operand, fetched))
+                continue
+            if operand not in fetched:
+                fetched[operand], = _fetch_all(self.redis_client, [operand])
+            values.append(fetched[operand])
+
+        if op_name.upper() == 'NOT':
+            return ~values[0]
+        return reduce(_LOCAL_BIT_OPS[op_name.upper()], values)
+
+    def _get_operand_sizes(self):
+        """
+        Returns the STRLEN of every stored bitmap the operation tree reads from.
+        """
+        keys = []
+        self._collect_operand_keys(keys)
+        keys = list(set(keys))
+
+        with self.redis_client.pipeline(transaction=False) as p:
+            for key in keys:
+                p.strlen(key)
+            return dict(zip(keys, p.execute()))
+
+    def _collect_operand_keys(self, keys):
+        for ev in self.events:
+            if isinstance(ev, BitOperation) and not ev._materialized:
+                ev._collect_operand_keys(keys)
+            else:
+                keys.append(ev.redis_key)
+
+    def _plan(self, sizes, length_sensitive, plans):
+        """
+        Returns the tree rooted at this operation as nested `(op_name, operands, size)`
+        tuples, where operands are stored keys or other tuples.
+
+        Without `sizes` the tree is returned as is. Otherwise it is simplified
+        and `None` is returned when the result is known to be empty.
+        """
+        memo_key = (id(self), length_sensitive)
+        if memo_key in plans:
+            return plans[memo_key]
+
+        op = self.op_name.upper()
+        sensitive = length_sensitive or op == 'NOT'
+
+        operands = []
+        for ev in self.events:
+            if isinstance(ev, BitOperation) and not ev._materialized:
+                operand = ev._plan(sizes, sensitive, plans)
+                size = operand[2] if operand is not None else 0
+            else:
+                operand = ev.redis_key
+                size = sizes[operand] if sizes is not None else None
+            operands.append((operand, size))
+
+        if sizes is None:
+            plan = (self.op_name, [operand for operand, _ in operands], None)
+        else:
+            plan = _simplify_bit_op(self.op_name, operands, sensitive)
+
+        plans[memo_key] = plan
+        return plan
+
+    def _queue_plan(self, pipe, plan, dest_key, scratch_keys):
+        """
+        Queues BITOPs computing `plan` into `dest_key`, computing nested
+        operations into scratch keys first. With `cache` set nested operations
+        are kept under their content addressed keys instead.
+        """
+        op_name, operands, size = plan
+        if op_name == 'ONES':
+            pipe.set(dest_key, b'\xff' * size)
+            return 1
+        if op_name == 'EMPTY':
+            pipe.delete(dest_key)
+            return 1
+
+        queued = 0
+        operand_keys = []
+        for operand in operands:
+            if not isinstance(operand, tuple):
+                operand_keys.append(operand)
+            elif self.cache:
+                nested_key = self._plan_key(operand)
+                queued += self._queue_plan(pipe, operand, nested_key, scratch_keys)
+                operand_keys.append(nested_key)
+            else:
+                scratch_key = scratch_keys.get(id(operand))
+                if scratch_key is None:
+                    scratch_key = self._scratch_key()
+                    queued += self._queue_plan(pipe, operand, scratch_key, scratch_keys)
+                    scratch_keys[id(operand)] = scratch_key
+                operand_keys.append(scratch_key)
+
+        if self.cache:
+            keys = [dest_key, self.divider.join([dest_key, 'sig'])] + [
+                _version_key(self.prefix, self.divider, key) for key in [dest_key] + operand_keys]
+            _queue_script(pipe, self.redis_client, _CACHED_BITOP_SCRIPT,
+                          keys[:3] + operand_keys + keys[3:],
+                          [op_name, self.ttl, _version_token()])
+        else:
+            pipe.bitop(op_name, dest_key, *operand_keys)
+        return queued + 1
+
+    def _scratch_key(self):
+        if self.cluster:
+            return self.divider.join([self.prefix, 'bitop', self._slot_tag, 'tmp', uuid4().hex])
+        return self.divider.join([self.prefix, 'bitop', 'tmp', uuid4().hex])
+
+    def _plan_key(self, plan):
+        """
+        Returns the content addressed key a (possibly nested) plan is cached under.
+        """
+        if not isinstance(plan, tuple):
+            return plan
+        operand_keys = [self._plan_key(operand) for operand in plan[1]]
+        return _content_key(self.prefix, self.divider, plan[0], operand_keys)
 
 
 class BitOpAnd(BitOperation):
 
-    def __init__(self, prefix, divider, redis_client, ttl, *events):
-        BitOperation.__init__(self, 'AND', prefix, divider, redis_client, ttl, *events)
+    def __init__(self, prefix, divider, redis_client, ttl, *events, **options):
+        BitOperation.__init__(self, 'AND', prefix, divider, redis_client, ttl, *events, **options)
 
 
 class BitOpNot(BitOperation):
 
-    def __init__(self, prefix, divider, redis_client, ttl, event):
-        BitOperation.__init__(self, 'Not', prefix, divider, redis_client, ttl, event)
+    def __init__(self, prefix, divider, redis_client, ttl, event, **options):
+        BitOperation.__init__(self, 'Not', prefix, divider, redis_client, ttl, event, **options)
 
 
 class BitOpOr(BitOperation):
 
-    def __init__(self, prefix, divider, redis_client, ttl, *events):
-        BitOperation.__init__(self, 'OR', prefix, divider, redis_client, ttl, *events)
+    def __init__(self, prefix, divider, redis_client, ttl, *events, **options):
+        BitOperation.__init__(self, 'OR', prefix, divider, redis_client, ttl, *events, **options)
 
 
 class BitOpXor(BitOperation):
 
-    def __init__(self, prefix, divider, redis_client, ttl, *events):
-        BitOperation.__init__(self, 'XOR', prefix, divider, redis_client, ttl, *events)
+    def __init__(self, prefix, divider, redis_client, ttl, *events, **options):
+        BitOperation.__init__(self, 'XOR', prefix, divider, redis_client, ttl, *events, **options)
 
 
 #--- Private ----------------------------------------------
-def _prefix_key(event_name, prefix, divider, date=None):
+def _materialize_all(bitmaps):
+    """
+    Computes every lazy bit operation among `bitmaps` in one round trip.
+    """
+    lazy_ops = [bitmap for bitmap in bitmaps
+                if isinstance(bitmap, BitOperation) and not bitmap._materialized]
+    if not lazy_ops:
+        return
+
+    def materialize():
+        with lazy_ops[0].redis_client.pipeline(transaction=not lazy_ops[0].cluster) as p:
+            queued = sum(op._queue_materialize(p) for op in lazy_ops)
+            results = p.execute()
+        if lazy_ops[0].memory_budget is not None:
+            written = [key for op in lazy_ops for key in op._tracked_keys]
+            lazy_ops[0]._evict_over_budget(results[queued - 1], written)
+
+    _run_scripted(lazy_ops[0].redis_client, materialize)
+
+    for op in lazy_ops:
+        op._materialized = True
+
+
+_LOCAL_BIT_OPS = {'AND': operator.and_, 'OR': operator.or_, 'XOR': operator.xor}
+
+
+def _iter_nested_results(plan_key, plan):
+    """
+    Yields the keys `plan_key` gives to the plans nested in `plan`.
+    """
+    for operand in plan[1]:
+        if isinstance(operand, tuple):
+            yield plan_key(operand)
+            for key in _iter_nested_results(plan_key, operand):
+                yield key
+
+
+def _iter_plan_keys(plan):
+    """
+    Yields the stored keys a plan reads from.
+    """
+    for operand in plan[1]:
+        if isinstance(operand, tuple):
+            for key in _iter_plan_keys(operand):
+                yield key
+        else:
+            yield operand
+
+
+def _plan_segments(plan, segment_sets):
+    """
+    Returns the segments the result of `plan` can have bits in, given
+    the segments of its operand keys. NOT can set bits in every segment
+    up to the last one of its operand.
+    """
+    op_name, operands, _ = plan
+    if op_name.upper() == 'NOT':
+        last = _last_plan_segment(plan, segment_sets)
+        return set(range(last + 1)) if last is not None else set()
+
+    sets = [_plan_segments(operand, segment_sets) if isinstance(operand, tuple)
+            else segment_sets[operand] for operand in operands]
+    if op_name.upper() == 'AND':
+        return reduce(operator.and_, sets)
+    return reduce(operator.or_, sets)
+
+
+def _last_plan_segment(plan, segment_sets):
+    """
+    Returns the last segment any key `plan` reads from has, which holds
+    the end of the result, or `None` if none of them has segments.
+    """
+    segments = set()
+    for key in _iter_plan_keys(plan):
+        segments |= segment_sets[key]
+    return max(segments) if segments else None
+
+
+def _segment_plan(plan, divider, segment, segment_sets, ones):
+    """
+    Returns `plan` with its operand keys replaced by the keys of their segment `segment`.
+    A NOT becomes an XOR with `ones`, a full segment of set bits, below the last segment
+    of its operand and an `EMPTY` plan above it, so it inverts as far as it would without
+    segments.
+    """
+    op_name, operands, size = plan
+    segment_operands = [
+        _segment_plan(operand, divider, segment, segment_sets, ones) if isinstance(operand, tuple)
+        else _segment_key(operand, divider, segment) for operand in operands]
+
+    if op_name.upper() == 'NOT':
+        last = _last_plan_segment(plan, segment_sets)
+        if last is None or segment > last:
+            return ('EMPTY', [], 0)
+        if segment < last:
+            return ('XOR', segment_operands + [ones], size)
+    return (op_name, segment_operands, size)
+
+
+def _simplify_bit_op(op_name, operands, length_sensitive):
+    """
+    Simplifies a bit operation given its `(operand, size)` pairs, where a size of 0
+    means the operand does not exist. Returns an `(op_name, operands, size)` plan
+    or `None` if the result is empty.
+
+    BITOP pads shorter operands with zero bytes, so the result of an AND over a
+    missing operand is not missing but all zeros. It can only be skipped when
+    no enclosing NOT depends on its length (`length_sensitive` is false).
+    """
+    op = op_name.upper()
+
+    if op == 'NOT':
+        operand, size = operands[0]
+        if size == 0 and not length_sensitive:
+            return None
+        return (op_name, [operand], size)
+
+    if op == 'AND':
+        if not length_sensitive and any(size == 0 for _, size in operands):
+            return None
+    else:
+        present = [(operand, size) for operand, size in operands if size != 0]
+        if not present:
+            if not length_sensitive:
+                return None
+            present = operands[:1]
+        operands = present
+
+    if op in ('AND', 'OR'):
+        unique, seen = [], set()
+        for operand, size in operands:
+            identity = id(operand) if isinstance(operand, tuple) else operand
+            if identity not in seen:
+                seen.add(identity)
+                unique.append((operand, size))
+        operands = unique
+
+    # BITOP pads every operand to the longest one, AND included
+    operands = sorted(operands, key=lambda operand_size: operand_size[1])
+    size = max(size for _, size in operands)
+    return (op_name, [operand for operand, _ in operands], size)
+
+
+# KEYS are the bitmaps to mark, ARGV[1] is the uuid, ARGV[2] a version token,
+# ARGV[3] the time the event name is recorded in the name registry at ('' to skip),
+# ARGV[4] the event name and ARGV[i + 4] the TTL of KEYS[i] in seconds (0 for no TTL).
+# TTLs are only applied to new keys. If there are twice as many KEYS as bitmaps,
+# the second half are the version keys of the bitmaps, set to the token with the TTL
+# of their bitmap. When the name is recorded, the last of KEYS is the registry.
+_MARK_EVENT_SCRIPT = """
+local count = #ARGV - 4
+local register = ARGV[3] ~= ''
+local versioned = #KEYS - (register and 1 or 0) > count
+for i = 1, count do
+    local key = KEYS[i]
+    local ttl = tonumber(ARGV[i + 4])
+    local is_new = ttl > 0 and redis.call('EXISTS', key) == 0
+    redis.call('SETBIT', key, ARGV[1], 1)
+    if is_new then
+        redis.call('EXPIRE', key, ttl)
+    end
+    if versioned then
+        local version_key = KEYS[count + i]
+        redis.call('SET', version_key, ARGV[2])
+        local pttl = redis.call('PTTL', key)
+        if pttl > 0 then
+            redis.call('PEXPIRE', version_key, pttl)
+        end
+    end
+end
+if register then
+    redis.call('ZADD', KEYS[#KEYS], ARGV[3], ARGV[4])
+end
+return count
+"""
+
+# KEYS are the id to offset hash, the offset to id hash and the offset counter.
+# Returns the offsets of the ids in ARGV, allocating the missing ones.
+_ALLOCATE_IDS_SCRIPT = """
+local offsets = {}
+for i, id in ipairs(ARGV) do
+    local offset = redis.call('HGET', KEYS[1], id)
+    if not offset then
+        offset = redis.call('INCR', KEYS[3]) - 1
+        redis.call('HSET', KEYS[1], id, offset)
+        redis.call('HSET', KEYS[2], offset, id)
+    end
+    offsets[i] = tonumber(offset)
+end
+return offsets
+"""
+
+# KEYS[1] is the result key, KEYS[2] its signature key and KEYS[3] its version key,
+# followed by the N operands and then their N version keys. ARGV is the operator,
+# the TTL and a new version token for the result. The BITOP only runs when the
+# versions or lengths of the operands changed since the result was stored.
+# Version keys take the TTL of their operand and are deleted with it.
+# Returns 1 on a cache hit.
+_CACHED_BITOP_SCRIPT = """
+local count = (#KEYS - 3) / 2
+local operands = {}
+local signature = {}
+for i = 1, count do
+    local key = KEYS[3 + i]
+    local version_key = KEYS[3 + count + i]
+    local pttl = redis.call('PTTL', key)
+    if pttl == -2 then
+        redis.call('DEL', version_key)
+    elseif pttl > 0 then
+        redis.call('PEXPIRE', version_key, pttl)
+    end
+    operands[i] = key
+    signature[i] = (redis.call('GET', version_key) or '0') .. '/' .. redis.call('STRLEN', key)
+end
+signature = table.concat(signature, ',')
+if redis.call('EXISTS', KEYS[1]) == 1 and redis.call('GET', KEYS[2]) == signature then
+    return 1
+end
+redis.call('BITOP', ARGV[1], KEYS[1], unpack(operands))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SET', KEYS[2], signature, 'EX', ARGV[2])
+redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[2])
+return 0
+"""
+
+
+def _version_key(prefix, divider, redis_key):
+    return divider.join([prefix, 'bitop', 'version', redis_key])
+
+
+def _version_token():
+    """
+    Returns a new version token. Tokens are random rather than counters, so a key
+    that expires and is written again never reuses the version of its old content.
+    """
+    return uuid4().hex[:16]
+
+
+_loaded_scripts = _LRUCache(1000)
+
+
+def _queue_script(pipe, redis_client, script, keys, args):
+    """
+    Queues running `script` with EVALSHA, loading it with SCRIPT LOAD the first
+    time this process runs it on `redis_client`. Pipelines queuing scripts are
+    executed with `_run_scripted`, which loads them again if the server lost them.
+    `pipe` can be `redis_client` itself, the result of the script is then returned.
+    """
+    sha = sha1(script.encode('utf-8')).hexdigest()
+    loaded = _loaded_scripts.get(id(redis_client))
+    if loaded is None:
+        loaded = set()
+        _loaded_scripts.set(id(redis_client), loaded)
+    if sha not in loaded:
+        redis_client.script_load(script)
+        loaded.add(sha)
+    return pipe.evalsha(sha, len(keys), *(list(keys) + list(args)))
+
+
+def _run_scripted(redis_client, run):
+    """
+    Calls `run`, which queues scripts with `_queue_script` and executes them,
+    and calls it again once if the server no longer had one of them,
+    e.g. after a restart or SCRIPT FLUSH.
+    """
+    try:
+        return run()
+    except NoScriptError:
+        _loaded_scripts.set(id(redis_client), set())
+        return run()
+
+
+def _content_key(prefix, divider, op_name, operand_keys, slot_tag=None):
+    digest = sha1('\n'.join([op_name] + list(operand_keys)).encode('utf-8')).hexdigest()
+    if slot_tag:
+        return divider.join([prefix, 'bitop', slot_tag, op_name, digest])
+    return divider.join([prefix, 'bitop', op_name, digest])
+
+
+# Records freshly written temporary results in the LRU registry, forgets
+# entries that have certainly expired and returns the bytes used by all results.
+# KEYS: lru zset, sizes hash, total counter, written results. ARGV: now, ttl
+_TRACK_TEMP_KEYS_SCRIPT = """
+local now = tonumber(ARGV[1])
+for i = 4, #KEYS do
+    local size = redis.call('STRLEN', KEYS[i])
+    local old_size = tonumber(redis.call('HGET', KEYS[2], KEYS[i]) or '0')
+    if size > 0 then
+        redis.call('ZADD', KEYS[1], now, KEYS[i])
+        redis.call('HSET', KEYS[2], KEYS[i], size)
+    else
+        redis.call('ZREM', KEYS[1], KEYS[i])
+        redis.call('HDEL', KEYS[2], KEYS[i])
+    end
+    redis.call('INCRBY', KEYS[3], size - old_size)
+end
+
+-- Results are never expired later than their TTL after they were last written
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. (now - tonumber(ARGV[2])))
+for _, key in ipairs(expired) do
+    redis.call('DECRBY', KEYS[3], tonumber(redis.call('HGET', KEYS[2], key) or '0'))
+    redis.call('ZREM', KEYS[1], key)
+    redis.call('HDEL', KEYS[2], key)
+end
+
+return tonumber(redis.call('GET', KEYS[3]) or '0')
+"""
+
+# Deletes the given results, least recently used first, until the registry
+# fits in the memory budget. Returns the bytes still used.
+# KEYS: lru zset, sizes hash, total counter, candidate results. ARGV: budget
+_EVICT_TEMP_KEYS_SCRIPT = """
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+for i = 4, #KEYS do
+    if total <= tonumber(ARGV[1]) then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[2], KEYS[i]) or '0')
+    total = total - size
+    redis.call('DECRBY', KEYS[3], size)
+    redis.call('DEL', KEYS[i])
+    redis.call('ZREM', KEYS[1], KEYS[i])
+    redis.call('HDEL', KEYS[2], KEYS[i])
+end
+return total
+"""
+
+_EVICTION_BATCH = 100
+
+# Marks a result as used now, or forgets it if it is gone. Returns 1 if it exists.
+# KEYS: result, lru zset, sizes hash, total counter. ARGV: now
+_TOUCH_TEMP_KEY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or '0'))
+    redis.call('ZREM', KEYS[2], KEYS[1])
+    redis.call('HDEL', KEYS[3], KEYS[1])
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[1], KEYS[1])
+return 1
+"""
+
+
+# How many offsets a single BITFIELD command reads or writes
+_BITFIELD_CHUNK_SIZE = 1000
+
+_bitfield_support = _LRUCache(1000)
+
+
+def _server_has_bitfield(redis_client, probe_key):
+    """
+    Returns whether the server behind `redis_client` supports BITFIELD (Redis 3.2+),
+    asking it once per client with an empty BITFIELD on the string key `probe_key`.
+    Errors other than an unknown command are raised.
+    """
+    supported = _bitfield_support.get(id(redis_client))
+    if supported is None:
+        try:
+            redis_client.execute_command('BITFIELD', probe_key)
+            supported = True
+        except ResponseError as e:
+            if 'unknown command' not in str(e).lower():
+                raise
+            supported = False
+        _bitfield_support.set(id(redis_client), supported)
+    return supported
+
+
+def _bitfield_args(subcommand, offsets, value=None):
+    args = []
+    for offset in offsets:
+        args.extend([subcommand, 'u1', offset])
+        if value is not None:
+            args.append(value)
+    return args
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+_POPCOUNT = [bin(i).count('1') for i in range(256)]
+
+
+def _count_bits(data, first_bit, last_bit):
+    """
+    Counts the set bits of `data` between `first_bit` and `last_bit`, inclusive,
+    where bit 0 is the most significant bit of the first byte (like SETBIT).
+    """
+    total = 0
+    for i, byte in enumerate(bytearray(data or b'')):
+        lo = max(first_bit - i * 8, 0)
+        hi = min(last_bit - i * 8, 7)
+        if lo <= hi:
+            total += _POPCOUNT[byte & (0xff >> lo) & (0xff << (7 - hi))]
+    return total
+
+
+# Bitmaps are combined as Python integers, whose bitwise operators run in C,
+# and counted in chunks of this many bytes
+_LOCAL_CHUNK_SIZE = 1024 * 1024
+
+
+_NON_ZERO_BYTES_RE = re.compile(b'[^\x00]+')
+_SET_BITS = [[bit for bit in range(8) if byte & (0x80 >> bit)] for byte in range(256)]
+
+
+def _iter_set_bits(data, first_bit=0):
+    """
+    Yields the positions of the set bits in `data`, numbered from `first_bit`.
+    Runs of zero bytes are skipped by the regex engine.
+    """
+    for match in _NON_ZERO_BYTES_RE.finditer(data):
+        position = first_bit + match.start() * 8
+        for byte in bytearray(match.group()):
+            for bit in _SET_BITS[byte]:
+                yield position + bit
+            position += 8
+
+
+def _bytes_to_int(data):
+    if not data:
+        return 0
+    return int(hexlify(data), 16)
+
+
+def _int_to_bytes(value, length):
+    if not length:
+        return b''
+    return unhexlify('%0*x' % (length * 2, value))
+
+
+def _get_range_cover(start, end):
+    """
+    Returns the fewest `(granularity, datetime)` buckets that exactly cover
+    the hours from `start` to `end`, preferring larger ones among equally few.
+    Hours outside the whole days of the range are hour buckets, the whole days
+    are split by a shortest path over their boundaries, so e.g. a month
+    starting inside a partial week wins over the weeks around it.
+    """
+    first_day = datetime(start.year, start.month, start.day)
+    if start.hour:
+        first_day += timedelta(days=1)
+    end_day = datetime(end.year, end.month, end.day)
+    if end.hour == 23:
+        end_day += timedelta(days=1)
+
+    if end_day <= first_day:
+        return _hour_buckets(start, end)
+
+    # best[i] is the number of buckets covering days i.. and the first of them
+    days = (end_day - first_day).days
+    best = [None] * days + [(0, None)]
+    for i in range(days - 1, -1, -1):
+        day = first_day + timedelta(days=i)
+        next_month = datetime(day.year + day.month // 12, day.month % 12 + 1, 1)
+        options = [('day', 1)]
+        if day.weekday() == 0:
+            options.insert(0, ('week', 7))
+        if day.day == 1:
+            options.insert(0, ('month', (next_month - day).days))
+        for granularity, length in options:
+            if i + length <= days and (best[i] is None or best[i + length][0] + 1 < best[i][0]):
+                best[i] = (best[i + length][0] + 1, (granularity, length))
+
+    cover = _hour_buckets(start, first_day - timedelta(hours=1))
+    i = 0
+    while i < days:
+        granularity, length = best[i][1]
+        cover.append((granularity, first_day + timedelta(days=i)))
+        i += length
+    return cover + _hour_buckets(end_day, end)
+
+
+def _hour_buckets(start, end):
+    cover = []
+    while start <= end:
+        cover.append(('hour', start))
+        start += timedelta(hours=1)
+    return cover
+
+
+def _month_days(now):
+    first_day = date(now.year, now.month, 1)
+    next_month = date(now.year + now.month // 12, now.month % 12 + 1, 1)
+    return [first_day + timedelta(days=i) for i in range((next_month - first_day).days)]
+
+
+def _week_days(now):
+    monday = date(now.year, now.month, now.day) - timedelta(days=now.weekday())
+    return [monday + timedelta(days=i) for i in range(7)]
+
+
+def _ttl_seconds(ttl):
+    if ttl is None:
+        return 0
+    if isinstance(ttl, timedelta):
+        return int(ttl.total_seconds())
+    return int(ttl)
+
+
+def _prefix_key(event_name, prefix, divider, date=None, hash_tag=None, month=None):
+    if hash_tag == 'event':
+        event_name = '{%s}' % event_name
     if date:
-        return divider.join([prefix, 'ev', event_name, date])
+        key = divider.join([prefix, 'ev', event_name, date])
+        if hash_tag == 'month':
+            key = divider.join([key, '{%s-%s}' % month])
+        return key
     else:
         return divider.join([prefix, 'at', event_name])
+
+
+def _to_str(value):
+    """
+    Returns `value`, a key or name read from Redis, as a native string.
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _count_bit_range(key, start_bit, end_bit):
+    """
+    Counts the set bits of `key` between `start_bit` and `end_bit`, like
+    `MixinCounts.get_count`, for synchronous and asyncio callers alike.
+    Yields functions queuing commands on a pipeline, is sent the results
+    of each and finally yields the count.
+    """
+    if start_bit is None and end_bit is None:
+        count, = yield lambda p: p.bitcount(key)
+        yield count
+        return
+
+    start_bit = start_bit or 0
+    end_bit = -1 if end_bit is None else end_bit
+
+    if start_bit < 0 or end_bit < 0:
+        length, = yield lambda p: p.strlen(key)
+        if start_bit < 0:
+            start_bit = max(start_bit + length * 8, 0)
+        if end_bit < 0:
+            end_bit += length * 8
+
+    if end_bit < start_bit:
+        yield 0
+        return
+
+    first_byte = start_bit // 8
+    last_byte = end_bit // 8
+
+    if last_byte - first_byte <= 1:
+        data, = yield lambda p: p.getrange(key, first_byte, last_byte)
+        yield _count_bits(data, start_bit - first_byte * 8, end_bit - first_byte * 8)
+        return
+
+    def queue_commands(p):
+        p.getrange(key, first_byte, first_byte)
+        p.bitcount(key, first_byte + 1, last_byte - 1)
+        p.getrange(key, last_byte, last_byte)
+
+    head, middle, tail = yield queue_commands
+    yield _count_bits(head, start_bit % 8, 7) + middle + _count_bits(tail, 0, end_bit % 8)
+
+
+def _segment_key(redis_key, divider, segment):
+    return divider.join([redis_key, 's', str(segment)])
+
+
+def _get_segment_sets(redis_client, keys):
+    """
+    Returns the set of segment numbers stored under each of `keys`.
+    """
+    with redis_client.pipeline(transaction=False) as p:
+        for key in keys:
+            p.smembers(key)
+        return [set(int(member) for member in members) for members in p.execute()]
+
+
+def _iso_week_start(year, week):
+    """
+    Returns the Monday of ISO week `week` of `year`.
+    """
+    jan_4 = date(year, 1, 4)
+    return jan_4 + timedelta(days=-jan_4.weekday(), weeks=week - 1)
+
+
+def _hash_slot_key(key):
+    """
+    Returns the part of `key` Redis Cluster hashes: the content of its first
+    non-empty `{...}` hash tag, or the whole key.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def _key_slot(key):
+    """
+    Returns the Redis Cluster hash slot of `key` (CRC16/XMODEM modulo 16384).
+    """
+    data = _hash_slot_key(key)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xff00) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xff]
+    return crc % 16384
+
+
+def _same_slot(keys):
+    return len(set(_key_slot(key) for key in keys)) <= 1
+
+
+def _fetch_all(redis_client, keys):
+    """
+    Downloads every key in `keys` into a `LocalBitmap`.
+    """
+    return [Bitmap(key, redis_client).fetch() for key in keys]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+bitmapist.aio
+~~~~~~~~~~~~~
+asyncio support for bitmapist, on top of the `redis.asyncio` client
+that ships with redis-py 4.2+. Requires Python 3.
+
+`AsyncBitmapist` builds keys exactly like `Bitmapist`, but marking,
+counting and membership checks are coroutines, so one process can keep
+many of them in flight without blocking a thread per call.
+
+Example::
+
+    import redis.asyncio
+    from bitmapist.aio import AsyncBitmapist
+
+    bm = AsyncBitmapist(redis.asyncio.Redis(host='localhost', port=6379))
+
+    await bm.mark_event('active', 123)
+    await bm.mark_attribute('paid_user', 123)
+
+    active = bm.bit_op_and(
+        bm.get_month_event('active', now),
+        bm.get_attribute('paid_user'),
+    )
+    print(await active.get_count())
+    print(await active.contains(123))
+"""
+
+from datetime import datetime
+
+from bitmapist import Bitmapist, BitOperation, _count_bit_range
+
+
+class AsyncBitmapist(object):
+    """
+    Marks and queries bitmaps laid out like a `Bitmapist`'s, with coroutines.
+    `redis_client` must be a `redis.asyncio.Redis`.
+
+    The factory and bit operation methods are not coroutines, they return
+    `AsyncBitmap` objects whose queries are. Bit operations stay lazy and run
+    with their query in one MULTI/EXEC round trip.
+
+    Planned and cached bit operations, Lua marking, id mappers and rollups need
+    synchronous round trips while building commands and are not supported.
+    Listing and deleting names and keys is left to a `Bitmapist` with
+    the same prefix on a synchronous client.
+    """
+
+    def __init__(self, redis_client, prefix='trackist', divider=':', temp_ttl=None,
+                 name_registry=True, registry_refresh=3600):
+        # Builds keys and bit operations, its own Redis calls would not be awaited
+        self._bitmapist = Bitmapist(redis_client, prefix, divider, temp_ttl,
+                                    name_registry=name_registry,
+                                    registry_refresh=registry_refresh)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.divider = divider
+
+    def get_month_event(self, event_name, now):
+        return AsyncBitmap(self._bitmapist.get_month_event(event_name, now))
+
+    def get_week_event(self, event_name, now):
+        return AsyncBitmap(self._bitmapist.get_week_event(event_name, now))
+
+    def get_day_event(self, event_name, now):
+        return AsyncBitmap(self._bitmapist.get_day_event(event_name, now))
+
+    def get_hour_event(self, event_name, now):
+        return AsyncBitmap(self._bitmapist.get_hour_event(event_name, now))
+
+    def get_attribute(self, attribute_name):
+        return AsyncBitmap(self._bitmapist.get_attribute(attribute_name))
+
+    def bit_op_and(self, *bitmaps):
+        return AsyncBitmap(self._bitmapist.bit_op_and(*[bm.bitmap for bm in bitmaps]))
+
+    def bit_op_or(self, *bitmaps):
+        return AsyncBitmap(self._bitmapist.bit_op_or(*[bm.bitmap for bm in bitmaps]))
+
+    def bit_op_xor(self, *bitmaps):
+        return AsyncBitmap(self._bitmapist.bit_op_xor(*[bm.bitmap for bm in bitmaps]))
+
+    def bit_op_not(self, bitmap):
+        return AsyncBitmap(self._bitmapist.bit_op_not(bitmap.bitmap))
+
+    async def mark_event(self, event_name, uuid, now=None, month=True, week=True, day=True,
+                         hour=True, month_ttl=None, week_ttl=None, day_ttl=None, hour_ttl=None):
+        """
+        Marks an event for hours, days, weeks and months. Takes the same arguments
+        as `Bitmapist.mark_event`.
+        """
+        if not now:
+            now = datetime.utcnow()
+
+        stat_objs = self._bitmapist._get_event_targets(event_name, now, month, week, day, hour,
+                                                       month_ttl, week_ttl, day_ttl, hour_ttl)
+
+        async with self.redis_client.pipeline() as p:
+            for obj, ttl in stat_objs:
+                p.setbit(obj.redis_key, uuid, 1)
+                if ttl is not None:
+                    p.expire(obj.redis_key, ttl)
+            self._bitmapist._register_name(p, 'ev', event_name)
+            await p.execute()
+
+    async def mark_attribute_multi(self, attribute_name, uuids, mark_as=1):
+        if mark_as not in (0, 1):
+            raise ValueError('Can only mark bitmaps with 0 or 1')
+
+        obj = self.get_attribute(attribute_name)
+        async with self.redis_client.pipeline(transaction=False) as p:
+            for _id in uuids:
+                p.setbit(obj.redis_key, _id, mark_as)
+            self._bitmapist._register_name(p, 'at', attribute_name)
+            await p.execute()
+
+    async def mark_attribute(self, attribute_name, uuid, mark_as=1):
+        """
+        Marks an attribute that is not time specific. Takes the same arguments
+        as `Bitmapist.mark_attribute`.
+        """
+        if type(uuid) is list:
+            return await self.mark_attribute_multi(attribute_name, uuid, mark_as)
+
+        await self.mark_attribute_multi(attribute_name, [uuid], mark_as)
+
+
+class AsyncBitmap(object):
+    """
+    Wraps a `Bitmap` or `BitOperation` and runs its queries on an asyncio client.
+    """
+
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+        self.redis_key = bitmap.redis_key
+
+    async def _execute(self, queue_commands):
+        bitmap = self.bitmap
+        if not isinstance(bitmap, BitOperation) or bitmap._materialized:
+            async with bitmap.redis_client.pipeline(transaction=False) as p:
+                queue_commands(p)
+                return await p.execute()
+
+        async with bitmap.redis_client.pipeline() as p:
+            queued = bitmap._queue_materialize(p)
+            queue_commands(p)
+            results = await p.execute()
+
+        bitmap._materialized = True
+        return results[queued:]
+
+    async def has_events_marked(self):
+        exists, = await self._execute(lambda p: p.exists(self.redis_key))
+        return bool(exists)
+
+    async def contains(self, uuid):
+        value, = await self._execute(lambda p: p.getbit(self.redis_key, uuid))
+        return bool(value)
+
+    async def get_count(self, start_bit=None, end_bit=None):
+        """
+        Counts the set bits between `start_bit` and `end_bit`, inclusive,
+        like `Bitmap.get_count`.
+        """
+        steps = _count_bit_range(self.redis_key, start_bit, end_bit)
+        step = next(steps)
+        while callable(step):
+            step = steps.send(await self._execute(step))
+        return step
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+bitmapist.backfill
+~~~~~~~~~~~~~~~~~~
+Rebuilds event bitmaps from raw event logs, much faster than calling
+`mark_event` once per line.
+
+The logs are split into byte ranges that a pool of processes parses in
+parallel. Every process builds the bitmaps its range touches as local
+bitsets, and the parent writes them to Redis as each range finishes:
+SETRANGE into a scratch key and a single BITOP OR per key, restoring
+the key's TTL, so Redis sees a few commands per key instead of one per
+event and the parent never holds more than one range's bitsets.
+
+Logs are JSON lines or CSV files with a header row, with one event per
+line. Each event has a name, an integer uuid and a time, either in UTC
+ISO 8601 ("2012-10-15T14:03:00") or as a Unix timestamp::
+
+    {"event": "active", "uuid": 123, "time": "2012-10-15T14:03:00"}
+
+Example::
+
+    from bitmapist.backfill import backfill
+
+    backfill(Bitmapist(redis_client), ['events-2012-10.jsonl', 'events-2012-11.csv'])
+"""
+
+import csv
+import json
+import multiprocessing
+import numbers
+import os
+
+from datetime import datetime
+
+from bitmapist import Bitmapist
+
+
+def backfill(bitmapist, paths, workers=None, event_field='event', uuid_field='uuid',
+             time_field='time', month=True, week=True, day=True, hour=True,
+             chunk_size=64 * 1024 * 1024):
+    """
+    Marks every event in the log files at `paths` with `bitmapist`.
+    Files ending in ".csv" are read as CSV, anything else as JSON lines.
+
+    :param :workers How many processes parse the logs. Defaults to the number of CPUs,
+                    1 parses them in this process
+    :param :event_field The field holding the event name
+    :param :uuid_field The field holding the uuid
+    :param :time_field The field holding the time of the event
+    :param :month, week, day, hour Which granularities are written, like in `mark_event`
+    :param :chunk_size How many bytes of a log file one process parses at a time
+    :return The number of events marked
+    """
+    if bitmapist.id_mapper is not None or bitmapist.use_script:
+        raise ValueError('backfill does not support id_mapper or use_script')
+
+    options = {
+        'prefix': bitmapist.prefix,
+        'divider': bitmapist.divider,
+        'rollup': bitmapist.rollup,
+        'hash_tag': bitmapist.hash_tag,
+        'fields': (event_field, uuid_field, time_field),
+        'granularities': (month, week, day, hour),
+    }
+    tasks = [(path, start, end, options) for path in paths
+             for start, end in _split_file(path, chunk_size)]
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(tasks) <= 1:
+        results = map(_build_bitsets, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        results = pool.imap_unordered(_build_bitsets, tasks)
+
+    marked = 0
+    try:
+        for bitsets, event_names, task_marked in results:
+            _write_bitsets(bitmapist, bitsets, event_names)
+            marked += task_marked
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return marked
+
+
+#--- Private ----------------------------------------------
+_WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+# How many zero bytes a bitset spans before it is split in two pieces
+_MAX_GAP_BYTES = 1024
+
+
+def _split_file(path, chunk_size):
+    """
+    Returns `(start, end)` byte ranges covering the file at `path`. A range parses
+    the lines that start within it, so lines split across ranges are read once.
+    """
+    size = os.path.getsize(path)
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def _iter_lines(path, start, end):
+    """
+    Yields the lines of the file at `path` that start between `start` and `end`.
+    """
+    with open(path, 'rb') as log:
+        if start:
+            log.seek(start - 1)
+            log.readline()
+        while log.tell() < end:
+            line = log.readline()
+            if not line:
+                break
+            yield line
+
+
+def _iter_events(path, start, end, fields):
+    """
+    Yields the `(event_name, uuid, time)` of the events logged in a byte range.
+    """
+    event_field, uuid_field, time_field = fields
+    is_csv = path.endswith('.csv')
+    if is_csv:
+        with open(path, 'rb') as log:
+            header = next(csv.reader([_to_text(log.readline())]))
+
+    skip_header = is_csv and not start
+    for line in _iter_lines(path, start, end):
+        if skip_header:
+            skip_header = False
+            continue
+        line = _to_text(line)
+        if not line.strip():
+            continue
+
+        try:
+            if is_csv:
+                record = dict(zip(header, next(csv.reader([line]))))
+            else:
+                record = json.loads(line)
+            yield record[event_field], int(record[uuid_field]), _parse_time(record[time_field])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Cannot read the event %r in %s' % (line.strip(), path))
+
+
+def _build_bitsets(task):
+    """
+    Parses a byte range of a log file and returns its bitsets as
+    `{redis_key: [(first_byte, data), ...]}`, its event names and its number of events.
+    """
+    path, start, end, options = task
+    bitmapist = Bitmapist(None, prefix=options['prefix'], divider=options['divider'],
+                          rollup=options['rollup'], hash_tag=options['hash_tag'])
+    month, week, day, hour = options['granularities']
+
+    offsets = {}
+    event_names = set()
+    marked = 0
+    for event_name, uuid, now in _iter_events(path, start, end, options['fields']):
+        for obj, _ in bitmapist._get_event_targets(event_name, now, month, week, day, hour):
+            offsets.setdefault(obj.redis_key, []).append(uuid)
+        event_names.add(event_name)
+        marked += 1
+
+    bitsets = {}
+    for redis_key, uuids in offsets.items():
+        bitsets[redis_key] = [_pack_bits(piece) for piece in _split_sparse(sorted(uuids))]
+    return bitsets, event_names, marked
+
+
+def _split_sparse(uuids):
+    """
+    Splits sorted `uuids` wherever more than `_MAX_GAP_BYTES` bytes of zeros would
+    separate two of them, so a bitset never takes much more memory than its events,
+    however far apart the uuids of a range are.
+    """
+    piece = []
+    for uuid in uuids:
+        if piece and uuid // 8 - piece[-1] // 8 > _MAX_GAP_BYTES:
+            yield piece
+            piece = []
+        piece.append(uuid)
+    if piece:
+        yield piece
+
+
+def _pack_bits(uuids):
+    """
+    Returns `(first_byte, data)` with the bits of sorted `uuids` set.
+    """
+    first_byte = uuids[0] // 8
+    data = bytearray(uuids[-1] // 8 - first_byte + 1)
+    for uuid in uuids:
+        data[uuid // 8 - first_byte] |= 0x80 >> (uuid % 8)
+    return first_byte, bytes(data)
+
+
+def _write_bitsets(bitmapist, bitsets, event_names):
+    batch = {}
+    queued_bytes = 0
+    for redis_key, pieces in bitsets.items():
+        batch[redis_key] = pieces
+        queued_bytes += sum(len(data) for _, data in pieces)
+        if queued_bytes >= _WRITE_BATCH_BYTES:
+            bitmapist._write_bitsets(batch)
+            batch = {}
+            queued_bytes = 0
+    if batch:
+        bitmapist._write_bitsets(batch)
+
+    with bitmapist.redis_client.pipeline(transaction=False) as p:
+        for event_name in event_names:
+            bitmapist._register_name(p, 'ev', event_name)
+        p.execute()
+
+
+def _parse_time(value):
+    """
+    Parses a UTC time given as a Unix timestamp or in ISO 8601.
+    """
+    if isinstance(value, numbers.Real):
+        return datetime.utcfromtimestamp(value)
+    value = value.strip()
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d')
+    return datetime.strptime(value[:19].replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S')
+
+
+def _to_text(line):
+    if isinstance(line, str):
+        return line
+    return line.decode('utf-8')
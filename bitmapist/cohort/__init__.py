@@ -68,10 +68,14 @@ Get the data and render it via HTML::
 from os import path
 
 from datetime import datetime, timedelta
+from uuid import uuid4
 from dateutil.relativedelta import relativedelta
 
 from mako.lookup import TemplateLookup
 
+from bitmapist import (_fetch_all, _get_segment_sets, _hash_slot_key, _instrumented,
+                       _materialize_all, _same_slot, _segment_key)
+
 
 #--- HTML rendering ----------------------------------------------
 def render_html_form(action_url, selections1, selections2,
@@ -119,6 +123,7 @@ class Cohort(object):
     def __init__(self, bitmapist_client):
         self.bitmapist_client = bitmapist_client
 
+    @_instrumented
     def get_dates_data(self, select1, select2,
                        time_group='days',
                        as_percent=True):
@@ -130,6 +135,10 @@ class Cohort(object):
         :param :time_group What is the data grouped by? Can be `days`, `weeks` or `months`
         :param :as_percent If `True` then percents as calculated and shown. Defaults to `True`
         :return A list of day data, formated like `[[datetime, count], ...]`
+
+        The whole table is computed in two pipelined round trips: one counting
+        the rows and checking which columns have events, and one intersecting
+        every cell that can be non-empty.
         """
         # Days
         if time_group == 'days':
@@ -154,34 +163,46 @@ class Cohort(object):
             now -= timedelta(days=now.day - 1)
             timedelta_inc = lambda m: relativedelta(months=m)
 
-        dates = []
-
+        # Plan the whole table up front
+        rows = []
         for i in range(0, date_range):
-            result = [now]
+            row_now = now + timedelta_inc(i)
+            columns = [fn_get_events(select2, row_now + timedelta_inc(d_delta))
+                       for d_delta in range(0, 13)]
+            rows.append((row_now, fn_get_events(select1, row_now), columns))
+
+        row_counts, marked_keys = self._get_totals(rows)
+
+        # Intersect every cell that can be non-empty in one pipeline,
+        # reusing a single scratch key
+        cells = []
+        for _, row_events, columns in rows:
+            if not row_counts[row_events.redis_key]:
+                continue
+            for delta_events in columns:
+                if delta_events.redis_key in marked_keys:
+                    cells.append((row_events.redis_key, delta_events.redis_key))
+        cell_counts = self._get_intersection_counts(cells)
 
-            # Total count
-            day_events = fn_get_events(select1, now)
+        dates = []
+        for row_now, row_events, columns in rows:
+            result = [row_now]
 
-            total_day_count = len(day_events)
+            # Total count
+            total_day_count = row_counts[row_events.redis_key]
             result.append(total_day_count)
 
             # Daily count
-            for d_delta in range(0, 13):
+            for delta_events in columns:
                 if total_day_count == 0:
                     result.append('')
                     continue
 
-                delta_now = now + timedelta_inc(d_delta)
-
-                delta_events = fn_get_events(select2, delta_now)
-
-                if not delta_events.has_events_marked():
+                if delta_events.redis_key not in marked_keys:
                     result.append('')
                     continue
 
-                day_set_op = self.bitmapist_client.bit_op_and(day_events, delta_events)
-
-                delta_count = len(day_set_op)
+                delta_count = cell_counts[(row_events.redis_key, delta_events.redis_key)]
                 if delta_count == 0:
                     result.append(float(0.0))
                 else:
@@ -192,10 +213,144 @@ class Cohort(object):
 
             dates.append(result)
 
-            now = now + timedelta_inc(1)
-
         return dates
 
+    def _get_totals(self, rows):
+        """
+        Counts every row bitmap and checks which column bitmaps exist, in one round trip.
+        Returns the counts by key and the set of existing column keys.
+        """
+        bitmaps = {}
+        for _, row_events, columns in rows:
+            bitmaps[row_events.redis_key] = row_events
+            for delta_events in columns:
+                bitmaps[delta_events.redis_key] = delta_events
+        _materialize_all(bitmaps.values())
+
+        row_keys = list(set(row_events.redis_key for _, row_events, _ in rows))
+        column_keys = list(set(delta_events.redis_key
+                               for _, _, columns in rows for delta_events in columns))
+        if self.bitmapist_client.segment_size:
+            return self._get_segmented_totals(row_keys, column_keys)
+
+        with self.bitmapist_client.redis_client.pipeline(transaction=False) as p:
+            for key in row_keys:
+                p.bitcount(key)
+            for key in column_keys:
+                p.exists(key)
+            results = p.execute()
+
+        row_counts = dict(zip(row_keys, results[:len(row_keys)]))
+        marked_keys = set(key for key, exists in zip(column_keys, results[len(row_keys):])
+                          if exists)
+        return row_counts, marked_keys
+
+    def _get_segmented_totals(self, row_keys, column_keys):
+        """
+        Like `_get_totals` for segmented bitmaps, counting the segments of every row.
+        """
+        client = self.bitmapist_client
+        keys = list(set(row_keys) | set(column_keys))
+        segment_sets = dict(zip(keys, _get_segment_sets(client.redis_client, keys)))
+
+        counted = []
+        with client.redis_client.pipeline(transaction=False) as p:
+            for key in row_keys:
+                for segment in segment_sets[key]:
+                    p.bitcount(_segment_key(key, client.divider, segment))
+                    counted.append(key)
+            results = p.execute()
+
+        row_counts = dict((key, 0) for key in row_keys)
+        for key, count in zip(counted, results):
+            row_counts[key] += count
+        marked_keys = set(key for key in column_keys if segment_sets[key])
+        return row_counts, marked_keys
+
+    def _get_intersection_counts(self, cells):
+        """
+        Returns the BITCOUNT of the AND of every `(row_key, column_key)` pair in `cells`.
+        """
+        if not cells:
+            return {}
+        if self.bitmapist_client.segment_size:
+            return self._get_segmented_intersection_counts(cells)
+        return self._count_intersections(cells)
+
+    def _get_segmented_intersection_counts(self, cells):
+        """
+        Intersects the segments every `(row_key, column_key)` pair has in common.
+        """
+        client = self.bitmapist_client
+        keys = list(set(key for cell in cells for key in cell))
+        segment_sets = dict(zip(keys, _get_segment_sets(client.redis_client, keys)))
+
+        segment_cells = []
+        for row_key, column_key in cells:
+            for segment in segment_sets[row_key] & segment_sets[column_key]:
+                segment_cells.append(((row_key, column_key),
+                                      (_segment_key(row_key, client.divider, segment),
+                                       _segment_key(column_key, client.divider, segment))))
+
+        segment_counts = {}
+        if segment_cells:
+            segment_counts = self._count_intersections([pair for _, pair in segment_cells])
+
+        counts = dict((cell, 0) for cell in cells)
+        for cell, pair in segment_cells:
+            counts[cell] += segment_counts[pair]
+        return counts
+
+    def _count_intersections(self, cells):
+        client = self.bitmapist_client
+        if client.cluster:
+            return self._get_cluster_intersection_counts(cells)
+
+        scratch_key = client.divider.join([client.prefix, 'bitop', 'tmp', uuid4().hex])
+
+        with client.redis_client.pipeline(transaction=False) as p:
+            for row_key, column_key in cells:
+                p.bitop('AND', scratch_key, row_key, column_key)
+                p.bitcount(scratch_key)
+            p.delete(scratch_key)
+            results = p.execute()
+
+        return dict(zip(cells, results[1:-1:2]))
+
+    def _get_cluster_intersection_counts(self, cells):
+        """
+        Like `_get_intersection_counts`, but with one scratch key per hash slot.
+        Cells whose bitmaps live in different slots are intersected client-side.
+        """
+        client = self.bitmapist_client
+        remote_cells = [cell for cell in cells if _same_slot(cell)]
+        local_cells = [cell for cell in cells if not _same_slot(cell)]
+
+        counts = {}
+        if remote_cells:
+            scratch_keys = {}
+            with client.redis_client.pipeline(transaction=False) as p:
+                for row_key, column_key in remote_cells:
+                    slot_tag = '{%s}' % _hash_slot_key(row_key)
+                    scratch_key = scratch_keys.get(slot_tag)
+                    if scratch_key is None:
+                        scratch_key = scratch_keys[slot_tag] = client.divider.join(
+                            [client.prefix, 'bitop', slot_tag, 'tmp', uuid4().hex])
+                    p.bitop('AND', scratch_key, row_key, column_key)
+                    p.bitcount(scratch_key)
+                for scratch_key in scratch_keys.values():
+                    p.delete(scratch_key)
+                results = p.execute()
+            counts.update(zip(remote_cells, results[1:2 * len(remote_cells):2]))
+
+        if local_cells:
+            keys = list(set(key for cell in local_cells for key in cell))
+            bitmaps = dict(zip(keys, _fetch_all(client.redis_client, keys)))
+            for row_key, column_key in local_cells:
+                counts[(row_key, column_key)] = len(bitmaps[row_key] & bitmaps[column_key])
+
+        return counts
+
 
 _LOOKUP = None
 
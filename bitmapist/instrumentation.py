@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+bitmapist.instrumentation
+~~~~~~~~~~~~~~~~~~~~~~~~~
+Measures what public bitmapist calls cost: wall time, Redis round trips,
+commands and payload bytes.
+
+Pass an `Instrumentation` to `Bitmapist`. Its Redis client is then wrapped
+in a proxy that counts every command and pipeline, and each call to a public
+method of the `Bitmapist`, of the bitmaps it returns or of a `Cohort` over it
+is recorded once, with everything it sent to Redis, including the work of
+the public methods it calls in turn.
+
+Example::
+
+    from bitmapist import Bitmapist, Instrumentation
+
+    instrumentation = Instrumentation()
+    instrumentation.add_callback(
+        lambda call: statsd.timing('bitmapist.' + call.name, call.duration * 1000))
+    bm = Bitmapist(redis_client, instrumentation=instrumentation)
+
+    bm.get_month_event('active', now).get_count()
+    print instrumentation.snapshot()['MonthEvents.get_count']['round_trips']
+"""
+
+import functools
+import numbers
+import threading
+import time
+
+
+class Instrumentation(object):
+    """
+    Records instrumented calls, hands each of them to the callbacks
+    and aggregates them per call name.
+
+    :param :callbacks Functions called with every finished `InstrumentedCall`
+    :param :histogram_bounds Upper bounds, in seconds, of the latency histogram buckets.
+                             Slower calls fall in a last, unbounded bucket
+    """
+
+    HISTOGRAM_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, callbacks=(), histogram_bounds=None):
+        self.callbacks = list(callbacks)
+        self.histogram_bounds = tuple(histogram_bounds or self.HISTOGRAM_BOUNDS)
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def snapshot(self):
+        """
+        Returns the aggregates per call name, e.g.::
+
+            {'MonthEvents.get_count': {
+                'calls': 2, 'errors': 0, 'duration': 0.0004, 'max_duration': 0.0003,
+                'round_trips': 2, 'commands': 2, 'bytes_sent': 52, 'bytes_received': 2,
+                'histogram': [(0.0005, 2), (0.001, 0), ..., (None, 0)]}}
+
+        The histogram counts calls per latency bucket, each bucket given by its upper bound.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, stats in self._stats.items():
+                snapshot[name] = dict(stats)
+                snapshot[name]['histogram'] = list(zip(self.histogram_bounds + (None,),
+                                                       stats['histogram']))
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _get_current_call(self):
+        return getattr(self._local, 'call', None)
+
+    def _record(self, call):
+        with self._lock:
+            stats = self._stats.get(call.name)
+            if stats is None:
+                stats = self._stats[call.name] = {
+                    'calls': 0, 'errors': 0, 'duration': 0.0, 'max_duration': 0.0,
+                    'round_trips': 0, 'commands': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                    'histogram': [0] * (len(self.histogram_bounds) + 1),
+                }
+            stats['calls'] += 1
+            stats['errors'] += call.error is not None
+            stats['duration'] += call.duration
+            stats['max_duration'] = max(stats['max_duration'], call.duration)
+            for counter in ('round_trips', 'commands', 'bytes_sent', 'bytes_received'):
+                stats[counter] += getattr(call, counter)
+
+            bucket = len(self.histogram_bounds)
+            for index, bound in enumerate(self.histogram_bounds):
+                if call.duration <= bound:
+                    bucket = index
+                    break
+            stats['histogram'][bucket] += 1
+
+        for callback in self.callbacks:
+            callback(call)
+
+
+class InstrumentedCall(object):
+    """
+    What one call to a public method cost. `bytes_sent` and `bytes_received`
+    count the arguments and replies of its commands, not the protocol framing.
+    `error` is the exception the call raised, if any.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.round_trips = 0
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<InstrumentedCall %s %.6fs %d round trips %d commands>' % (
+            self.name, self.duration, self.round_trips, self.commands)
+
+
+def _instrumented(method):
+    """
+    Records calls to `method` with the instrumentation of the object's Redis client,
+    named `ClassName.method`. Calls made while another instrumented call is running
+    in the same thread count towards that outer call only.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = _get_instrumentation(self)
+        if instrumentation is None or instrumentation._get_current_call() is not None:
+            return method(self, *args, **kwargs)
+
+        call = InstrumentedCall('%s.%s' % (type(self).__name__, method.__name__))
+        instrumentation._local.call = call
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            call.duration = time.time() - start
+            instrumentation._local.call = None
+            instrumentation._record(call)
+    return wrapper
+
+
+def _get_instrumentation(obj):
+    client = getattr(obj, 'redis_client', None)
+    if client is None:
+        client = getattr(getattr(obj, 'bitmapist_client', None), 'redis_client', None)
+    return getattr(client, 'instrumentation', None)
+
+
+class _InstrumentedClient(object):
+    """
+    Wraps a Redis client and counts the commands sent through it towards
+    the current instrumented call.
+    """
+
+    def __init__(self, client, instrumentation):
+        self._client = client
+        self.instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            _count(self.instrumentation, 1, 1, args, result)
+            return result
+        return command
+
+    def pipeline(self, *args, **kwargs):
+        return _InstrumentedPipeline(self._client.pipeline(*args, **kwargs), self.instrumentation)
+
+    def register_script(self, script):
+        return _InstrumentedScript(self._client.register_script(script), self.instrumentation)
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterates with SCAN through the proxy, so every page counts as a round trip.
+        """
+        if hasattr(self._client, 'get_nodes') or not hasattr(self._client, 'scan'):
+            # Cluster clients scan node by node, count the iteration as one round trip
+            for key in self._client.scan_iter(match=match, count=count):
+                yield key
+            _count(self.instrumentation, 1, 1, (match, count), None)
+            return
+
+        cursor = '0'
+        while cursor != 0:
+            cursor, keys = self.scan(cursor=cursor, match=match, count=count)
+            for key in keys:
+                yield key
+
+
+class _InstrumentedPipeline(object):
+
+    def __init__(self, pipe, instrumentation):
+        self._pipe = pipe
+        self.instrumentation = instrumentation
+        self._queued = 0
+        self._queued_bytes = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipe, name)
+        if not callable(attr) or name in ('multi', 'reset'):
+            return attr
+
+        def queue(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            self._queued += 1
+            self._queued_bytes += _payload_size(args)
+            return self if result is self._pipe else result
+        return queue
+
+    def execute(self, *args, **kwargs):
+        queued, queued_bytes = self._queued, self._queued_bytes
+        self._queued = self._queued_bytes = 0
+        results = self._pipe.execute(*args, **kwargs)
+        call = self.instrumentation._get_current_call()
+        if call is not None:
+            call.round_trips += 1
+            call.commands += queued
+            call.bytes_sent += queued_bytes
+            call.bytes_received += _payload_size(results)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._queued = self._queued_bytes = 0
+        self._pipe.reset()
+
+
+class _InstrumentedScript(object):
+
+    def __init__(self, script, instrumentation):
+        self._script = script
+        self.instrumentation = instrumentation
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, _InstrumentedPipeline):
+            client._queued += 1
+            client._queued_bytes += _payload_size((keys, args))
+            return self._script(keys=keys, args=args, client=client._pipe)
+
+        result = self._script(keys=keys, args=args, client=client)
+        _count(self.instrumentation, 1, 1, (keys, args), result)
+        return result
+
+
+def _count(instrumentation, round_trips, commands, args, result):
+    call = instrumentation._get_current_call()
+    if call is not None:
+        call.round_trips += round_trips
+        call.commands += commands
+        call.bytes_sent += _payload_size(args)
+        call.bytes_received += _payload_size(result)
+
+
+def _payload_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(_payload_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_payload_size(key) + _payload_size(item) for key, item in value.items())
+    if isinstance(value, type(u'')):
+        return len(value.encode('utf-8'))
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return len(str(value))
+    return 0
@@ -0,0 +1,727 @@
+# -*- coding: utf-8 -*-
+"""
+bitmapist.local
+~~~~~~~~~~~~~~~
+A local storage backend for bitmapist, for backfills, tests and offline analysis
+without a Redis server.
+
+`LocalRedis` implements the part of the redis-py client API that bitmapist uses,
+with the same semantics for SETBIT, GETBIT, BITCOUNT, BITOP, GETRANGE, SETRANGE
+and BITFIELD. Bitmaps are kept in memory-mapped files under `path`, or in
+process memory when no path is given. Files are opened and mapped when their
+bitmap is used, and only the most recently used ones are kept open. Sets,
+hashes and sorted sets, like the name registry, are kept in memory and saved
+next to the bitmaps by `flush`.
+
+Lua scripts are not supported, so `use_script`, `cache_bit_ops`,
+`temp_memory_budget` and `IdMapper` need a Redis server.
+
+Example::
+
+    from bitmapist import Bitmapist
+    from bitmapist.local import LocalRedis
+
+    local = LocalRedis('/data/bitmaps')
+    bm = Bitmapist(local)
+    for user_id, now in history:
+        bm.mark_event('active', user_id, now=now)
+
+    local.push_to_redis(redis.Redis('localhost', 6379))
+    local.close()
+"""
+
+import json
+import mmap
+import os
+import threading
+import time
+
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from datetime import timedelta
+from fnmatch import fnmatchcase
+from hashlib import sha1
+from uuid import uuid4
+
+from redis.exceptions import ResponseError
+
+from bitmapist import LocalBitmap, _chunks, _version_key, _version_token
+
+
+class LocalRedis(object):
+    """
+    A redis-py compatible client storing everything locally.
+
+    :param :path A directory for the bitmap files and the index of keys, created if needed.
+                 Keys saved there by an earlier `flush` are loaded again.
+                 Defaults to keeping everything in memory
+    :param :max_open_files How many bitmap files are kept open and mapped at once.
+                           The least recently used one is closed to open another
+    """
+
+    def __init__(self, path=None, max_open_files=256):
+        self.path = path
+        self._open_files = _OpenFiles(max_open_files)
+        self._strings = {}
+        self._sets = {}
+        self._hashes = {}
+        self._zsets = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._load()
+
+    #--- Strings ----------------------------------------------
+    def get(self, name):
+        string = self._get_value(name, self._strings)
+        return None if string is None else string.read(0, string.length)
+
+    def set(self, name, value):
+        name = _to_bytes(name)
+        self._delete(name)
+        self._get_string(name, create=True).write(0, _to_bytes(value))
+        return True
+
+    def strlen(self, name):
+        string = self._get_value(name, self._strings)
+        return 0 if string is None else string.length
+
+    def getrange(self, key, start, end):
+        string = self._get_value(key, self._strings)
+        if string is None:
+            return b''
+        start, end = _byte_range(string.length, start, end)
+        if start > end:
+            return b''
+        return string.read(start, end + 1)
+
+    def setrange(self, name, offset, value):
+        value = _to_bytes(value)
+        if not value:
+            return self.strlen(name)
+        string = self._get_string(name, create=True)
+        string.write(offset, value)
+        return string.length
+
+    def setbit(self, name, offset, value):
+        string = self._get_string(name, create=True)
+        index, mask = offset // 8, 0x80 >> (offset % 8)
+        byte = string.get_byte(index)
+        string.set_byte(index, byte | mask if int(value) else byte & ~mask)
+        return 1 if byte & mask else 0
+
+    def getbit(self, name, offset):
+        string = self._get_value(name, self._strings)
+        if string is None:
+            return 0
+        return 1 if string.get_byte(offset // 8) & (0x80 >> (offset % 8)) else 0
+
+    def bitcount(self, key, start=None, end=None):
+        data = self.get(key) if start is None else self.getrange(key, start, end)
+        return LocalBitmap(data or b'').get_count()
+
+    def bitop(self, operation, dest, *keys):
+        bitmaps = [LocalBitmap(self.get(key) or b'') for key in keys]
+        operation = operation.upper()
+        if operation == 'NOT':
+            if len(bitmaps) != 1:
+                raise ResponseError('BITOP NOT must be called with a single source key.')
+            result = ~bitmaps[0]
+        else:
+            result = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                if operation == 'AND':
+                    result = result & bitmap
+                elif operation == 'OR':
+                    result = result | bitmap
+                elif operation == 'XOR':
+                    result = result ^ bitmap
+                else:
+                    raise ResponseError('syntax error')
+
+        if not result.data:
+            self.delete(dest)
+            return 0
+        self.set(dest, bytes(result.data))
+        return len(result.data)
+
+    def bitfield(self, key, *args):
+        """
+        Supports the GET and SET subcommands on single bits (`u1`).
+        """
+        results = []
+        args = list(args)
+        while args:
+            subcommand = _to_text(args.pop(0)).upper()
+            field_type, offset = _to_text(args.pop(0)), int(args.pop(0))
+            if field_type != 'u1':
+                raise ResponseError('LocalRedis only supports BITFIELD on u1 fields')
+            if subcommand == 'GET':
+                results.append(self.getbit(key, offset))
+            elif subcommand == 'SET':
+                results.append(self.setbit(key, offset, int(args.pop(0))))
+            else:
+                raise ResponseError('LocalRedis only supports BITFIELD GET and SET')
+        return results
+
+    #--- Sets, hashes and sorted sets ----------------------------------------------
+    def sadd(self, name, *values):
+        members = self._get_container(name, self._sets, set)
+        before = len(members)
+        members.update(_to_bytes(value) for value in values)
+        return len(members) - before
+
+    def srem(self, name, *values):
+        members = self._get_value(name, self._sets)
+        if members is None:
+            return 0
+        before = len(members)
+        members.difference_update(_to_bytes(value) for value in values)
+        if not members:
+            self._delete(_to_bytes(name))
+        return before - len(members)
+
+    def smembers(self, name):
+        return set(self._get_value(name, self._sets) or ())
+
+    def sismember(self, name, value):
+        return _to_bytes(value) in (self._get_value(name, self._sets) or ())
+
+    def hset(self, name, key, value):
+        fields = self._get_container(name, self._hashes, dict)
+        key = _to_bytes(key)
+        created = key not in fields
+        fields[key] = _to_bytes(value)
+        return int(created)
+
+    def hget(self, name, key):
+        return (self._get_value(name, self._hashes) or {}).get(_to_bytes(key))
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (list, tuple)):
+            keys = list(keys) + list(args)
+        else:
+            keys = [keys] + list(args)
+        return [self.hget(name, key) for key in keys]
+
+    def hgetall(self, name):
+        return dict(self._get_value(name, self._hashes) or {})
+
+    def hincrby(self, name, key, amount=1):
+        fields = self._get_container(name, self._hashes, dict)
+        key = _to_bytes(key)
+        value = int(fields.get(key, 0)) + amount
+        fields[key] = _to_bytes(value)
+        return value
+
+    def zadd(self, name, mapping):
+        scores = self._get_container(name, self._zsets, dict)
+        added = 0
+        for member, score in mapping.items():
+            member = _to_bytes(member)
+            added += member not in scores
+            scores[member] = float(score)
+        return added
+
+    def zrem(self, name, *values):
+        scores = self._get_value(name, self._zsets)
+        if scores is None:
+            return 0
+        removed = sum(scores.pop(_to_bytes(value), None) is not None for value in values)
+        if not scores:
+            self._delete(_to_bytes(name))
+        return removed
+
+    def zremrangebyscore(self, name, min, max):
+        scores = self._get_value(name, self._zsets)
+        if scores is None:
+            return 0
+        in_range = _score_range(min, max)
+        members = [member for member, score in scores.items() if in_range(score)]
+        for member in members:
+            del scores[member]
+        if not scores:
+            self._delete(_to_bytes(name))
+        return len(members)
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        scores = self._get_value(name, self._zsets) or {}
+        members = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=desc)
+        start, end = _byte_range(len(members), start, end)
+        members = members[start:end + 1] if start <= end else []
+        if withscores:
+            return members
+        return [member for member, _ in members]
+
+    #--- Keys ----------------------------------------------
+    def delete(self, *names):
+        return sum(self._delete(_to_bytes(name)) for name in names)
+
+    unlink = delete
+
+    def exists(self, *names):
+        return sum(1 for name in names if self._type(_to_bytes(name)) is not None)
+
+    def type(self, name):
+        return (self._type(_to_bytes(name)) or 'none').encode('ascii')
+
+    def expire(self, name, time):
+        name = _to_bytes(name)
+        if self._type(name) is None:
+            return False
+        if isinstance(time, timedelta):
+            time = int(time.total_seconds())
+        self._expires[name] = _now() + time
+        return True
+
+    def pexpire(self, name, time):
+        if isinstance(time, timedelta):
+            time = int(time.total_seconds() * 1000)
+        return self.expire(name, time / 1000.0)
+
+    def ttl(self, name):
+        name = _to_bytes(name)
+        if self._type(name) is None:
+            return -2
+        if name not in self._expires:
+            return -1
+        return max(int(round(self._expires[name] - _now())), 0)
+
+    def pttl(self, name):
+        name = _to_bytes(name)
+        if self._type(name) is None:
+            return -2
+        if name not in self._expires:
+            return -1
+        return max(int(round((self._expires[name] - _now()) * 1000)), 0)
+
+    def scan_iter(self, match=None, count=None):
+        for name in list(self._all_keys()):
+            if self._type(name) is None:
+                continue
+            if match is None or fnmatchcase(name, _to_bytes(match)):
+                yield name
+
+    def flushdb(self):
+        for name in list(self._all_keys()):
+            self._delete(name)
+        return True
+
+    #--- Client ----------------------------------------------
+    def execute_command(self, *args, **options):
+        command = _to_text(args[0]).upper()
+        if command == 'ZADD':
+            pairs = args[2:]
+            return self.zadd(args[1], dict(zip(pairs[1::2], pairs[0::2])))
+        method = getattr(self, command.lower(), None)
+        if method is None or command.startswith('_'):
+            raise ResponseError("unknown command '%s'" % command)
+        return method(*args[1:])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LocalPipeline(self)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        raise ResponseError('LocalRedis does not run Lua scripts')
+
+    def register_script(self, script):
+        raise ResponseError('LocalRedis does not run Lua scripts')
+
+    def flush(self):
+        """
+        Writes the bitmap files to disk and saves the index of keys,
+        so the data can be opened again with `LocalRedis(path)`.
+        """
+        if self.path is None:
+            return
+        self._purge_expired()
+        for string in self._strings.values():
+            string.flush()
+
+        index = {
+            'strings': dict((_hex(name), string.length)
+                            for name, string in self._strings.items()),
+            'sets': dict((_hex(name), [_hex(member) for member in members])
+                         for name, members in self._sets.items()),
+            'hashes': dict((_hex(name), dict((_hex(key), _hex(value))
+                                             for key, value in fields.items()))
+                           for name, fields in self._hashes.items()),
+            'zsets': dict((_hex(name), dict((_hex(member), score)
+                                            for member, score in scores.items()))
+                          for name, scores in self._zsets.items()),
+            'expires': dict((_hex(name), deadline)
+                            for name, deadline in self._expires.items()),
+        }
+        index_path = os.path.join(self.path, 'index.json')
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(index_path + '.tmp', index_path)
+
+    def close(self):
+        self.flush()
+        for string in self._strings.values():
+            string.close()
+        self._strings = {}
+
+    def push_to_redis(self, redis_client, match='*', merge=False, chunk_size=1024 * 1024,
+                      prefix='trackist', divider=':'):
+        """
+        Copies every key matching `match` to `redis_client`, with their TTLs.
+        Bitmaps are sent `chunk_size` bytes per SETRANGE in non-transactional
+        pipelines, so a large bitmap never travels as a single command.
+        Every bitmap pushed gets a new version token, so results cached by
+        a `Bitmapist` with `cache_bit_ops` and the same `prefix` and `divider`
+        are recomputed.
+
+        :param :merge If `True`, bitmaps are OR-ed into the ones already in Redis
+                      and set members and hash fields are added to the existing ones.
+                      Otherwise existing keys are replaced
+        :return The number of keys pushed
+        """
+        pushed = 0
+        queued_bytes = 0
+        version_prefix = _to_bytes(_version_key(prefix, divider, ''))
+        p = redis_client.pipeline(transaction=False)
+        for name in self.scan_iter(match=match):
+            kind = self._type(name)
+            if name.startswith(version_prefix):
+                continue
+            if not merge:
+                p.delete(name)
+
+            if kind == 'string':
+                target = name
+                if merge:
+                    target = name + b':push:' + uuid4().hex.encode('ascii')
+                length = self.strlen(name)
+                for offset in range(0, length, chunk_size):
+                    chunk = self.getrange(name, offset, offset + chunk_size - 1)
+                    p.setrange(target, offset, chunk)
+                    queued_bytes += len(chunk)
+                    if queued_bytes >= chunk_size:
+                        p.execute()
+                        queued_bytes = 0
+                if merge:
+                    p.bitop('OR', name, name, target)
+                    p.delete(target)
+            elif kind == 'set':
+                for members in _chunks(sorted(self._sets[name]), 1000):
+                    p.sadd(name, *members)
+            elif kind == 'hash':
+                for key, value in self._hashes[name].items():
+                    p.hset(name, key, value)
+            elif kind == 'zset':
+                for pairs in _chunks(sorted(self._zsets[name].items()), 1000):
+                    args = []
+                    for member, score in pairs:
+                        args.extend([score, member])
+                    p.execute_command('ZADD', name, *args)
+
+            ttl = self.ttl(name)
+            if ttl >= 0:
+                p.expire(name, max(ttl, 1))
+            if kind == 'string':
+                version_key = version_prefix + name
+                p.set(version_key, _version_token())
+                if ttl >= 0:
+                    p.expire(version_key, max(ttl, 1))
+            pushed += 1
+
+        p.execute()
+        return pushed
+
+    #--- Private ----------------------------------------------
+    def _all_keys(self):
+        for store in (self._strings, self._sets, self._hashes, self._zsets):
+            for name in store:
+                yield name
+
+    def _type(self, name):
+        deadline = self._expires.get(name)
+        if deadline is not None and deadline <= _now():
+            self._delete(name)
+            return None
+        for kind, store in (('string', self._strings), ('set', self._sets),
+                            ('hash', self._hashes), ('zset', self._zsets)):
+            if name in store:
+                return kind
+        return None
+
+    def _get_value(self, name, store):
+        name = _to_bytes(name)
+        kind = self._type(name)
+        if kind is None:
+            return None
+        if name not in store:
+            raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return store[name]
+
+    def _get_container(self, name, store, factory):
+        value = self._get_value(name, store)
+        if value is None:
+            value = store[_to_bytes(name)] = factory()
+        return value
+
+    def _get_string(self, name, create=False):
+        string = self._get_value(name, self._strings)
+        if string is None and create:
+            name = _to_bytes(name)
+            file_path = None
+            if self.path is not None:
+                file_path = os.path.join(self.path, sha1(name).hexdigest() + '.bin')
+            string = self._strings[name] = _GrowableString(file_path, open_files=self._open_files)
+        return string
+
+    def _delete(self, name):
+        self._expires.pop(name, None)
+        string = self._strings.pop(name, None)
+        if string is not None:
+            string.remove()
+            return 1
+        for store in (self._sets, self._hashes, self._zsets):
+            if store.pop(name, None) is not None:
+                return 1
+        return 0
+
+    def _purge_expired(self):
+        for name in list(self._expires):
+            self._type(name)
+
+    def _load(self):
+        index_path = os.path.join(self.path, 'index.json')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+
+        for name, length in index['strings'].items():
+            name = unhexlify(name)
+            self._strings[name] = _GrowableString(
+                os.path.join(self.path, sha1(name).hexdigest() + '.bin'), length, self._open_files)
+        for name, members in index['sets'].items():
+            self._sets[unhexlify(name)] = set(unhexlify(member) for member in members)
+        for name, fields in index['hashes'].items():
+            self._hashes[unhexlify(name)] = dict((unhexlify(key), unhexlify(value))
+                                                 for key, value in fields.items())
+        for name, scores in index['zsets'].items():
+            self._zsets[unhexlify(name)] = dict((unhexlify(member), score)
+                                                for member, score in scores.items())
+        for name, deadline in index['expires'].items():
+            self._expires[unhexlify(name)] = deadline
+
+
+class LocalPipeline(object):
+    """
+    Queues commands for a `LocalRedis` and runs them in order, under one lock,
+    when `execute` is called.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def multi(self):
+        pass
+
+    def execute(self, raise_on_error=True):
+        commands, self._commands = self._commands, []
+        results = []
+        with self._client._lock:
+            for method, args, kwargs in commands:
+                try:
+                    results.append(method(*args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+        return results
+
+    def reset(self):
+        self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+
+class _OpenFiles(object):
+    """
+    The `_GrowableString`s whose files are open, least recently used first.
+    Opening one more than `max_size` closes the least recently used.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._strings = OrderedDict()
+
+    def touch(self, string):
+        if string in self._strings:
+            del self._strings[string]
+        self._strings[string] = True
+        while len(self._strings) > self.max_size:
+            oldest, _ = self._strings.popitem(last=False)
+            oldest._close_file()
+
+    def discard(self, string):
+        self._strings.pop(string, None)
+
+
+class _GrowableString(object):
+    """
+    A byte string in a memory-mapped file, or in memory without `file_path`.
+    The file grows by doubling, new bytes are zero, and `length` is
+    the logical length of the string. The file is only opened when the
+    string is read or written, and `open_files` may close it again.
+    """
+
+    def __init__(self, file_path=None, length=0, open_files=None):
+        self.file_path = file_path
+        self.length = length
+        self._open_files = open_files
+        self._file = None
+        self._map = None
+        self._data = bytearray()
+        self._capacity = 0
+
+    def read(self, start, end):
+        end = min(end, self.length)
+        if start >= end:
+            return b''
+        return bytes(self._open()[start:end])
+
+    def write(self, offset, data):
+        self._open()
+        self._reserve(offset + len(data))
+        self._data[offset:offset + len(data)] = data
+        self.length = max(self.length, offset + len(data))
+
+    def get_byte(self, index):
+        if index >= self.length:
+            return 0
+        return bytearray(self._open()[index:index + 1])[0]
+
+    def set_byte(self, index, value):
+        self.write(index, bytes(bytearray([value])))
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        if self._open_files is not None:
+            self._open_files.discard(self)
+        self._close_file()
+
+    def remove(self):
+        self.close()
+        if self.file_path is not None and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def _open(self):
+        """
+        Opens and maps the file if needed and returns the buffer holding the string.
+        """
+        if self.file_path is None:
+            return self._data
+        if self._file is None:
+            self._file = open(self.file_path, 'r+b' if os.path.exists(self.file_path) else 'w+b')
+            self._capacity = os.fstat(self._file.fileno()).st_size
+            if self._capacity:
+                self._map = mmap.mmap(self._file.fileno(), self._capacity)
+            self._data = self._map
+        if self._open_files is not None:
+            self._open_files.touch(self)
+        return self._data
+
+    def _close_file(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.file_path is not None:
+            self._data = None
+
+    def _reserve(self, length):
+        if self._file is None:
+            if len(self._data) < length:
+                self._data.extend(bytearray(length - len(self._data)))
+            return
+        if length <= self._capacity:
+            return
+
+        capacity = max(length, self._capacity * 2, mmap.PAGESIZE)
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(capacity)
+        self._map = self._data = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
+
+
+def _byte_range(length, start, end):
+    """
+    Resolves `start` and `end`, inclusive and possibly negative, like GETRANGE.
+    """
+    if start < 0:
+        start = max(start + length, 0)
+    if end < 0:
+        end = max(end + length, 0)
+    return start, min(end, length - 1)
+
+
+def _score_range(min, max):
+    """
+    Returns a predicate for scores between `min` and `max`, given like
+    ZRANGEBYSCORE: numbers, "-inf", "+inf" or "(" followed by an exclusive bound.
+    """
+    def parse(bound):
+        bound = _to_text(_to_bytes(bound))
+        if bound.startswith('('):
+            return float(bound[1:]), True
+        return float(bound), False
+
+    (low, low_open), (high, high_open) = parse(min), parse(max)
+
+    def in_range(score):
+        if score < low or (low_open and score == low):
+            return False
+        return score < high or (not high_open and score == high)
+    return in_range
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (int, float)) or type(value).__name__ == 'long':
+        value = repr(value) if isinstance(value, float) else str(value)
+    return value.encode('utf-8')
+
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _hex(value):
+    return hexlify(value).decode('ascii')
+
+
+_now = time.time
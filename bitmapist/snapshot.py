@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+bitmapist.snapshot
+~~~~~~~~~~~~~~~~~~
+Exports bitmaps to a compressed file and imports them again, to move
+events between Redis instances or archive old months.
+
+Keys are found with SCAN and read with GETRANGE in chunks, so no single
+command blocks the server for long, and the file is written as it goes.
+Each chunk is stored raw, as the positions of its set bits (sparse) or
+as runs of equal bytes (RLE), whichever suits its density, and the file
+is gzip compressed. Imports write the chunks back with SETRANGE in
+pipelines.
+
+Plain and segmented bitmaps are exported with their TTLs. Other keys,
+like the name registry, are skipped; run `Bitmapist.rebuild_name_registry`
+after an import.
+
+Example::
+
+    from bitmapist.snapshot import export_snapshot, import_snapshot
+
+    export_snapshot(redis_client, 'active-2012-10.bms', 'trackist:ev:active:2012-10*')
+    import_snapshot(other_redis_client, 'active-2012-10.bms')
+"""
+
+import gzip
+import re
+import struct
+
+from uuid import uuid4
+
+from bitmapist import LocalBitmap, _hash_slot_key, _iter_set_bits, _version_key, _version_token
+
+
+def export_snapshot(redis_client, path, match='*', chunk_size=64 * 1024, scan_count=1000):
+    """
+    Writes every bitmap whose key matches `match` to the snapshot file at `path`.
+
+    :param :chunk_size The number of bytes read per GETRANGE
+    :return The number of keys exported
+    """
+    exported = 0
+    with gzip.open(path, 'wb') as snapshot:
+        snapshot.write(_MAGIC)
+        for key in redis_client.scan_iter(match=match, count=scan_count):
+            p = redis_client.pipeline(transaction=False)
+            p.type(key)
+            p.ttl(key)
+            kind, ttl = p.execute()
+            kind = _to_bytes(kind)
+            if kind not in (b'string', b'set'):
+                continue
+            if ttl is None or ttl < 0:
+                ttl = -1
+
+            snapshot.write(b'K' + _pack_bytes(_to_bytes(key)) + struct.pack('>q', ttl))
+            if kind == b'set':
+                snapshot.write(b'S')
+                for member in sorted(redis_client.smembers(key)):
+                    snapshot.write(b'M' + _pack_bytes(_to_bytes(member)))
+            else:
+                snapshot.write(b'B')
+                for offset in range(0, redis_client.strlen(key), chunk_size):
+                    data = redis_client.getrange(key, offset, offset + chunk_size - 1)
+                    encoding, payload = _encode_chunk(data)
+                    snapshot.write(b'C' + struct.pack('>QIcI', offset, len(data), encoding, len(payload)))
+                    snapshot.write(payload)
+            exported += 1
+        snapshot.write(b'E')
+    return exported
+
+
+def import_snapshot(redis_client, path, merge=False, batch_size=1024 * 1024,
+                    prefix='trackist', divider=':'):
+    """
+    Writes the bitmaps in the snapshot file at `path` to `redis_client`.
+    Every bitmap imported gets a new version token, so results cached by
+    a `Bitmapist` with `cache_bit_ops` and the same `prefix` and `divider`
+    are recomputed. Version keys in the snapshot are skipped.
+
+    :param :merge If `True`, bitmaps are OR-ed into the ones already in Redis,
+                  which keep their TTL. Otherwise existing keys are replaced
+    :param :batch_size Roughly how many bytes are sent per pipeline
+    :return The number of keys imported
+    """
+    imported = 0
+    queued_bytes = 0
+    key = target = ttl = kind = None
+    scratch_written = False
+    finished = []
+    version_prefix = _version_key(prefix, divider, '').encode('utf-8')
+    p = redis_client.pipeline(transaction=False)
+
+    with gzip.open(path, 'rb') as snapshot:
+        if snapshot.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('%s is not a bitmapist snapshot' % path)
+
+        while True:
+            record = _read_exact(snapshot, 1)
+            if record in (b'K', b'E') and key is not None:
+                if target is not None:
+                    finished.append((key, target, ttl, kind))
+                    imported += 1
+                key = None
+
+            if record == b'E':
+                break
+            elif record == b'K':
+                key = _read_bytes(snapshot)
+                ttl, = struct.unpack('>q', _read_exact(snapshot, 8))
+                target = key
+                kind = _read_exact(snapshot, 1)
+                if key.startswith(version_prefix):
+                    target = None
+                elif merge:
+                    target = _scratch_key(key, prefix, divider)
+                    scratch_written = False
+                elif not merge:
+                    p.delete(key)
+            elif record == b'M':
+                member = _read_bytes(snapshot)
+                if target is not None:
+                    p.sadd(target, member)
+                    scratch_written = _queue_scratch_expire(p, key, target, scratch_written)
+            elif record == b'C':
+                offset, length, encoding, payload_length = struct.unpack(
+                    '>QIcI', _read_exact(snapshot, 17))
+                payload = _read_exact(snapshot, payload_length)
+                if target is not None:
+                    p.setrange(target, offset, _decode_chunk(encoding, payload, length))
+                    scratch_written = _queue_scratch_expire(p, key, target, scratch_written)
+                    queued_bytes += length
+            else:
+                raise ValueError('%s is corrupted' % path)
+
+            if queued_bytes >= batch_size or len(finished) >= _MAX_FINISHED_KEYS:
+                _execute(redis_client, p, finished, version_prefix)
+                queued_bytes = 0
+
+    _execute(redis_client, p, finished, version_prefix)
+    return imported
+
+
+#--- Private ----------------------------------------------
+_MAGIC = b'BITMAPIST SNAPSHOT 1\n'
+
+_ENCODING_ZERO = b'Z'
+_ENCODING_RAW = b'R'
+_ENCODING_SPARSE = b'S'
+_ENCODING_RLE = b'L'
+
+_RUNS_RE = re.compile(b'(.)\\1*', re.DOTALL)
+
+
+# How many imported keys are finished per pipeline at most
+_MAX_FINISHED_KEYS = 1000
+
+# How many seconds the scratch key of a merged key may outlive an interrupted import
+_SCRATCH_TTL = 24 * 3600
+
+
+def _execute(redis_client, pipe, finished, version_prefix):
+    """
+    Queues finishing the imported keys in `finished` and executes `pipe`.
+    The TTLs of the keys merged into are read first, since BITOP drops them.
+    """
+    merged = [key for key, target, _, _ in finished if target != key]
+    existing_ttls = {}
+    if merged:
+        with redis_client.pipeline(transaction=False) as ttl_pipe:
+            for key in merged:
+                ttl_pipe.pttl(key)
+            existing_ttls = dict(zip(merged, ttl_pipe.execute()))
+
+    for key, target, ttl, kind in finished:
+        _queue_finish_key(pipe, key, target, ttl, kind, existing_ttls.get(key))
+        if kind == b'B':
+            version_key = version_prefix + key
+            pipe.set(version_key, _version_token())
+            if ttl >= 0:
+                pipe.expire(version_key, max(ttl, 1))
+    del finished[:]
+    pipe.execute()
+
+
+def _queue_finish_key(pipe, key, target, ttl, kind, existing_ttl=None):
+    """
+    Queues merging `target` into `key` if they differ, then restores the TTL
+    of an existing `key` or applies the snapshot's `ttl` to a new one.
+    """
+    if target != key:
+        if kind == b'B':
+            pipe.bitop('OR', key, key, target)
+        else:
+            pipe.sunionstore(key, key, target)
+        pipe.delete(target)
+    if existing_ttl is not None and existing_ttl != -2:
+        if existing_ttl > 0:
+            pipe.pexpire(key, existing_ttl)
+    elif ttl >= 0:
+        pipe.expire(key, max(ttl, 1))
+
+
+def _scratch_key(key, prefix, divider):
+    """
+    Returns a temporary key in the same cluster slot as `key`, among the temporary
+    bit op keys of `prefix`, so `Bitmapist.delete_temporary_bitop_keys` finds it.
+    """
+    slot_key = _hash_slot_key(key.decode('latin-1')).encode('latin-1')
+    return divider.encode('utf-8').join([prefix.encode('utf-8'), b'bitop', b'{' + slot_key + b'}',
+                                         b'tmp', uuid4().hex.encode('ascii')])
+
+
+def _queue_scratch_expire(pipe, key, target, scratch_written):
+    """
+    Queues expiring the scratch key `target` when it is first written, so it does not
+    outlive an interrupted import. Returns whether it has been written.
+    """
+    if target != key and not scratch_written:
+        pipe.expire(target, _SCRATCH_TTL)
+    return True
+
+
+def _encode_chunk(data):
+    """
+    Returns the encoding and the payload for a chunk of bitmap bytes.
+    Set bits are stored as varint deltas when they are rare, runs of
+    equal bytes as (byte, varint length) pairs when they are long,
+    and anything else as is.
+    """
+    count = LocalBitmap(data).get_count()
+    if not count:
+        return _ENCODING_ZERO, b''
+
+    if count * 2 < len(data) // 4:
+        payload = bytearray()
+        previous = 0
+        for bit in _iter_set_bits(data):
+            _write_varint(payload, bit - previous)
+            previous = bit
+        return _ENCODING_SPARSE, bytes(payload)
+
+    runs = [match.span() for match in _RUNS_RE.finditer(data)]
+    if len(runs) * 3 < len(data) // 2:
+        payload = bytearray()
+        data = bytearray(data)
+        for start, end in runs:
+            payload.append(data[start])
+            _write_varint(payload, end - start)
+        return _ENCODING_RLE, bytes(payload)
+
+    return _ENCODING_RAW, data
+
+
+def _decode_chunk(encoding, payload, length):
+    if encoding == _ENCODING_RAW:
+        return payload
+    if encoding == _ENCODING_ZERO:
+        return bytes(bytearray(length))
+
+    data = bytearray(length)
+    payload = bytearray(payload)
+    position = 0
+    if encoding == _ENCODING_SPARSE:
+        bit = 0
+        while position < len(payload):
+            delta, position = _read_varint(payload, position)
+            bit += delta
+            data[bit // 8] |= 0x80 >> (bit % 8)
+    elif encoding == _ENCODING_RLE:
+        start = 0
+        while position < len(payload):
+            byte = payload[position]
+            run, position = _read_varint(payload, position + 1)
+            data[start:start + run] = bytearray([byte]) * run
+            start += run
+    else:
+        raise ValueError('Unknown chunk encoding %r' % encoding)
+    return bytes(data)
+
+
+def _write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(buf, position):
+    value = shift = 0
+    while True:
+        byte = buf[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _pack_bytes(value):
+    return struct.pack('>I', len(value)) + value
+
+
+def _read_bytes(snapshot):
+    length, = struct.unpack('>I', _read_exact(snapshot, 4))
+    return _read_exact(snapshot, length)
+
+
+def _read_exact(snapshot, length):
+    data = snapshot.read(length)
+    if len(data) != length:
+        raise ValueError('Snapshot ends unexpectedly')
+    return data
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
@@ -11,7 +11,7 @@ setup(name='bitmapist-yipit',
       version='2.6.5',
       author="yayalice",
       author_email="alice@yipit.com",
-      install_requires=['redis>=2.7.2.1', 'mako', 'python-dateutil<2.0'],
+      install_requires=['redis>=2.10', 'mako', 'python-dateutil<2.0'],
       dependency_links=['https://github.com/yayalice/redis-py/tarball/master#egg=redis-2.7.2.1'],
       classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -53,7 +53,8 @@ If you want to read more about bitmaps please read following:
 * http://en.wikipedia.org/wiki/Bit_array
 * http://www.slideshare.net/crashlytics/crashlytics-on-redis-analytics
 
-Requires Redis 2.6+ and newest version of redis-py.
+Requires Redis 2.8+ and redis-py 2.10+. Keys are deleted with UNLINK on Redis 4.0+
+and bits are written and read in bulk with BITFIELD on Redis 3.2+.
 
 Examples
 ========
@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio tests use syntax Python 2 cannot parse
+collect_ignore = ['test_aio.py'] if sys.version_info < (3,) else []
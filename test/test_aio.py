@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from datetime import datetime, timedelta
+
+import redis
+import redis.asyncio
+
+from bitmapist import Bitmapist
+from bitmapist.aio import AsyncBitmapist
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_async_mark_and_query():
+    async def scenario():
+        bm = AsyncBitmapist(redis.asyncio.Redis(host='localhost'))
+        Bitmapist(redis.Redis('localhost')).delete_all()
+
+        now = datetime.utcnow()
+        last_month = now - timedelta(days=31)
+
+        await asyncio.gather(*[bm.mark_event('active', uuid, now=now) for uuid in range(10)])
+        await bm.mark_event('active', 3, now=last_month)
+        await bm.mark_attribute('paid_user', [2, 3, 4])
+        await bm.mark_attribute('paid_user', 4, mark_as=0)
+
+        assert await bm.get_month_event('active', now).get_count() == 10
+        assert await bm.get_hour_event('active', now).get_count(2, 5) == 4
+        assert await bm.get_hour_event('active', now).get_count(-14) == 8
+        assert await bm.get_day_event('active', now).contains(9)
+        assert not await bm.get_day_event('active', now).contains(10)
+        assert not await bm.get_day_event('active', last_month - timedelta(days=1)).has_events_marked()
+
+        both = bm.bit_op_and(
+            bm.get_month_event('active', now),
+            bm.bit_op_or(bm.get_month_event('active', last_month), bm.get_attribute('paid_user')),
+        )
+        assert await both.get_count() == 2
+        assert await both.contains(2)
+        assert not await both.contains(4)
+
+        await bm.redis_client.aclose()
+
+    run(scenario())
+
+
+def test_async_exposes_no_sync_methods():
+    bm = AsyncBitmapist(redis.asyncio.Redis(host='localhost'))
+    for name in ('mark_events_bulk', 'get_all_event_names', 'delete_all', 'compact_rollups',
+                 'rebuild_name_registry'):
+        assert not hasattr(bm, name)
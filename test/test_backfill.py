@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+
+from bitmapist import Bitmapist
+from bitmapist.backfill import backfill
+import redis
+
+client = redis.Redis('localhost')
+
+
+def write_logs(path, events):
+    with open(os.path.join(path, 'events.jsonl'), 'w') as log:
+        for event_name, uuid, now in events[::2]:
+            log.write(json.dumps({'event': event_name, 'uuid': uuid,
+                                  'time': now.strftime('%Y-%m-%dT%H:%M:%S')}) + '\n')
+        log.write('\n')
+    with open(os.path.join(path, 'events.csv'), 'w') as log:
+        log.write('time,uuid,event\n')
+        for event_name, uuid, now in events[1::2]:
+            log.write('%d,%d,%s\n' % ((now - datetime(1970, 1, 1)).total_seconds(), uuid, event_name))
+    return [os.path.join(path, 'events.jsonl'), os.path.join(path, 'events.csv')]
+
+
+def test_backfill_matches_mark_event():
+    start = datetime(2012, 10, 1)
+    events = [('active' if i % 3 else 'signup', (i * 37) % 5000, start + timedelta(minutes=i * 17))
+              for i in range(3000)]
+    path = tempfile.mkdtemp()
+    try:
+        paths = write_logs(path, events)
+        bm = Bitmapist(client, prefix='marked')
+        for prefix in ('marked', 'backfilled', 'segmented'):
+            Bitmapist(client, prefix=prefix).delete_all()
+        for event_name, uuid, now in events:
+            bm.mark_event(event_name, uuid, now=now)
+
+        backfilled = Bitmapist(client, prefix='backfilled')
+        month_key = backfilled.get_month_event('signup', start).redis_key
+        client.setbit(month_key, 0, 1)
+        client.expire(month_key, 100000)
+        assert backfill(backfilled, paths, workers=2, chunk_size=10000) == 3000
+        segmented = Bitmapist(client, prefix='segmented', segment_size=1024)
+        assert backfill(segmented, paths, workers=1, day=False, hour=False) == 3000
+
+        for now in (start, start + timedelta(days=20), start + timedelta(days=33, hours=5)):
+            for event_name in ('active', 'signup'):
+                for getter in ('get_month_event', 'get_week_event', 'get_day_event', 'get_hour_event'):
+                    expected = list(getattr(bm, getter)(event_name, now))
+                    assert list(getattr(backfilled, getter)(event_name, now)) == expected
+                    if getter in ('get_month_event', 'get_week_event'):
+                        assert list(getattr(segmented, getter)(event_name, now)) == expected
+
+        # Merging into existing keys keeps their TTL
+        assert 0 < client.ttl(month_key) <= 100000
+        assert sorted(backfilled.get_all_event_names()) == sorted(bm.get_all_event_names())
+        assert not list(client.scan_iter('*:tmp:*'))
+    finally:
+        shutil.rmtree(path)
+
+
+def test_backfill_without_events():
+    path = tempfile.mkdtemp()
+    try:
+        empty_path = os.path.join(path, 'empty.jsonl')
+        open(empty_path, 'w').close()
+        backfilled = Bitmapist(client, prefix='backfilled')
+        assert backfill(backfilled, [], workers=2) == 0
+        assert backfill(backfilled, [empty_path], workers=2) == 0
+    finally:
+        shutil.rmtree(path)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
 
-from bitmapist import Bitmapist, MixinCounts
+from bitmapist import Bitmapist, BufferedBitmapist, IdMapper, Instrumentation, LocalBitmap, _get_range_cover, _key_slot, _same_slot
 import redis
 import time
 
@@ -9,45 +9,8 @@ client = redis.Redis('localhost')
 bm = Bitmapist(client)
 
 
-def test_convert_start_bits_to_btye():
-    counter = MixinCounts()
-    assert counter._convert_to_start_byte(-16) == -2
-    assert counter._convert_to_start_byte(-15) == -1
-    assert counter._convert_to_start_byte(-10) == -1
-    assert counter._convert_to_start_byte(-9) == -1
-    assert counter._convert_to_start_byte(-8) == -1
-    assert counter._convert_to_start_byte(-7) == MixinCounts.ERROR
-    assert counter._convert_to_start_byte(-1) == MixinCounts.ERROR
-    assert counter._convert_to_start_byte(0) == 0
-    assert counter._convert_to_start_byte(1) == 1
-    assert counter._convert_to_start_byte(2) == 1
-    assert counter._convert_to_start_byte(7) == 1
-    assert counter._convert_to_start_byte(8) == 1
-    assert counter._convert_to_start_byte(9) == 2
-    assert counter._convert_to_start_byte(120) == 15
-    assert counter._convert_to_start_byte(122) == 16
-    assert counter._convert_to_start_byte(127) == 16
-    assert counter._convert_to_start_byte(128) == 16
-
-
-def test_convert_end_bits_to_btye():
-    counter = MixinCounts()
-    assert counter._convert_to_end_byte(-10) == -3
-    assert counter._convert_to_end_byte(-9) == -2
-    assert counter._convert_to_end_byte(-8) == -2
-    assert counter._convert_to_end_byte(-7) == -2
-    assert counter._convert_to_end_byte(-2) == -2
-    assert counter._convert_to_end_byte(-1) == -1
-    assert counter._convert_to_end_byte(0) == MixinCounts.ERROR
-    assert counter._convert_to_end_byte(6) == MixinCounts.ERROR
-    assert counter._convert_to_end_byte(7) == 0
-    assert counter._convert_to_end_byte(8) == 0
-    assert counter._convert_to_end_byte(9) == 0
-    assert counter._convert_to_end_byte(14) == 0
-    assert counter._convert_to_end_byte(15) == 1
-    assert counter._convert_to_end_byte(122) == 14
-    assert counter._convert_to_end_byte(127) == 15
-    assert counter._convert_to_end_byte(128) == 15
+def decoded(values):
+    return [value.decode('utf-8') for value in values]
 
 
 def test_mark_event_with_diff_days():
@@ -330,7 +293,7 @@ def test_event_get_count():
 
     assert bm.get_month_event('active', now).get_count() == 0
 
-    for uid in xrange(123, 144):
+    for uid in range(123, 144):
         bm.mark_event('active', uid, now)
     assert bm.get_month_event('active', now).get_count() == 21
     assert bm.get_month_event('active', now).get_count(120, 128) == 6
@@ -348,7 +311,7 @@ def test_set_divider():
     bm2.delete_all()
     bm2.mark_attribute('paiduser', 123)
     assert 'trackist_at_paiduser' in \
-        client.keys()
+        decoded(client.keys())
     bm.delete_all()
 
 
@@ -357,7 +320,7 @@ def test_set_key_prefix():
     bm2.delete_all()
     bm2.mark_attribute('paid_user', 123)
     assert 'HELLO:at:paid_user' in \
-        client.keys()
+        decoded(client.keys())
     bm.delete_all()
 
 
@@ -379,3 +342,893 @@ def test_get_all_attribute_names():
 
     att_names = bm.get_all_attribute_names()
     assert set(['happy', 'sad']) == set(att_names)
+
+
+def test_mark_events_bulk():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    yesterday = now - timedelta(days=1)
+
+    marked = bm.mark_events_bulk([
+        ('active', 123, now),
+        ('active', 123, now),
+        ('active', 23232, yesterday),
+        ('signed-up', 123),
+    ], batch_size=2)
+
+    assert marked == 4
+    assert bm.get_day_event('active', now).get_count() == 1
+    assert bm.get_day_event('active', yesterday).get_count() == 1
+    assert 123 in bm.get_hour_event('signed-up', now)
+    assert 23232 not in bm.get_day_event('signed-up', now)
+
+
+def test_mark_events_bulk_granularities():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    bm.mark_events_bulk([('active', 123, now)], day=False, hour=False)
+
+    assert 123 in bm.get_month_event('active', now)
+    assert 123 in bm.get_week_event('active', now)
+    assert 123 not in bm.get_day_event('active', now)
+    assert 123 not in bm.get_hour_event('active', now)
+
+
+def test_mark_event_with_script():
+    bm_script = Bitmapist(client, use_script=True)
+    bm_script.delete_all()
+
+    now = datetime.utcnow()
+    bm_script.mark_event('active', 123, now=now)
+    bm_script.mark_event('active', 23232, now=now, day=False, hour=False)
+
+    assert bm_script.get_month_event('active', now).get_count() == 2
+    assert bm_script.get_week_event('active', now).get_count() == 2
+    assert bm_script.get_day_event('active', now).get_count() == 1
+    assert 123 in bm_script.get_hour_event('active', now)
+    assert 23232 not in bm_script.get_hour_event('active', now)
+
+    # The script records the event name in the registry itself
+    assert client.zscore('trackist:names:ev', 'active') is not None
+
+
+def test_mark_event_with_script_and_expire():
+    bm_script = Bitmapist(client, use_script=True)
+    bm_script.delete_all()
+
+    now = datetime.utcnow()
+    bm_script.mark_event('active', 123, now=now, hour_ttl=timedelta(seconds=1))
+    hour_key = bm_script.get_hour_event('active', now).redis_key
+    month_key = bm_script.get_month_event('active', now).redis_key
+    assert 0 < client.ttl(hour_key) <= 1
+    assert client.ttl(month_key) in (None, -1)
+
+    # The TTL of an existing key is left untouched
+    bm_script.mark_event('active', 124, now=now, hour_ttl=100)
+    assert client.ttl(hour_key) <= 1
+
+    time.sleep(1.1)
+    assert 123 not in bm_script.get_hour_event('active', now)
+    assert 123 in bm_script.get_month_event('active', now)
+
+
+def test_bit_operations_are_lazy():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    last_month = now - timedelta(days=30)
+    bm.mark_event('active', 123, now=now)
+    bm.mark_event('active', 123, now=last_month)
+    bm.mark_event('active', 224, now=last_month)
+    bm.mark_attribute('paid_user', 123)
+
+    inner = bm.bit_op_and(
+        bm.get_month_event('active', last_month),
+        bm.get_month_event('active', now)
+    )
+    outer = bm.bit_op_and(inner, bm.get_attribute('paid_user'))
+
+    # Nothing is computed until the result is queried
+    assert not client.exists(inner.redis_key)
+    assert not client.exists(outer.redis_key)
+
+    assert len(outer) == 1
+    assert 123 in outer
+
+    # Intermediate results are dropped right away
+    assert client.exists(outer.redis_key)
+    assert not client.exists(inner.redis_key)
+    assert client.keys('trackist:bitop:tmp:*') == []
+
+    # The nested operation can still be used on its own
+    assert len(inner) == 1
+    assert 224 not in inner
+
+
+def test_planned_bit_operations():
+    bm_plan = Bitmapist(client, plan_bit_ops=True)
+    bm_plan.delete_all()
+
+    now = datetime.utcnow()
+    last_month = now - timedelta(days=30)
+    bm_plan.mark_event('active', 123, now=now)
+    bm_plan.mark_event('active', 123, now=last_month)
+    bm_plan.mark_event('active', 224, now=last_month)
+    bm_plan.mark_attribute('paid_user', 4)
+
+    this_month = bm_plan.get_month_event('active', now)
+    prev_month = bm_plan.get_month_event('active', last_month)
+    missing = bm_plan.get_attribute('missing')
+
+    # AND with a missing operand is skipped
+    empty_and = bm_plan.bit_op_and(prev_month, missing, this_month)
+    assert len(empty_and) == 0
+    assert not client.exists(empty_and.redis_key)
+
+    # Missing operands are dropped from OR, duplicates are removed
+    assert len(bm_plan.bit_op_or(prev_month, missing, prev_month, this_month)) == 2
+    assert len(bm_plan.bit_op_and(prev_month, prev_month, this_month)) == 1
+    assert len(bm_plan.bit_op_or(missing, missing)) == 0
+    assert len(bm_plan.bit_op_xor(prev_month, missing, this_month)) == 1
+
+    # Nested operations give the same results as without planning
+    nested = bm_plan.bit_op_or(
+        bm_plan.bit_op_and(prev_month, missing),
+        bm_plan.bit_op_and(prev_month, this_month),
+    )
+    assert len(nested) == 1
+    assert 123 in nested
+
+    # NOT depends on the length of its operand, so the AND is still computed
+    paid = bm_plan.get_attribute('paid_user')
+    assert len(bm_plan.bit_op_not(bm_plan.bit_op_and(paid, missing))) == 8
+    assert len(bm.bit_op_not(bm.bit_op_and(paid, missing))) == 8
+    assert len(bm_plan.bit_op_not(missing)) == 0
+
+    # An AND is as long as its longest operand, even under an OR
+    bm_plan.mark_attribute('big_user', 800)
+    big = bm_plan.get_attribute('big_user')
+    for instance in (bm_plan, bm):
+        inverted = instance.bit_op_not(instance.bit_op_or(instance.bit_op_and(big, missing), paid))
+        assert len(inverted) == 101 * 8 - 1
+
+
+def test_cached_bit_operations():
+    bm_cache = Bitmapist(client, cache_bit_ops=True)
+    bm_cache.delete_all()
+
+    now = datetime.utcnow()
+    last_month = now - timedelta(days=30)
+    bm_cache.mark_event('active', 123, now=now)
+    bm_cache.mark_event('active', 123, now=last_month)
+    bm_cache.mark_event('active', 224, now=last_month)
+    bm_cache.mark_attribute('paid_user', 123)
+
+    def active_paid():
+        return bm_cache.bit_op_and(
+            bm_cache.bit_op_and(
+                bm_cache.get_month_event('active', last_month),
+                bm_cache.get_month_event('active', now)
+            ),
+            bm_cache.get_attribute('paid_user')
+        )
+
+    first = active_paid()
+    assert len(first) == 1
+
+    # An identical query reuses the stored result
+    second = active_paid()
+    assert second.redis_key == first.redis_key
+    client.setbit(second.redis_key, 500, 1)
+    assert len(second) == 2
+
+    # Writing to an operand invalidates the result
+    bm_cache.mark_event('active', 224, now=now)
+    bm_cache.mark_attribute('paid_user', 224)
+    third = active_paid()
+    assert len(third) == 2
+    assert 224 in third
+    assert 500 not in third
+
+    # Deleting an operand does too, and drops its version
+    paid_version = 'trackist:bitop:version:trackist:at:paid_user'
+    assert client.exists(paid_version)
+    bm_cache.delete_all_attributes()
+    assert len(active_paid()) == 0
+    assert not client.exists(paid_version)
+
+    # Versions and signatures expire with their keys
+    assert not client.exists('trackist:bitop:versions')
+    assert not client.exists('trackist:bitop:signatures')
+    bm_cache.mark_event('expiring', 1, now=now, month_ttl=100)
+    month_key = bm_cache.get_month_event('expiring', now).redis_key
+    assert 0 < client.ttl('trackist:bitop:version:' + month_key) <= 100
+    ored = bm_cache.bit_op_or(bm_cache.get_month_event('expiring', now),
+                              bm_cache.get_month_event('active', now))
+    assert len(ored) == 3
+    assert 0 < client.ttl(ored.redis_key + ':sig') <= client.ttl(ored.redis_key)
+
+    # Scripts are loaded again when the server lost them
+    client.script_flush()
+    assert len(active_paid()) == 0
+
+
+def test_delete_all_in_batches():
+    bm.delete_all()
+
+    bm.mark_attribute_multi('paid_user', [1, 2])
+    for i in range(25):
+        bm.mark_attribute('attr%s' % i, 1)
+    bm.mark_event('active', 1)
+    client.set('unrelated', 1)
+
+    assert bm.delete_all_attributes(batch_size=10, max_keys_per_second=1000) == 27
+    assert bm.get_all_attribute_names() == set()
+    assert bm.get_all_event_names() == set(['active'])
+
+    assert bm.delete_all(batch_size=3) == 5
+    assert int(client.get('unrelated')) == 1
+    client.delete('unrelated')
+
+    # Keys that are already gone are not counted
+    bm.mark_attribute('paid_user', 1)
+    assert bm._unlink(['trackist:at:paid_user', 'trackist:at:gone']) == 1
+
+
+def test_iter_event_names():
+    bm.delete_all()
+
+    bm.mark_event('signed-up', 123)
+    bm.mark_event('logged-on', 123)
+    bm.mark_event('logged-on', 124)
+
+    event_names = list(bm.iter_event_names())
+    assert sorted(event_names) == ['logged-on', 'signed-up']
+
+
+def test_name_registry():
+    bm.delete_all()
+
+    bm.mark_event('signed-up', 123)
+    bm.mark_events_bulk([('logged-on', 123)])
+    bm.mark_attribute('paid_user', 123)
+
+    assert set(decoded(client.zrange('trackist:names:ev', 0, -1))) == set(['signed-up', 'logged-on'])
+    assert decoded(client.zrange('trackist:names:at', 0, -1)) == ['paid_user']
+
+    # Names are scanned for until the registry is complete
+    client.zadd('trackist:names:ev', {'registered-only': 1})
+    assert bm.get_all_event_names() == set(['signed-up', 'logged-on'])
+
+    # Then they are listed from the registry, not from the keys
+    bm.rebuild_name_registry()
+    assert 'registered-only' in bm.get_all_event_names()
+
+    bm.delete_all_events()
+    assert bm.get_all_event_names() == set()
+    assert bm.get_all_attribute_names() == set(['paid_user'])
+
+    # Names are recorded again after they have been deleted
+    bm.mark_event('signed-up', 124)
+    assert bm.get_all_event_names() == set(['signed-up'])
+    assert decoded(client.zrange('trackist:names:ev', 0, -1)) == ['signed-up']
+
+    # Names not marked for a while are pruned
+    client.zadd('trackist:names:ev', {'stale': 1})
+    assert bm.prune_name_registry(max_age=3600) == 1
+    assert decoded(client.zrange('trackist:names:ev', 0, -1)) == ['signed-up']
+
+
+def test_rebuild_name_registry():
+    bm_unregistered = Bitmapist(client, name_registry=False)
+    bm_unregistered.delete_all()
+
+    bm_unregistered.mark_event('signed-up', 123)
+    bm_unregistered.mark_attribute('paid_user', 123)
+    assert not client.exists('trackist:names:ev')
+    assert bm_unregistered.get_all_event_names() == set(['signed-up'])
+
+    bm.rebuild_name_registry()
+    assert decoded(client.zrange('trackist:names:ev', 0, -1)) == ['signed-up']
+    assert decoded(client.zrange('trackist:names:at', 0, -1)) == ['paid_user']
+
+
+def test_get_count_matches_getbit():
+    bm.delete_all()
+
+    uuids = [0, 3, 7, 8, 9, 15, 16, 30, 31, 33, 40, 47, 63, 64, 70]
+    bm.mark_attribute_multi('paid_user', uuids)
+    att = bm.get_attribute('paid_user')
+
+    for start in range(0, 72, 3):
+        for end in range(start, 80, 5):
+            expected = len([uuid for uuid in uuids if start <= uuid <= end])
+            assert att.get_count(start, end) == expected
+
+    # Negative bits count from the end of the bitmap (72 bits long)
+    assert att.get_count(-8, -1) == 2
+    assert att.get_count(-16, -2) == 3
+    assert att.get_count(-100, 7) == 3
+    assert att.get_count(10, 5) == 0
+
+
+def test_fetch_local_bitmap():
+    bm.delete_all()
+
+    bm.mark_attribute_multi('paid_user', [1, 8, 100])
+    bm.mark_attribute_multi('active', [1, 7, 8, 2000])
+
+    paid = bm.get_attribute('paid_user').fetch(chunk_size=4)
+    active = bm.get_attribute('active').fetch()
+    assert paid.data == bytearray(client.get('trackist:at:paid_user'))
+
+    assert len(paid) == 3
+    assert 100 in paid
+    assert 101 not in paid
+    assert 5000 not in paid
+
+    assert len(paid & active) == len(bm.bit_op_and(
+        bm.get_attribute('paid_user'), bm.get_attribute('active'))) == 2
+    assert len(paid | active) == 5
+    assert len(paid ^ active) == 3
+    assert ~paid == bm.bit_op_not(bm.get_attribute('paid_user')).fetch()
+    assert len(~active) == len(bm.bit_op_not(bm.get_attribute('active')))
+
+    assert len(bm.get_attribute('missing').fetch()) == 0
+
+
+def test_iter_ids():
+    bm.delete_all()
+
+    uuids = [0, 7, 8, 9, 63, 64, 1000, 1001, 70000]
+    bm.mark_attribute_multi('paid_user', uuids)
+    paid = bm.get_attribute('paid_user')
+
+    assert list(paid) == uuids
+    assert list(paid.iter_ids(chunk_size=3)) == uuids
+    assert list(paid.iter_ids(start=8, end=1000, chunk_size=2)) == [8, 9, 63, 64, 1000]
+    assert list(paid.iter_ids(start=10, end=62)) == []
+    assert list(paid.iter_ids(start=1001)) == [1001, 70000]
+    assert list(paid.fetch()) == uuids
+    assert list(bm.get_attribute('missing')) == []
+
+    # Bit operations can be iterated too
+    bm.mark_attribute_multi('active', [9, 64, 70000, 80000])
+    assert list(bm.bit_op_and(paid, bm.get_attribute('active'))) == [9, 64, 70000]
+
+
+def test_id_mapper():
+    mapper = IdMapper(client, cache_size=2, batch_size=2, id_type=int)
+    bm_mapped = Bitmapist(client, id_mapper=mapper)
+    bm_mapped.delete_all()
+
+    now = datetime.utcnow()
+    big_id = 2 ** 62 + 1
+    bm_mapped.mark_event('active', big_id, now=now)
+    bm_mapped.mark_events_bulk([('active', 10 ** 15, now), ('active', big_id, now),
+                                ('active', 'not-a-number', now)], batch_size=2)
+    bm_mapped.mark_attribute('paid_user', big_id)
+    bm_mapped.mark_attribute_multi('paid_user', [10 ** 15, 5])
+
+    # Offsets are dense
+    assert mapper.get_offsets([big_id, 10 ** 15, 'not-a-number', 5]) == [0, 1, 2, 3]
+    assert client.strlen(bm_mapped.get_month_event('active', now).redis_key) == 1
+
+    active = bm_mapped.get_month_event('active', now)
+    assert big_id in active
+    assert 10 ** 15 in active
+    assert 5 not in active
+    assert 12345 not in active
+    assert len(active) == 3
+
+    paid_active = bm_mapped.bit_op_and(active, bm_mapped.get_attribute('paid_user'))
+    assert big_id in paid_active
+    assert list(paid_active) == [big_id, 10 ** 15]
+
+    # A fresh mapper reads the allocated offsets back from Redis
+    other = IdMapper(client)
+    assert other.lookup_offset(10 ** 15) == 1
+    assert other.get_ids([0, 2, 99]) == [str(big_id), 'not-a-number', None]
+    assert IdMapper(client).lookup_offsets([10 ** 15, 'unknown', big_id]) == [1, None, 0]
+    assert Bitmapist(client, id_mapper=IdMapper(client)).get_month_event(
+        'active', now).contains_many([big_id, 'unknown', 5]) == [True, False, False]
+
+
+def test_rollup_mode():
+    bm_rollup = Bitmapist(client, rollup=True)
+    bm_rollup.delete_all()
+
+    now = datetime.utcnow()
+    bm_rollup.mark_event('active', 123, now=now)
+    bm_rollup.mark_events_bulk([('active', 124, now)])
+
+    # Only days and hours are written for the open week and month
+    assert not client.exists(bm.get_month_event('active', now).redis_key)
+    assert not client.exists(bm.get_week_event('active', now).redis_key)
+    assert 123 in bm_rollup.get_hour_event('active', now)
+
+    # Weeks and months are derived from their days on read
+    assert len(bm_rollup.get_month_event('active', now)) == 2
+    assert 124 in bm_rollup.get_week_event('active', now)
+
+    # Compacting materializes the stored bitmaps
+    bm_rollup.compact_rollups(now)
+    assert len(bm.get_month_event('active', now)) == 2
+    assert len(bm.get_week_event('active', now)) == 2
+
+    # Compacting again keeps the TTL of the stored bitmaps
+    month_key = bm.get_month_event('active', now).redis_key
+    client.expire(month_key, 1000)
+    bm_rollup.compact_rollups(now)
+    assert 0 < client.ttl(month_key) <= 1000
+
+    # Names of open weeks are found by scanning their day keys
+    assert Bitmapist(client, rollup=True, name_registry=False).get_all_event_names() == set(['active'])
+
+
+def test_rollup_mode_closed_periods():
+    bm_rollup = Bitmapist(client, rollup=True)
+    bm_rollup.delete_all()
+
+    now = datetime.utcnow()
+    last_month = now - timedelta(days=40)
+
+    # Late marks for closed periods keep writing the stored bitmaps
+    bm_rollup.mark_event('active', 123, now=last_month)
+    assert 123 in bm.get_month_event('active', last_month)
+
+    client.setbit(bm.get_day_event('active', last_month).redis_key, 124, 1)
+    assert len(bm_rollup.get_month_event('active', last_month)) == 2
+    assert len(bm.get_month_event('active', last_month)) == 1
+
+    # Once compacted, closed periods are sealed and read directly
+    bm_rollup.compact_rollups(last_month, event_names=['active'])
+    month = Bitmapist(client, rollup=True).get_month_event('active', last_month)
+    assert month.redis_key == bm.get_month_event('active', last_month).redis_key
+    assert len(month) == 2
+    assert 124 in bm_rollup.get_week_event('active', last_month)
+
+
+def test_range_cover():
+    cover = _get_range_cover(datetime(2012, 10, 30, 22), datetime(2012, 12, 4, 1))
+    assert cover == [
+        ('hour', datetime(2012, 10, 30, 22)),
+        ('hour', datetime(2012, 10, 30, 23)),
+        ('day', datetime(2012, 10, 31)),
+        ('month', datetime(2012, 11, 1)),
+        ('day', datetime(2012, 12, 1)),
+        ('day', datetime(2012, 12, 2)),
+        ('day', datetime(2012, 12, 3)),
+        ('hour', datetime(2012, 12, 4, 0)),
+        ('hour', datetime(2012, 12, 4, 1)),
+    ]
+
+    # A month starting inside a partial week beats the weeks around it
+    cover = _get_range_cover(datetime(2020, 1, 27), datetime(2020, 2, 29, 23))
+    assert cover == [('day', datetime(2020, 1, day)) for day in range(27, 32)] + [
+        ('month', datetime(2020, 2, 1)),
+    ]
+
+    # Monday 2012-10-08 starts a full ISO week
+    cover = _get_range_cover(datetime(2012, 10, 7), datetime(2012, 10, 15, 23))
+    assert cover == [
+        ('day', datetime(2012, 10, 7)),
+        ('week', datetime(2012, 10, 8)),
+        ('day', datetime(2012, 10, 15)),
+    ]
+
+    assert _get_range_cover(datetime(2012, 10, 7, 5), datetime(2012, 10, 7, 5)) == [
+        ('hour', datetime(2012, 10, 7, 5))]
+
+
+def test_get_range_event():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    bm.mark_event('active', 1, now=now)
+    bm.mark_event('active', 2, now=now - timedelta(days=10))
+    bm.mark_event('active', 3, now=now - timedelta(days=29, hours=23))
+    bm.mark_event('active', 4, now=now - timedelta(days=45))
+
+    last_30_days = bm.get_range_event('active', now - timedelta(days=30), now)
+    assert sorted(last_30_days) == [1, 2, 3]
+    assert len(bm.get_range_event('active', now - timedelta(days=30), now)) == 3
+    assert len(bm.get_range_event('active', now - timedelta(days=60), now)) == 4
+    assert len(Bitmapist(client, rollup=True).get_range_event(
+        'active', now - timedelta(days=60), now - timedelta(days=1))) == 3
+
+    try:
+        bm.get_range_event('active', now, now - timedelta(days=1))
+    except ValueError:
+        pass
+    else:
+        raise Exception('No error thrown when expected')
+
+
+def test_key_slot():
+    assert _key_slot('123456789') == 0x31c3
+    assert _key_slot('foo') == 12182
+    assert _key_slot('{user1000}.following') == _key_slot('{user1000}.followers')
+    assert _key_slot('foo{}{bar}') == _key_slot('foo{}{bar}')
+    assert _key_slot('foo{{bar}}zap') == _key_slot('{bar')
+
+
+def test_hash_tag_layout():
+    bm.delete_all()
+
+    now = datetime(2012, 10, 31, 12)
+    by_event = Bitmapist(client, hash_tag='event', name_registry=False)
+    by_month = Bitmapist(client, hash_tag='month', name_registry=False)
+
+    assert by_event.get_day_event('active', now).redis_key == 'trackist:ev:{active}:2012-10-31'
+    assert by_event.get_attribute('paid').redis_key == 'trackist:at:{paid}'
+    assert by_month.get_hour_event('active', now).redis_key == 'trackist:ev:active:2012-10-31-12:{2012-10}'
+    # ISO week 44 of 2012 starts on Monday October 29th
+    assert by_month.get_week_event('active', now).redis_key == 'trackist:ev:active:W2012-44:{2012-10}'
+
+    by_event.mark_event('active', 1, now=now)
+    by_event.mark_attribute('paid', 1)
+    assert by_event.get_all_event_names() == set(['active'])
+    assert by_event.get_all_attribute_names() == set(['paid'])
+
+    bm.delete_all()
+    by_month.mark_event('active', 1, now=now)
+    assert by_month.get_all_event_names() == set(['active'])
+
+
+def test_cluster_cross_slot_bit_ops():
+    bm.delete_all()
+
+    cluster_bm = Bitmapist(client, cluster=True, hash_tag='event')
+    now = datetime.utcnow()
+
+    cluster_bm.mark_event('active', 1, now=now)
+    cluster_bm.mark_event('active', 2, now=now)
+    cluster_bm.mark_event('active', 2, now=now - timedelta(days=31))
+    cluster_bm.mark_event('paid', 2, now=now)
+    cluster_bm.mark_event('paid', 3, now=now)
+
+    # Same event, same slot: runs as BITOP in a key tagged with the event
+    same_slot = cluster_bm.bit_op_and(
+        cluster_bm.get_month_event('active', now),
+        cluster_bm.get_month_event('active', now - timedelta(days=31)))
+    assert same_slot.redis_key.startswith('trackist:bitop:{active}:AND:')
+    assert list(same_slot) == [2]
+
+    # Different events, different slots: computed client-side
+    cross_slot = cluster_bm.bit_op_or(
+        cluster_bm.bit_op_and(cluster_bm.get_month_event('active', now),
+                              cluster_bm.get_month_event('paid', now)),
+        cluster_bm.bit_op_not(cluster_bm.get_month_event('active', now - timedelta(days=31))))
+    assert not _same_slot([cluster_bm.get_month_event('active', now).redis_key,
+                           cluster_bm.get_month_event('paid', now).redis_key])
+    assert list(cross_slot) == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert client.ttl(cross_slot.redis_key) > 0
+
+    empty = cluster_bm.bit_op_and(cluster_bm.get_month_event('active', now),
+                                  cluster_bm.get_month_event('nothing', now))
+    assert len(empty) == 0
+    # Like BITOP, the result is as long as the longest operand
+    tagged_bm = Bitmapist(client, hash_tag='event')
+    assert empty.has_events_marked() == tagged_bm.bit_op_and(
+        tagged_bm.get_month_event('active', now),
+        tagged_bm.get_month_event('nothing', now)).has_events_marked()
+
+    for options in ({'cache_bit_ops': True}, {'use_script': True},
+                    {'id_mapper': IdMapper(client)}):
+        try:
+            Bitmapist(client, cluster=True, **options)
+        except ValueError:
+            pass
+        else:
+            raise Exception('No error thrown when expected')
+
+
+def test_segmented_bitmaps():
+    bm.delete_all()
+
+    seg_bm = Bitmapist(client, segment_size=16)
+    now = datetime.utcnow()
+    last_month = now - timedelta(days=31)
+
+    seg_bm.mark_event('active', 1, now=now)
+    seg_bm.mark_event('active', 40, now=now)
+    seg_bm.mark_events_bulk([('active', 41, now), ('active', 3, last_month), ('active', 40, last_month)])
+    seg_bm.mark_attribute('paid', [3, 41, 100])
+    seg_bm.mark_attribute('paid', 100, mark_as=0)
+
+    month = seg_bm.get_month_event('active', now)
+    assert client.smembers(month.redis_key) == set([b'0', b'2'])
+    assert client.getbit(month.redis_key + ':s:2', 8) == 1
+
+    assert len(month) == 3
+    assert month.get_count(2, 40) == 1
+    assert month.get_count(-8) == 2
+    assert 41 in month and 1 in month
+    assert 2 not in month and 1000 not in month
+    assert list(month) == [1, 40, 41]
+    assert list(month.iter_ids(10, 40)) == [40]
+    assert month.fetch() == LocalBitmap(b'\x40\x00\x00\x00\x00\xc0')
+    assert month.has_events_marked()
+    assert not seg_bm.get_month_event('nothing', now).has_events_marked()
+
+    paid = seg_bm.get_attribute('paid')
+    assert list(paid) == [3, 41]
+
+    both = seg_bm.bit_op_and(month, seg_bm.get_month_event('active', last_month))
+    assert list(both) == [40]
+    assert client.smembers(both.redis_key) == set([b'0', b'2'])
+
+    nested = seg_bm.bit_op_or(seg_bm.bit_op_xor(month, paid), seg_bm.get_month_event('nothing', now))
+    assert list(nested) == [1, 3, 40]
+    assert nested.get_count(0, 15) == 2
+
+    # NOT inverts up to the end of its operand, missing segments included
+    inverted = seg_bm.bit_op_not(paid)
+    plain_bm = Bitmapist(client, prefix='plain')
+    plain_bm.mark_attribute('paid', [3, 41, 100])
+    plain_bm.mark_attribute('paid', 100, mark_as=0)
+    assert len(inverted) == len(plain_bm.bit_op_not(plain_bm.get_attribute('paid'))) == 102
+    plain_bm.delete_all()
+    assert 3 not in inverted and 0 in inverted and 23 in inverted and 100 in inverted
+    assert 41 not in inverted and 104 not in inverted
+    assert len(seg_bm.bit_op_not(seg_bm.bit_op_not(paid))) == 2
+    assert len(seg_bm.bit_op_or(seg_bm.bit_op_not(seg_bm.get_attribute('nothing')), paid)) == 2
+    assert len(seg_bm.bit_op_and(seg_bm.bit_op_not(month), seg_bm.get_attribute('paid'))) == 1
+
+    assert seg_bm.get_all_event_names() == set(['active'])
+    seg_bm._forget_names('ev', 'at')
+    assert set(seg_bm._scan_event_names()) == set(['active'])
+    assert set(seg_bm._scan_attribute_names()) == set(['paid'])
+
+    try:
+        Bitmapist(client, segment_size=12)
+    except ValueError:
+        pass
+    else:
+        raise Exception('No error thrown when expected')
+
+
+def test_temp_key_names_are_bounded():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    op = bm.get_day_event('active', now)
+    for days in range(1, 50):
+        op = bm.bit_op_or(op, bm.get_day_event('active', now - timedelta(days=days)))
+    assert len(op.redis_key) < 80
+    assert op.redis_key.startswith('trackist:bitop:OR:')
+
+    same = bm.bit_op_and(bm.get_day_event('active', now), bm.get_day_event('other', now))
+    other = bm.bit_op_and(bm.get_day_event('other', now), bm.get_day_event('active', now))
+    assert same.redis_key != other.redis_key
+
+
+def test_temp_memory_budget():
+    bm.delete_all()
+
+    budget_bm = Bitmapist(client, temp_memory_budget=2500)
+    now = datetime.utcnow()
+    for i, event_name in enumerate(['a', 'b', 'c']):
+        # 1000 bytes each
+        budget_bm.mark_event(event_name, 7999, now=now)
+        budget_bm.mark_event(event_name, i, now=now)
+
+    ops = [budget_bm.bit_op_or(budget_bm.get_day_event(event_name, now),
+                               budget_bm.get_hour_event(event_name, now))
+           for event_name in ['a', 'b', 'c']]
+
+    assert len(ops[0]) == 2
+    assert len(ops[1]) == 2
+    assert client.hgetall('trackist:bitop:sizes') == {
+        ops[0].redis_key.encode(): b'1000', ops[1].redis_key.encode(): b'1000'}
+
+    # Using the first result makes the second one the least recently used
+    time.sleep(0.01)
+    assert 0 in ops[0]
+    assert len(ops[2]) == 2
+    assert client.exists(ops[0].redis_key)
+    assert not client.exists(ops[1].redis_key)
+    assert client.zrange('trackist:bitop:lru', 0, -1) == [
+        ops[0].redis_key.encode(), ops[2].redis_key.encode()]
+
+    # An evicted result is computed again when read
+    assert list(ops[1]) == [1, 7999]
+    assert client.exists(ops[1].redis_key)
+    assert not client.exists(ops[0].redis_key)
+
+    # The registry keeps a running total of the sizes
+    assert int(client.get('trackist:bitop:used')) == 2000
+    client.delete(ops[2].redis_key)
+    assert len(ops[2]) == 2
+    assert int(client.get('trackist:bitop:used')) == 2000
+
+    try:
+        Bitmapist(client, temp_memory_budget=1000, segment_size=8)
+    except ValueError:
+        pass
+    else:
+        raise Exception('No error thrown when expected')
+
+
+def test_merge_bits():
+    bm.delete_all()
+
+    dense = list(range(100, 300, 3))
+    sparse = [5, 10 ** 6]
+    bm.mark_attribute('dense', dense)
+    bm.mark_attribute('sparse', sparse)
+    bm.mark_events_bulk([('active', uuid) for uuid in dense])
+
+    assert list(bm.get_attribute('dense')) == dense
+    assert list(bm.get_attribute('sparse')) == sparse
+    assert list(bm.get_day_event('active', datetime.utcnow())) == dense
+    assert client.keys('trackist:bitop:tmp:*') == []
+
+    bm.mark_attribute('dense', dense[:20], mark_as=0)
+    assert list(bm.get_attribute('dense')) == dense[20:]
+
+    # Marking keeps the TTL of the bitmap
+    client.expire('trackist:at:dense', 1000)
+    bm.mark_attribute('dense', dense)
+    assert 0 < client.ttl('trackist:at:dense') <= 1000
+
+    # Bitsets are OR-ed into new and existing keys alike, keeping their TTL
+    bm._write_bitsets({'trackist:at:dense': [(0, b'\x80')],
+                       'trackist:at:new': [(1, b'\x01'), (2, b'\x80')]})
+    assert list(bm.get_attribute('dense')) == [0] + dense
+    assert 0 < client.ttl('trackist:at:dense') <= 1000
+    assert list(bm.get_attribute('new')) == [15, 16]
+    assert client.keys('trackist:bitop:tmp:*') == []
+
+
+def test_buffered_bitmapist():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    with BufferedBitmapist(client, max_marks=100, max_delay=None) as buffered:
+        for _ in range(3):
+            for uuid in range(10):
+                buffered.mark_event('active', uuid, now=now)
+        buffered.mark_attribute('paid', [1, 2, 3])
+        buffered.mark_attribute('paid', 3)
+
+        # Nothing is written until the buffer is flushed
+        assert not bm.get_day_event('active', now).has_events_marked()
+        assert buffered._pending_count == 43
+
+        # Unmarking writes the buffer first
+        buffered.mark_attribute('paid', 2, mark_as=0)
+        assert list(bm.get_attribute('paid')) == [1, 3]
+        assert len(bm.get_month_event('active', now)) == 10
+
+        for uuid in range(10, 200):
+            buffered.mark_event('active', uuid, now=now, month=False, week=False, hour=False)
+        # Flushed when the 100th distinct bit was buffered
+        assert len(bm.get_day_event('active', now)) == 110
+        buffered.mark_event('late', 1, now=now)
+
+    assert len(bm.get_day_event('active', now)) == 200
+    assert 1 in bm.get_hour_event('late', now)
+    assert bm.get_all_event_names() == set(['active', 'late'])
+    assert bm.get_all_attribute_names() == set(['paid'])
+
+    delayed = BufferedBitmapist(client, max_delay=0)
+    delayed.mark_event('delayed', 1, now=now)
+    assert 1 in bm.get_day_event('delayed', now)
+
+
+class FailingClient(object):
+    """
+    Passes commands on to `client`, but fails to open pipelines while `failing` is set.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.failing = True
+
+    def pipeline(self, *args, **kwargs):
+        if self.failing:
+            raise redis.ConnectionError('Connection refused')
+        return self.client.pipeline(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_buffered_bitmapist_keeps_marks_when_flushing_fails():
+    bm.delete_all()
+
+    now = datetime.utcnow()
+    failing = FailingClient(client)
+    buffered = BufferedBitmapist(failing, max_delay=None)
+    buffered.mark_event('active', 1, now=now)
+    buffered.mark_attribute('paid', [1, 2])
+    try:
+        buffered.flush()
+    except redis.ConnectionError:
+        pass
+    else:
+        raise Exception('No error thrown when expected')
+    assert buffered._pending_count == 6
+
+    failing.failing = False
+    assert buffered.flush() == 6
+    assert 1 in bm.get_hour_event('active', now)
+    assert list(bm.get_attribute('paid')) == [1, 2]
+    assert bm.get_all_event_names() == set(['active'])
+
+
+def test_bitfield_writes_and_contains_many():
+    bm.delete_all()
+
+    sparse = [3, 5000, 10 ** 6, 77]
+    bm.mark_attribute('paid', sparse)
+    assert list(bm.get_attribute('paid')) == sorted(sparse)
+    bm.mark_attribute('paid', [5000, 10 ** 6], mark_as=0)
+    assert list(bm.get_attribute('paid')) == [3, 77]
+
+    bm_setbit = Bitmapist(client)
+    bm_setbit._supports_bitfield = False
+    bm_setbit.mark_attribute('trial', [1, 10 ** 5])
+    assert list(bm.get_attribute('trial')) == [1, 10 ** 5]
+
+    uuids = [77, 4, 3, 10 ** 6, 3]
+    assert bm.get_attribute('paid').contains_many(uuids) == [True, False, True, False, True]
+    assert bm.get_attribute('nothing').contains_many(uuids) == [False] * 5
+    assert bm.get_attribute('paid').contains_many([]) == []
+
+    both = bm.bit_op_or(bm.get_attribute('paid'), bm.get_attribute('trial'))
+    assert both.contains_many(range(0, 5)) == [False, True, False, True, False]
+
+    seg_bm = Bitmapist(client, segment_size=16)
+    seg_bm.mark_attribute('seg', [1, 40, 41])
+    assert seg_bm.get_attribute('seg').contains_many([41, 1, 2, 1000]) == [True, True, False, False]
+
+    # Errors other than a missing BITFIELD command are raised
+    client.sadd('trackist:at:not-a-bitmap', 1)
+    try:
+        bm.get_attribute('not-a-bitmap').contains_many([1, 2])
+    except redis.ResponseError:
+        pass
+    else:
+        raise Exception('No error thrown when expected')
+    client.delete('trackist:at:not-a-bitmap')
+
+
+def test_instrumentation():
+    calls = []
+    instrumentation = Instrumentation(callbacks=[calls.append])
+    bm.delete_all()
+    ibm = Bitmapist(client, instrumentation=instrumentation)
+    now = datetime.utcnow()
+
+    ibm.mark_event('active', 123, now=now)
+    ibm.mark_attribute('paid_user', [1, 123])
+    active = ibm.get_month_event('active', now)
+    assert 123 in active
+    assert active.get_count(0, 200) == 1
+    assert ibm.bit_op_and(active, ibm.get_attribute('paid_user')).get_count() == 1
+    assert len(ibm.get_all_event_names()) == 1
+
+    names = [call.name for call in calls]
+    assert names[:5] == ['Bitmapist.mark_event', 'Bitmapist.mark_attribute',
+                         'MonthEvents.__contains__', 'MonthEvents.get_count', 'BitOpAnd.get_count']
+    mark_event = calls[0]
+    assert (mark_event.round_trips, mark_event.commands) == (1, 5)
+    assert mark_event.bytes_sent > 0
+    assert calls[4].round_trips == 1
+
+    stats = instrumentation.snapshot()
+    assert stats['Bitmapist.get_all_event_names']['calls'] == 1
+    assert stats['Bitmapist.mark_attribute']['calls'] == 1
+    assert 'Bitmapist.mark_attribute_multi' not in stats
+    assert sum(count for _, count in stats['MonthEvents.get_count']['histogram']) == 1
+    assert stats['MonthEvents.get_count']['histogram'][-1][0] is None
+
+    instrumentation.reset()
+    assert instrumentation.snapshot() == {}
+    assert 123 in bm.get_month_event('active', now)
+    assert not calls[len(names):]
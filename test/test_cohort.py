@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from bitmapist import Bitmapist
+from bitmapist.cohort import Cohort
+import redis
+
+client = redis.Redis('localhost')
+bm = Bitmapist(client)
+
+
+def test_get_dates_data():
+    bm.delete_all()
+
+    today = datetime.utcnow()
+    two_days_ago = today - timedelta(days=2)
+    yesterday = today - timedelta(days=1)
+
+    bm.mark_event('active', 1, now=two_days_ago)
+    bm.mark_event('active', 2, now=two_days_ago)
+    bm.mark_event('active', 3, now=yesterday)
+    bm.mark_event('song:play', 1, now=two_days_ago)
+    bm.mark_event('song:play', 1, now=yesterday)
+    bm.mark_event('song:play', 2, now=yesterday)
+    bm.mark_event('song:play', 4, now=today)
+
+    dates = Cohort(bm).get_dates_data('active', 'song:play', as_percent=False)
+    assert len(dates) == 25
+
+    row = dates[-3]
+    assert row[0].date() == two_days_ago.date()
+    assert row[1] == 2
+    assert row[2:5] == [1, 2, 0.0]
+    assert row[5:] == [''] * 10
+
+    row = dates[-2]
+    assert row[1] == 1
+    assert row[2:4] == [0.0, 0.0]
+
+    assert dates[-1][1:] == [0] + [''] * 13
+
+    dates = Cohort(bm).get_dates_data('active', 'song:play')
+    assert dates[-3][2:4] == [50.0, 100.0]
+
+
+def test_get_dates_data_cluster():
+    bm.delete_all()
+
+    cluster_bm = Bitmapist(client, cluster=True, hash_tag='event')
+    today = datetime.utcnow()
+    for uuid, days_ago in [(1, 3), (2, 3), (3, 2), (1, 1), (2, 0)]:
+        cluster_bm.mark_event('active', uuid, now=today - timedelta(days=days_ago))
+        cluster_bm.mark_event('song:play', uuid, now=today - timedelta(days=days_ago - 1))
+    cluster_bm.mark_event('active', 1, now=today)
+
+    for select2 in ('active', 'song:play'):
+        expected = Cohort(Bitmapist(client, hash_tag='event')).get_dates_data(
+            'active', select2, as_percent=False)
+        dates = Cohort(cluster_bm).get_dates_data('active', select2, as_percent=False)
+        assert [row[1:] for row in dates] == [row[1:] for row in expected]
+
+
+def test_get_dates_data_segmented():
+    bm.delete_all()
+
+    marks = [('active', 1, 3), ('active', 20, 3), ('active', 3, 2), ('active', 20, 1),
+             ('song:play', 20, 2), ('song:play', 1, 1), ('song:play', 35, 0)]
+    seg_bm = Bitmapist(client, prefix='seg', segment_size=16)
+    for event_name, uuid, days_ago in marks:
+        seg_bm.mark_event(event_name, uuid, now=datetime.utcnow() - timedelta(days=days_ago))
+        bm.mark_event(event_name, uuid, now=datetime.utcnow() - timedelta(days=days_ago))
+
+    expected = Cohort(bm).get_dates_data('active', 'song:play', as_percent=False)
+    dates = Cohort(seg_bm).get_dates_data('active', 'song:play', as_percent=False)
+    assert [row[1:] for row in dates] == [row[1:] for row in expected]
+    seg_bm.delete_all()
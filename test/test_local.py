@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import shutil
+import tempfile
+
+from bitmapist import Bitmapist, BufferedBitmapist
+from bitmapist.local import LocalRedis
+import redis
+
+client = redis.Redis('localhost')
+
+
+def mark_history(bm, now):
+    last_month = now - timedelta(days=31)
+    for uuid in range(0, 200, 3):
+        bm.mark_event('active', uuid, now=now)
+    bm.mark_event('active', 7, now=last_month)
+    bm.mark_event('active', 9, now=last_month)
+    bm.mark_event('signup', 9, now=now, month_ttl=3600)
+    bm.mark_attribute('paid_user', [3, 6, 7, 500])
+    bm.mark_attribute('paid_user', 500, mark_as=0)
+
+
+def query_history(bm, now):
+    last_month = now - timedelta(days=31)
+    month = bm.get_month_event('active', now)
+    paid = bm.get_attribute('paid_user')
+    return [
+        month.get_count(),
+        month.get_count(10, 100),
+        bm.get_hour_event('active', now).get_count(),
+        9 in month,
+        10 in month,
+        bm.bit_op_and(month, paid).get_count(),
+        bm.bit_op_or(month, bm.get_month_event('active', last_month)).get_count(),
+        bm.bit_op_xor(month, paid).get_count(),
+        list(bm.bit_op_and(month, paid)),
+        bm.bit_op_not(paid).get_count(),
+        bm.get_attribute('paid_user').contains_many([3, 4, 6, 500]),
+        bm.get_month_event('active', now).fetch().data,
+        sorted(bm.iter_event_names()),
+    ]
+
+
+def test_local_backend_matches_redis():
+    now = datetime.utcnow()
+    Bitmapist(client).delete_all()
+    mark_history(Bitmapist(client), now)
+
+    local = LocalRedis()
+    mark_history(Bitmapist(local), now)
+
+    assert query_history(Bitmapist(local), now) == query_history(Bitmapist(client), now)
+    assert local.ttl(Bitmapist(local).get_month_event('signup', now).redis_key) > 3500
+
+
+def test_local_backend_files():
+    now = datetime.utcnow()
+    path = tempfile.mkdtemp()
+    try:
+        local = LocalRedis(path)
+        with BufferedBitmapist(local, max_marks=50) as buffered:
+            for uuid in range(1000):
+                buffered.mark_event('active', uuid * 7, now=now)
+        bm = Bitmapist(local)
+        bm.bit_op_and(bm.get_month_event('active', now), bm.get_day_event('active', now)).get_count()
+        bm.delete_temporary_bitop_keys()
+        local.close()
+
+        reopened = LocalRedis(path)
+        bm = Bitmapist(reopened)
+        month = bm.get_month_event('active', now)
+        assert month.get_count() == 1000
+        assert 6993 in month
+        assert 6994 not in month
+        assert sorted(bm.iter_event_names()) == ['active']
+        assert not list(reopened.scan_iter('trackist:bitop:*'))
+        reopened.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_local_backend_limits_open_files():
+    now = datetime.utcnow()
+    path = tempfile.mkdtemp()
+    try:
+        local = LocalRedis(path, max_open_files=4)
+        bm = Bitmapist(local)
+        for index in range(50):
+            bm.mark_event('event:%d' % index, index, now=now, week=False, day=False, hour=False)
+        assert len(local._open_files._strings) == 4
+        assert bm.get_month_event('event:0', now).get_count() == 1
+        local.close()
+
+        reopened = LocalRedis(path, max_open_files=4)
+        assert not reopened._open_files._strings
+        bm = Bitmapist(reopened)
+        for index in range(50):
+            assert index in bm.get_month_event('event:%d' % index, now)
+        assert len(reopened._open_files._strings) == 4
+        reopened.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_push_to_redis():
+    now = datetime.utcnow()
+    bm = Bitmapist(client)
+    bm.delete_all()
+    bm.mark_event('active', 1, now=now)
+
+    local = LocalRedis()
+    mark_history(Bitmapist(local), now)
+    assert local.push_to_redis(client, merge=True, chunk_size=4) == len(list(local.scan_iter()))
+
+    month = bm.get_month_event('active', now)
+    assert month.get_count() == 68
+    assert 1 in month
+    assert list(bm.get_attribute('paid_user')) == [3, 6, 7]
+    assert client.ttl(bm.get_month_event('signup', now).redis_key) > 3500
+    assert sorted(bm.iter_event_names()) == ['active', 'signup']
+
+    local.push_to_redis(client)
+    assert bm.get_month_event('active', now).get_count() == 67
+
+
+def test_local_compact_rollups():
+    now = datetime.utcnow()
+    local = LocalRedis()
+    bm = Bitmapist(local)
+    bm_rollup = Bitmapist(local, rollup=True)
+
+    bm_rollup.mark_event('active', 123, now=now)
+    bm_rollup.mark_event('active', 124, now=now)
+    assert not local.exists(bm.get_month_event('active', now).redis_key)
+
+    bm_rollup.compact_rollups(now)
+    assert len(bm.get_month_event('active', now)) == 2
+    assert len(bm.get_week_event('active', now)) == 2
+
+    # Compacting again keeps the TTL of the stored bitmaps
+    month_key = bm.get_month_event('active', now).redis_key
+    local.expire(month_key, 1000)
+    bm_rollup.compact_rollups(now)
+    assert 0 < local.ttl(month_key) <= 1000
+    assert 0 < local.pttl(month_key) <= 1000 * 1000
+
+
+def test_local_prune_name_registry():
+    local = LocalRedis()
+    bm = Bitmapist(local)
+    bm.mark_event('signed-up', 123)
+    local.zadd('trackist:names:ev', {'stale': 1})
+
+    assert bm.prune_name_registry(max_age=3600) == 1
+    assert local.zrange('trackist:names:ev', 0, -1) == [b'signed-up']
+
+
+def test_push_to_redis_invalidates_cached_bit_ops():
+    now = datetime.utcnow()
+    bm = Bitmapist(client, cache_bit_ops=True)
+    bm.delete_all()
+    bm.mark_event('active', 1, now=now)
+    bm.mark_attribute('paid_user', 1)
+
+    def paid_active():
+        return bm.bit_op_and(bm.get_month_event('active', now), bm.get_attribute('paid_user')).get_count()
+    assert paid_active() == 1
+
+    local = LocalRedis()
+    mark_history(Bitmapist(local), now)
+    local.push_to_redis(client, merge=True)
+    assert paid_active() == 3
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import gzip
+import os
+import tempfile
+
+from bitmapist import Bitmapist
+from bitmapist.snapshot import export_snapshot, import_snapshot, _decode_chunk, _encode_chunk
+import redis
+
+client = redis.Redis('localhost')
+
+
+def test_chunk_encodings():
+    chunks = [
+        b'\x00' * 100,
+        b'\x00' * 50 + b'\x81' + b'\x00' * 49 + b'\x01',
+        b'\xff' * 60 + b'\x00' * 40 + b'\x0f' * 30,
+        bytes(bytearray(range(256))),
+    ]
+    encodings = []
+    for data in chunks:
+        encoding, payload = _encode_chunk(data)
+        encodings.append(encoding)
+        assert _decode_chunk(encoding, payload, len(data)) == data
+    assert encodings == [b'Z', b'S', b'L', b'R']
+
+
+def test_export_and_import_snapshot():
+    now = datetime(2012, 10, 15)
+    bm = Bitmapist(client)
+    segmented = Bitmapist(client, prefix='seg', segment_size=1024)
+    bm.delete_all()
+    segmented.delete_all()
+    for uuid in (3, 70, 700):
+        bm.mark_event('active', uuid, now=now, month_ttl=3600)
+    bm.mark_attribute('paid_user', [5, 1000000])
+    bm.mark_attribute('visited', list(range(0, 300000, 7)))
+    segmented.mark_attribute('paid_user', [5, 9000, 20000])
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        assert export_snapshot(client, path, 'trackist:*', chunk_size=4096) == 6
+        assert export_snapshot(client, path + '.seg', 'seg:*') == 4
+        assert os.path.getsize(path) < 20000
+
+        visited = bm.get_attribute('visited').fetch()
+        bm.delete_all()
+        segmented.delete_all()
+        bm.mark_attribute('paid_user', [6])
+        client.expire(bm.get_attribute('paid_user').redis_key, 1000)
+
+        assert import_snapshot(client, path, merge=True, batch_size=4096) == 6
+        assert import_snapshot(client, path + '.seg') == 4
+        assert bm.get_attribute('visited').fetch() == visited
+        assert list(bm.get_month_event('active', now)) == [3, 70, 700]
+        assert 3500 < client.ttl(bm.get_month_event('active', now).redis_key) <= 3600
+        assert list(bm.get_attribute('paid_user')) == [5, 6, 1000000]
+        assert 0 < client.ttl(bm.get_attribute('paid_user').redis_key) <= 1000
+        assert list(segmented.get_attribute('paid_user')) == [5, 9000, 20000]
+        assert not list(client.scan_iter('trackist:bitop:*:tmp:*'))
+
+        cached = Bitmapist(client, cache_bit_ops=True)
+
+        def paid_or_visited():
+            return cached.bit_op_or(cached.get_attribute('paid_user'),
+                                    cached.get_attribute('visited')).get_count()
+        assert paid_or_visited() == visited.get_count() + 3
+
+        # Imports invalidate cached results over the keys they replace
+        import_snapshot(client, path)
+        assert list(bm.get_attribute('paid_user')) == [5, 1000000]
+        assert paid_or_visited() == visited.get_count() + 2
+    finally:
+        for name in (path, path + '.seg'):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def test_interrupted_import_leaves_expiring_scratch_keys():
+    bm = Bitmapist(client)
+    bm.delete_all()
+    bm.mark_attribute('visited', list(range(0, 300000, 7)))
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        export_snapshot(client, path, 'trackist:at:*', chunk_size=4096)
+        with gzip.open(path, 'rb') as snapshot:
+            data = snapshot.read()
+        with gzip.open(path, 'wb') as snapshot:
+            snapshot.write(data[:len(data) // 2])
+
+        try:
+            import_snapshot(client, path, merge=True, batch_size=4096)
+        except ValueError:
+            pass
+        else:
+            raise Exception('No error thrown when expected')
+
+        scratch_keys = list(client.scan_iter('trackist:bitop:*:tmp:*'))
+        assert scratch_keys
+        assert all(client.ttl(key) > 0 for key in scratch_keys)
+        bm.delete_temporary_bitop_keys()
+        assert not list(client.scan_iter('trackist:bitop:*:tmp:*'))
+    finally:
+        os.remove(path)